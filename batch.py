@@ -0,0 +1,186 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+from pathlib import Path
+from typing import List, Dict, Any, Optional
+
+from dotenv import load_dotenv
+
+import claude_bot
+import mcp_manager
+
+logger = logging.getLogger(__name__)
+
+# Campos donde se busca el prompt de cada línea (el primero que exista), y su id
+PROMPT_FIELDS = ("prompt", "body", "text", "content")
+ID_FIELDS = ("id", "request_id")
+
+
+def _parse_item(line: str, lineno: int, prompt_field: Optional[str]) -> Dict[str, Any]:
+    data = json.loads(line)
+    if isinstance(data, str):
+        return {"id": str(lineno), "prompt": data}
+
+    fields = (prompt_field,) if prompt_field else PROMPT_FIELDS
+    prompt = next((data[f] for f in fields if data.get(f)), None)
+    if prompt is None:
+        raise ValueError(f"no prompt field ({', '.join(fields)})")
+    # Como en requests.jsonl: el título, si lo hay, encabeza el prompt
+    if not prompt_field and data.get("title") and prompt != data["title"]:
+        prompt = f"{data['title']}\n\n{prompt}"
+    item_id = next((str(data[f]) for f in ID_FIELDS if data.get(f) is not None), str(lineno))
+    return {"id": item_id, "prompt": prompt}
+
+
+def _read_items(path: Path, prompt_field: Optional[str], limit: Optional[int]):
+    """Genera los items del archivo de uno en uno; así miles de prompts no se cargan a la vez."""
+    count = 0
+    with open(path, "r", encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            if limit is not None and count >= limit:
+                return
+            count += 1
+            try:
+                yield _parse_item(line, lineno, prompt_field)
+            except (ValueError, TypeError) as e:
+                yield {"id": str(lineno), "prompt": None, "error": f"invalid input line: {e}"}
+
+
+async def _run_item(item: Dict[str, Any], started_at: float) -> Dict[str, Any]:
+    record = {"id": item["id"]}
+    if item.get("prompt") is None:
+        record.update(status="error", error=item.get("error"))
+        return record
+
+    # Cada item es una conversación nueva en memoria. Los límites de la API y los reintentos
+    # los gestiona claude_bot.scheduler, compartido por todos los workers.
+    session = claude_bot.ChatSession(item["id"], None)
+    chunks: List[str] = []
+    turn_start = time.monotonic()
+    async for chunk in session.send_message_stream(item["prompt"]):
+        chunks.append(chunk)
+    turn_end = time.monotonic()
+
+    error = session.last_error
+    reply = session.history[-1] if session.history and session.history[-1].role == "assistant" else None
+    usage = session.last_turn_usage
+    record.update(
+        status="error" if error is not None else "ok",
+        response=reply.content if reply else "".join(chunks),
+        tool_calls=[c["name"] for c in (reply.tool_calls or [])] if reply else [],
+        error=str(error) if error is not None else None,
+        timings={
+            "queued_s": round(turn_start - started_at, 4),
+            # Hasta el primer texto del modelo: los avisos de reintento también llegan como chunks
+            "ttft_s": round(session.last_ttft, 4) if session.last_ttft is not None else None,
+            "turn_s": round(turn_end - turn_start, 4),
+        },
+        usage={
+            "input_tokens": usage.get("input_tokens", 0),
+            "output_tokens": usage.get("output_tokens", 0),
+            "cache_read_tokens": usage.get("cache_read_tokens", 0),
+            "requests": usage.get("requests", 0),
+        },
+    )
+    return record
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+async def run_batch(input_path: Path, output, concurrency: int = 8,
+                    prompt_field: Optional[str] = None, limit: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Procesa los prompts de `input_path` con como mucho `concurrency` turnos en vuelo y escribe
+    un registro JSON por item en `output` a medida que terminan (orden de finalización).
+    """
+    items = _read_items(input_path, prompt_field, limit)
+    started_at = time.monotonic()
+    latencies: List[float] = []
+    counts = {"ok": 0, "error": 0}
+
+    async def worker():
+        # Los workers comparten el generador; next() no cede el loop, así que no hay carreras
+        for item in items:
+            record = await _run_item(item, started_at)
+            output.write(json.dumps(record, ensure_ascii=False) + "\n")
+            output.flush()
+            counts[record["status"]] += 1
+            if record["status"] == "ok":
+                latencies.append(record["timings"]["turn_s"])
+
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+
+    elapsed = time.monotonic() - started_at
+    done = counts["ok"] + counts["error"]
+    return {
+        "items": done,
+        "ok": counts["ok"],
+        "errors": counts["error"],
+        "elapsed_s": round(elapsed, 3),
+        "items_per_s": round(done / elapsed, 3) if elapsed else 0.0,
+        "p50_turn_s": round(_percentile(latencies, 50), 3),
+        "p95_turn_s": round(_percentile(latencies, 95), 3),
+        "rate_limit": claude_bot.scheduler.get_stats(),
+    }
+
+
+async def _main_async(args) -> Dict[str, Any]:
+    api_key = os.getenv("Anthropic_API_key")
+    if not api_key:
+        print("Please set an anthropic api key", file=sys.stderr)
+        raise SystemExit(1)
+
+    mcp_servers = mcp_manager.load_config(args.config)
+    await claude_bot.initialize(
+        api_key,
+        mcp_servers,
+        max_context=int(os.getenv("MAX_CONTEXT_MESSAGES", "0")),
+        max_parallel=args.max_parallel_tools,
+        context_budget=int(os.getenv("CONTEXT_TOKEN_BUDGET", "8000")),
+        enable_prompt_cache=os.getenv("PROMPT_CACHING", "0").lower() in ("1", "true", "yes"),
+        restore_session=False,
+    )
+    claude_bot.scheduler.configure(max_retries=args.max_retries)
+    try:
+        if args.output == "-":
+            return await run_batch(args.input, sys.stdout, args.concurrency, args.prompt_field, args.limit)
+        with open(args.output, "w", encoding="utf-8") as out:
+            return await run_batch(args.input, out, args.concurrency, args.prompt_field, args.limit)
+    finally:
+        await claude_bot.cleanup()
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Run a JSONL file of prompts through the bot without the TUI")
+    parser.add_argument("input", type=Path, help="JSONL file, one prompt per line")
+    parser.add_argument("-o", "--output", default="batch_results.jsonl", help="results file ('-' for stdout)")
+    parser.add_argument("-c", "--concurrency", type=int, default=8, help="turns in flight at once")
+    parser.add_argument("--max-retries", type=int, default=4, help="retries for rate limits and transient errors")
+    parser.add_argument("--prompt-field", default=None, help=f"field holding the prompt (default: {', '.join(PROMPT_FIELDS)})")
+    parser.add_argument("--limit", type=int, default=None, help="process only the first N items")
+    parser.add_argument("--max-parallel-tools", type=int, default=int(os.getenv("MAX_PARALLEL_TOOLS", "8")))
+    parser.add_argument("--config", default=os.getenv("MCP_CONFIG", "mcp_config.json"))
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, stream=sys.stderr)
+    summary = asyncio.run(_main_async(args))
+    print(json.dumps(summary), file=sys.stderr)
+    if summary["errors"]:
+        raise SystemExit(2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Servidor local que imita el endpoint de streaming de la Messages API de Anthropic para los
+benchmarks. Emite texto a un ritmo configurable de tokens por segundo y, mientras queden rondas,
+responde con tool_use llamando a la tool `work` de cada servidor MCP de benchmark.
+
+    python bench/fake_anthropic.py --port 8765 --tokens-per-sec 200 --tool-rounds 1
+"""
+import json
+import time
+import uuid
+import asyncio
+import argparse
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+WORK_TOOL_SUFFIX = "__work"
+
+
+def _sse(event: str, data: dict) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode()
+
+
+def _tool_rounds_done(messages: list) -> int:
+    """Rondas de tools del turno actual: tool_result desde el último mensaje del usuario."""
+    rounds = 0
+    for msg in reversed(messages):
+        content = msg.get("content")
+        is_result = (msg["role"] == "user" and isinstance(content, list)
+                     and any(b.get("type") == "tool_result" for b in content))
+        if is_result:
+            rounds += 1
+        elif msg["role"] == "user":
+            break
+    return rounds
+
+
+class FakeMessages:
+    def __init__(self, args):
+        self.tokens_per_sec = args.tokens_per_sec
+        self.output_tokens = args.output_tokens
+        self.tool_rounds = args.tool_rounds
+        self.first_token_delay = args.first_token_delay
+        self.rpm = args.rpm
+        self._bucket = float(args.rpm)
+        self._bucket_at = time.monotonic()
+
+    def _take_request(self) -> bool:
+        if not self.rpm:
+            return True
+        now = time.monotonic()
+        self._bucket = min(self.rpm, self._bucket + (now - self._bucket_at) * self.rpm / 60.0)
+        self._bucket_at = now
+        if self._bucket < 1:
+            return False
+        self._bucket -= 1
+        return True
+
+    def _limit_headers(self) -> dict:
+        if not self.rpm:
+            return {}
+        return {
+            "anthropic-ratelimit-requests-limit": str(self.rpm),
+            "anthropic-ratelimit-requests-remaining": str(int(self._bucket)),
+        }
+
+    async def handle(self, request: Request):
+        body = await request.json()
+        if not self._take_request():
+            return JSONResponse(
+                {"type": "error", "error": {"type": "rate_limit_error", "message": "fake rate limit"}},
+                status_code=429, headers={"retry-after": "1", **self._limit_headers()},
+            )
+        input_tokens = len(json.dumps(body)) // 4
+        tools = [t["name"] for t in body.get("tools", []) if t["name"].endswith(WORK_TOOL_SUFFIX)]
+        call_tools = tools if tools and _tool_rounds_done(body["messages"]) < self.tool_rounds else []
+        return StreamingResponse(
+            self._stream(body.get("model", "fake"), input_tokens, call_tools),
+            media_type="text/event-stream",
+            headers=self._limit_headers(),
+        )
+
+    async def _stream(self, model: str, input_tokens: int, call_tools: list):
+        message_id = f"msg_{uuid.uuid4().hex[:12]}"
+        yield _sse("message_start", {"type": "message_start", "message": {
+            "id": message_id, "type": "message", "role": "assistant", "model": model, "content": [],
+            "stop_reason": None, "stop_sequence": None,
+            "usage": {"input_tokens": input_tokens, "output_tokens": 1},
+        }})
+        if self.first_token_delay:
+            await asyncio.sleep(self.first_token_delay)
+
+        yield _sse("content_block_start", {"type": "content_block_start", "index": 0,
+                                           "content_block": {"type": "text", "text": ""}})
+        # Se agrupan los tokens de cada tick de ~10ms para no depender de la resolución del sleep
+        tick = 0.01
+        per_tick = max(1, round(self.tokens_per_sec * tick)) if self.tokens_per_sec else self.output_tokens
+        sent = 0
+        while sent < self.output_tokens:
+            count = min(per_tick, self.output_tokens - sent)
+            yield _sse("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                               "delta": {"type": "text_delta", "text": "tok " * count}})
+            sent += count
+            if self.tokens_per_sec:
+                await asyncio.sleep(count / self.tokens_per_sec)
+        yield _sse("content_block_stop", {"type": "content_block_stop", "index": 0})
+
+        for i, name in enumerate(call_tools, start=1):
+            yield _sse("content_block_start", {"type": "content_block_start", "index": i, "content_block": {
+                "type": "tool_use", "id": f"toolu_{uuid.uuid4().hex[:12]}", "name": name, "input": {},
+            }})
+            yield _sse("content_block_delta", {"type": "content_block_delta", "index": i,
+                                               "delta": {"type": "input_json_delta", "partial_json": '{"n": 1}'}})
+            yield _sse("content_block_stop", {"type": "content_block_stop", "index": i})
+
+        stop_reason = "tool_use" if call_tools else "end_turn"
+        yield _sse("message_delta", {"type": "message_delta",
+                                     "delta": {"stop_reason": stop_reason, "stop_sequence": None},
+                                     "usage": {"output_tokens": sent}})
+        yield _sse("message_stop", {"type": "message_stop"})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake streaming Anthropic Messages API")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--tokens-per-sec", type=float, default=200.0, help="0 = as fast as possible")
+    parser.add_argument("--output-tokens", type=int, default=50)
+    parser.add_argument("--first-token-delay", type=float, default=0.2, help="seconds before the first token")
+    parser.add_argument("--tool-rounds", type=int, default=0, help="tool_use rounds per user turn")
+    parser.add_argument("--rpm", type=int, default=0, help="requests per minute before returning 429 (0 = no limit)")
+    args = parser.parse_args()
+
+    fake = FakeMessages(args)
+    app = Starlette(routes=[Route("/v1/messages", fake.handle, methods=["POST"])])
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+"""
+Servidor MCP de benchmark con una única tool `work` que tarda --latency segundos y devuelve
+--payload-bytes de texto. Funciona por stdio o streamable-http.
+
+    python bench/fake_mcp.py --transport streamable-http --port 8801 --latency 0.05
+"""
+import asyncio
+import argparse
+
+from mcp.server.fastmcp import FastMCP
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake MCP server for benchmarks")
+    parser.add_argument("--transport", choices=("stdio", "streamable-http"), default="stdio")
+    parser.add_argument("--port", type=int, default=8801)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per tool call")
+    parser.add_argument("--payload-bytes", type=int, default=1024, help="size of each tool result")
+    args = parser.parse_args()
+
+    server = FastMCP("bench", port=args.port, log_level="WARNING")
+    payload = "x" * args.payload_bytes
+
+    @server.tool()
+    async def work(n: int = 0) -> str:
+        """Simulated work: waits a fixed latency and returns a fixed-size payload."""
+        await asyncio.sleep(args.latency)
+        return payload
+
+    server.run(args.transport)
+
+
+if __name__ == "__main__":
+    main()
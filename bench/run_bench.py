@@ -0,0 +1,204 @@
+"""
+Benchmark offline del bot: levanta un Messages API falso y servidores MCP falsos (stdio y
+streamable-http), ejecuta conversaciones concurrentes a través de claude_bot y reporta
+throughput, latencia por turno (p50/p99), TTFT, latencia de tools, memoria y arranque.
+
+    python bench/run_bench.py --sessions 20 --turns 3 --concurrency 10 --tool-rounds 1
+    python bench/run_bench.py ... --output after.json --compare before.json
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import logging
+import argparse
+import resource
+import subprocess
+from pathlib import Path
+from typing import List, Dict, Any, Optional
+
+BENCH_DIR = Path(__file__).resolve().parent
+ROOT = BENCH_DIR.parent
+sys.path.insert(0, str(ROOT))
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_for_port(port: int, timeout: float = 15.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"fake server on port {port} did not start")
+
+
+def _spawn(args: List[str], port: int) -> subprocess.Popen:
+    proc = subprocess.Popen([sys.executable, *args], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _wait_for_port(port)
+    return proc
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def _measure_import_time() -> float:
+    """Tiempo de importar los módulos del bot en un proceso limpio."""
+    code = "import time; t = time.perf_counter(); import claude_bot, mcp_manager; print(time.perf_counter() - t)"
+    out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+async def _run_workload(args) -> Dict[str, Any]:
+    import claude_bot
+    import mcp_manager
+    import tracing
+
+    servers = []
+    for i in range(args.stdio_servers):
+        servers.append(mcp_manager.MCPServerConfig(
+            name=f"bstdio{i}",
+            command=sys.executable,
+            args=[str(BENCH_DIR / "fake_mcp.py"), "--latency", str(args.mcp_latency),
+                  "--payload-bytes", str(args.payload_bytes)],
+            max_concurrency=args.mcp_concurrency, read_only_tools=["work"],
+        ))
+    for i, port in enumerate(args.http_ports):
+        servers.append(mcp_manager.MCPServerConfig(
+            name=f"bhttp{i}", url=f"http://127.0.0.1:{port}/mcp", transport="streamable-http",
+            max_concurrency=args.mcp_concurrency, pool_size=args.http_pool_size, read_only_tools=["work"],
+        ))
+
+    mcp_manager.default_hub.speculative_tools = args.speculative
+    start = time.perf_counter()
+    await claude_bot.initialize("bench-key", servers, max_parallel=args.max_parallel_tools,
+                                restore_session=False)
+    startup_s = time.perf_counter() - start
+    not_ready = {n: s for n, s in mcp_manager.get_server_status().items() if s != "ready"}
+    if not_ready:
+        raise RuntimeError(f"MCP servers not ready: {not_ready}")
+
+    tracing.reset()
+    turn_latencies: List[float] = []
+    errors = 0
+    limit = asyncio.Semaphore(args.concurrency)
+
+    async def conversation(index: int):
+        nonlocal errors
+        session = claude_bot.ChatSession(f"bench-{index}", None)
+        for turn in range(args.turns):
+            async with limit:
+                t0 = time.perf_counter()
+                async for _ in session.send_message_stream(f"bench prompt {index}.{turn}"):
+                    pass
+                turn_latencies.append(time.perf_counter() - t0)
+                if session.last_error is not None:
+                    errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(conversation(i) for i in range(args.sessions)))
+    elapsed = time.perf_counter() - start
+
+    spans = tracing.summary()
+    mcp_spans = [v for k, v in spans.items() if k.startswith("mcp.")]
+    await claude_bot.cleanup()
+
+    turns = len(turn_latencies)
+    return {
+        "startup_s": round(startup_s, 3),
+        "turns": turns,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "turns_per_s": round(turns / elapsed, 2) if elapsed else 0.0,
+        "turn_p50_ms": round(_percentile(turn_latencies, 50) * 1000, 1),
+        "turn_p99_ms": round(_percentile(turn_latencies, 99) * 1000, 1),
+        "ttft_p50_ms": spans.get("api.ttft", {}).get("p50_ms", 0.0),
+        "ttft_p99_ms": spans.get("api.ttft", {}).get("p99_ms", 0.0),
+        "tool_calls": sum(v["count"] for v in mcp_spans),
+        "tool_p50_ms": max((v["p50_ms"] for v in mcp_spans), default=0.0),
+        "tool_p99_ms": max((v["p99_ms"] for v in mcp_spans), default=0.0),
+        "rate_limit": claude_bot.scheduler.get_stats(),
+        "speculative_tools": dict(claude_bot.speculation_stats),
+    }
+
+
+def _print_report(results: Dict[str, Any], baseline: Optional[Dict[str, Any]]) -> None:
+    for key, value in results.items():
+        if isinstance(value, dict):
+            continue
+        line = f"{key:<18}{value:>12}"
+        old = (baseline or {}).get(key)
+        if isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+            line += f"   ({(value - old) / old * 100:+.1f}% vs baseline {old})"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark with fake Anthropic and MCP servers")
+    parser.add_argument("--sessions", type=int, default=20, help="concurrent conversations")
+    parser.add_argument("--turns", type=int, default=3, help="user turns per conversation")
+    parser.add_argument("--concurrency", type=int, default=10, help="turns in flight at once")
+    parser.add_argument("--tokens-per-sec", type=float, default=200.0)
+    parser.add_argument("--output-tokens", type=int, default=50)
+    parser.add_argument("--first-token-delay", type=float, default=0.2)
+    parser.add_argument("--tool-rounds", type=int, default=1, help="tool_use rounds per turn")
+    parser.add_argument("--rpm", type=int, default=0, help="fake API requests-per-minute limit")
+    parser.add_argument("--stdio-servers", type=int, default=1)
+    parser.add_argument("--http-servers", type=int, default=1)
+    parser.add_argument("--mcp-latency", type=float, default=0.05)
+    parser.add_argument("--payload-bytes", type=int, default=1024)
+    parser.add_argument("--mcp-concurrency", type=int, default=4)
+    parser.add_argument("--http-pool-size", type=int, default=1, help="sessions per streamable-http server")
+    parser.add_argument("--max-parallel-tools", type=int, default=8)
+    parser.add_argument("--speculative", action="store_true", help="start read-only tools while streaming")
+    parser.add_argument("--output", help="write results JSON here")
+    parser.add_argument("--compare", help="baseline results JSON to diff against")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    api_port = _free_port()
+    procs = [_spawn([str(BENCH_DIR / "fake_anthropic.py"), "--port", str(api_port),
+                     "--tokens-per-sec", str(args.tokens_per_sec), "--output-tokens", str(args.output_tokens),
+                     "--first-token-delay", str(args.first_token_delay), "--tool-rounds", str(args.tool_rounds),
+                     "--rpm", str(args.rpm)], api_port)]
+    args.http_ports = []
+    try:
+        for _ in range(args.http_servers):
+            port = _free_port()
+            procs.append(_spawn([str(BENCH_DIR / "fake_mcp.py"), "--transport", "streamable-http",
+                                 "--port", str(port), "--latency", str(args.mcp_latency),
+                                 "--payload-bytes", str(args.payload_bytes)], port))
+            args.http_ports.append(port)
+
+        os.environ["ANTHROPIC_BASE_URL"] = f"http://127.0.0.1:{api_port}"
+        import_s = _measure_import_time()
+        results = {"import_s": round(import_s, 3), **asyncio.run(_run_workload(args))}
+        # ru_maxrss está en KiB en Linux
+        results["max_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        results["params"] = {k: v for k, v in vars(args).items() if k not in ("output", "compare", "http_ports")}
+    finally:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.wait(timeout=10)
+
+    baseline = json.loads(Path(args.compare).read_text()) if args.compare else None
+    _print_report(results, baseline)
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,32 @@
+import os
+import re
 import json
+import time
+import asyncio
 import logging
-from typing import List, Dict, Any
+import threading
+from array import array
+from typing import List, Dict, Any, Optional, Tuple, TYPE_CHECKING
 from datetime import datetime
 from pathlib import Path
-from dataclasses import dataclass, asdict
-
-from anthropic import AsyncAnthropic
-from anthropic.types import Message
-from anthropic._exceptions import APIError, RateLimitError, APIConnectionError
+from dataclasses import dataclass, field
 
 import mcp_manager
+import tracing
+from rate_limiter import RateLimitScheduler
+from session_writer import SessionWriter
+from tool_selector import SEARCH_TOOL, SEARCH_TOOL_NAME
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# El SDK de Anthropic tarda casi un segundo en importarse: se carga en initialize() (o antes,
+# en un hilo, con preload()) para que la interfaz aparezca sin esperar
+if TYPE_CHECKING:
+    from anthropic import AsyncAnthropic
+    from anthropic.types import Message
 
 logger = logging.getLogger(__name__)
 
@@ -24,219 +41,1315 @@ class ChatMessage:
     content: str
     timestamp: datetime
     tool_calls: List[Dict[str, Any]] = None
+    # Estimación de tokens cacheada; no se persiste
+    token_estimate: Optional[int] = field(default=None, repr=False, compare=False)
+    # (límite, copia con las salidas de tools recortadas) para turnos antiguos; no se persiste
+    compacted: Optional[tuple] = field(default=None, repr=False, compare=False)
+
+
+# Estado compartido por todas las conversaciones del proceso: un único cliente de Anthropic
+# y el hub de conexiones MCP (cada ClientSession multiplexa peticiones concurrentes)
+client: "AsyncAnthropic" = None
+hub: mcp_manager.MCPHub = mcp_manager.default_hub
+# Valores por defecto de cada ChatSession nueva. La ventana de contexto se llena por presupuesto
+# de tokens; max_context_messages es sólo un tope opcional de mensajes (0 = sin tope)
+max_context_messages: int = 0
+context_token_budget: int = 8000
+# Los turnos con tools se guardan completos (tool_use + tool_result). En el contexto, las salidas
+# de tools de los turnos anteriores a los últimos tool_output_turns se recortan a
+# compacted_tool_output_chars caracteres (0 = nunca se recortan)
+tool_output_turns: int = 4
+compacted_tool_output_chars: int = 1000
+# El log sólo crece con cada turno. Cuando pasa de compact_log_bytes y duplica el tamaño que tenía
+# en la compactación anterior, se reescribe con las salidas de tools antiguas recortadas igual que
+# en el contexto, que es lo único que ocupa y ya no se vuelve a enviar entero (0 = nunca)
+compact_log_bytes: int = 4 * 1024 * 1024
+# Resumen incremental de los mensajes que ya no caben en el contexto, hecho en segundo plano con
+# un modelo barato después de cada turno. Se guarda junto a la sesión (<sesión>.summary.json) y
+# se envía como system prompt, así el contexto mantiene la memoria a un coste fijo
+summarize_context: bool = True
+SUMMARY_MODEL = "claude-3-5-haiku-20241022"
+SUMMARY_MAX_TOKENS = 600
+# Tamaño de cada tanda de transcripción que se pliega en el resumen
+SUMMARY_CHUNK_CHARS = 24_000
+# Una sesión larga sin resumen sólo resume sus últimos mensajes fuera de contexto, no todo el log
+SUMMARY_MAX_BACKFILL = 200
+SUMMARY_SYSTEM_PROMPT = (
+    "You maintain a running summary of an earlier part of a conversation between a user and an "
+    "assistant that can call tools. Merge the new transcript into the current summary. Keep facts, "
+    "decisions, names, numbers, file paths, dataset IDs, tool results the user may refer back to, and "
+    "open questions; drop greetings and filler. Write at most 300 words in the language of the "
+    "conversation and output only the updated summary."
+)
+# Heurística de ~4 caracteres por token más un overhead fijo por mensaje
+CHARS_PER_TOKEN = 4
+MESSAGE_OVERHEAD_TOKENS = 4
+# Prompt caching (opt-in): breakpoints en las tools, en el prefijo estable del historial y en
+# el último mensaje de cada vuelta del loop de tools
+prompt_caching: bool = False
+CACHE_CONTROL = {"type": "ephemeral"}
+_cached_tools_key = None
+_cached_tools: List[Dict[str, Any]] = []
+# Log de sesión append-only (una línea JSON por mensaje); session.json es el formato antiguo.
+# Las sesiones abiertas con open_session guardan su log en sessions_dir/<id>.jsonl
+session_file = Path("session.jsonl")
+legacy_session_file = Path("session.json")
+sessions_dir = Path("sessions")
+# Al arrancar sólo se carga la cola del log; lo anterior queda en disco y se pagina bajo demanda
+load_window: int = 200
+_READ_BLOCK = 64 * 1024
+# Los logs se escriben (y serializan) en un hilo aparte, compartido por todas las sesiones
+writer = SessionWriter()
+# Ejecución concurrente de tool_use: límite global de llamadas en vuelo, compartido por
+# todas las sesiones para que muchas conversaciones no saturen los servidores MCP
+parallel_tools: bool = True
+max_parallel_tools: int = 8
+_tool_semaphore: asyncio.Semaphore = None
+# Presupuestos de peticiones/tokens por minuto de la API key y reintentos; compartido por todas
+# las sesiones. El cliente se crea con max_retries=0 para que los reintentos pasen por aquí.
+scheduler = RateLimitScheduler()
+# Llamadas especulativas a tools de sólo lectura (MCPHub.speculative_tools): lanzadas durante el
+# stream, aprovechadas al terminar la respuesta y descartadas (reintento, cambio de argumentos)
+speculation_stats: Dict[str, int] = {"started": 0, "used": 0, "discarded": 0}
+_tools_token_estimate = (None, 0)
+
+def preload():
+    """Importa los módulos pesados (SDK de Anthropic y transportes MCP). Pensado para un hilo."""
+    import anthropic  # noqa: F401
+    import anthropic._exceptions  # noqa: F401
+    import mcp.client.stdio  # noqa: F401
+    import mcp.client.streamable_http  # noqa: F401
 
-client: AsyncAnthropic = None
-conversation_history: List[ChatMessage] = []
-max_context_messages: int = 20
-session_file = Path("session.json")
 
-async def initialize(api_key: str, mcp_servers: List[mcp_manager.MCPServerConfig], max_context: int = 20):
-    global client, max_context_messages
-    client = AsyncAnthropic(api_key=api_key)
+async def initialize(api_key: str, mcp_servers: List[mcp_manager.MCPServerConfig], max_context: int = 0,
+                     max_parallel: int = 8, context_budget: int = 8000, enable_prompt_cache: bool = False,
+                     startup_timeout: Optional[float] = None, restore_session: bool = True,
+                     wait_for_servers: bool = True, keep_tool_output_turns: int = 4,
+                     summarize: bool = True):
+    """
+    Crea el cliente, arranca los servidores MCP y restaura la sesión por defecto. Con
+    wait_for_servers=False los servidores conectan en segundo plano: las tools de los que ya
+    conectaron alguna vez se anuncian desde la caché y cada llamada espera sólo a su servidor.
+    """
+    from anthropic import AsyncAnthropic
+
+    global client, max_context_messages, context_token_budget, prompt_caching, tool_output_turns
+    global summarize_context
+    global max_parallel_tools, parallel_tools, _tool_semaphore
+    client = AsyncAnthropic(api_key=api_key, max_retries=0)
     max_context_messages = max_context
-    await mcp_manager.start_servers(mcp_servers)
-    await load_session()
+    context_token_budget = context_budget
+    prompt_caching = enable_prompt_cache
+    tool_output_turns = keep_tool_output_turns
+    summarize_context = summarize
+    max_parallel_tools = max(1, max_parallel)
+    parallel_tools = max_parallel_tools > 1
+    _tool_semaphore = asyncio.Semaphore(max_parallel_tools)
+    default_session.configure(max_context, context_budget, enable_prompt_cache, keep_tool_output_turns, summarize)
+    # Con wait, espera a que cada servidor esté listo o falle; nunca más que su connect_timeout
+    await hub.start_servers(mcp_servers, wait=wait_for_servers, timeout=startup_timeout)
+    if restore_session:
+        with tracing.span("startup.load_session", "startup"):
+            await default_session.load()
 
-async def load_session():
-    global conversation_history
-    if session_file.exists():
+def _dumps(obj) -> bytes:
+    # orjson es opcional (pip install orjson): serializa varias veces más rápido que json
+    if orjson is not None:
         try:
-            with open(session_file, 'r') as f:
-                data = json.load(f)
-                
-            conversation_history = []
-            for msg_data in data.get('messages', []):
-                msg = ChatMessage(
-                    role=msg_data['role'],
-                    content=msg_data['content'],
-                    timestamp=datetime.fromisoformat(msg_data['timestamp']),
-                    tool_calls=msg_data.get('tool_calls')
-                )
-                conversation_history.append(msg)
-                
-            logger.info(f"Loaded {len(conversation_history)} messages from session")
-        except Exception as e:
-            logger.error(f"Failed to load session: {e}")
+            return orjson.dumps(obj)
+        except TypeError:
+            pass
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False, default=str).encode('utf-8')
 
-async def save_session():
+
+def _loads(line):
+    return orjson.loads(line) if orjson is not None else json.loads(line)
+
+
+def _message_to_record(msg: ChatMessage) -> bytes:
+    return _dumps({
+        'role': msg.role,
+        'content': msg.content,
+        'timestamp': msg.timestamp.isoformat(),
+        'tool_calls': msg.tool_calls,
+    })
+
+
+def _record_to_message(msg_data: Dict[str, Any]) -> ChatMessage:
+    return ChatMessage(
+        role=msg_data['role'],
+        content=msg_data['content'],
+        timestamp=datetime.fromisoformat(msg_data['timestamp']),
+        tool_calls=msg_data.get('tool_calls')
+    )
+
+
+def _load_legacy_session(path: Path) -> List[ChatMessage]:
+    with open(path, 'r') as f:
+        data = json.load(f)
+    return [_record_to_message(msg_data) for msg_data in data.get('messages', [])]
+
+
+def _read_session(path: Path, legacy_path: Optional[Path], window: int):
+    """
+    Lee la cola del log (o el session.json antiguo). Devuelve (offset de la ventana, mensajes,
+    si hay que migrar el formato antiguo) o None si la sesión no existe. Se ejecuta en un hilo.
+    """
+    if path.exists():
+        prefix_bytes, lines = _read_tail_lines(path, window)
+        return prefix_bytes, _parse_lines(lines, path), False
+    if legacy_path and legacy_path.exists():
+        return 0, _load_legacy_session(legacy_path), True
+    return None
+
+
+def _write_log(f, path: Path, prefix_bytes: int, messages: List[ChatMessage]) -> None:
+    """Contenido completo del log: las líneas anteriores a la ventana se copian tal cual."""
+    if prefix_bytes and path.exists():
+        with open(path, 'rb') as src:
+            remaining = prefix_bytes
+            while remaining > 0:
+                block = src.read(min(_READ_BLOCK, remaining))
+                if not block:
+                    break
+                f.write(block)
+                remaining -= len(block)
+    for msg in messages:
+        f.write(_message_to_record(msg))
+        f.write(b'\n')
+
+
+def _read_tail_lines(path: Path, count: int):
+    """
+    Lee hacia atrás desde el final del archivo hasta juntar `count` líneas completas.
+    Devuelve (offset donde empieza la primera línea devuelta, líneas en bytes).
+    Una última línea sin salto de línea final (escritura interrumpida) se recorta del archivo.
+    """
+    with open(path, 'rb+') as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        if end == 0:
+            return 0, []
+
+        f.seek(end - 1)
+        if f.read(1) != b'\n':
+            # Buscar el último salto de línea y truncar lo que quede detrás
+            pos = end
+            cut = 0
+            while pos > 0:
+                start = max(0, pos - _READ_BLOCK)
+                f.seek(start)
+                block = f.read(pos - start)
+                idx = block.rfind(b'\n')
+                if idx != -1:
+                    cut = start + idx + 1
+                    break
+                pos = start
+            logger.warning(f"Truncating torn record at end of {path}")
+            f.truncate(cut)
+            end = cut
+
+        buf = b''
+        pos = end
+        while pos > 0 and buf.count(b'\n') <= count:
+            start = max(0, pos - _READ_BLOCK)
+            f.seek(start)
+            buf = f.read(pos - start) + buf
+            pos = start
+
+    lines = buf.split(b'\n')[:-1]
+    if len(lines) > count:
+        dropped = lines[:len(lines) - count]
+        pos += sum(len(line) + 1 for line in dropped)
+        lines = lines[len(lines) - count:]
+    return pos, lines
+
+
+def _parse_lines(lines, path: Path) -> List[ChatMessage]:
+    messages = []
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            messages.append(_record_to_message(_loads(line)))
+        except (ValueError, KeyError):
+            logger.warning(f"Skipping corrupt record in {path}")
+    return messages
+
+
+def estimate_tokens(msg: ChatMessage) -> int:
+    if msg.token_estimate is None:
+        if isinstance(msg.content, str):
+            chars = len(msg.content)
+        else:
+            chars = len(json.dumps(msg.content, default=str, ensure_ascii=False))
+        msg.token_estimate = chars // CHARS_PER_TOKEN + MESSAGE_OVERHEAD_TOKENS
+    return msg.token_estimate
+
+
+def _estimate_request_tokens(messages: List[Dict[str, Any]], tools: List[Dict[str, Any]]) -> int:
+    """Estimación barata de los tokens de entrada de una petición, para reservar cupo."""
+    global _tools_token_estimate
+    # get_all_tools_for_anthropic devuelve la misma lista mientras no cambie el set de tools
+    if _tools_token_estimate[0] is not tools:
+        _tools_token_estimate = (tools, len(json.dumps(tools, default=str)) // CHARS_PER_TOKEN if tools else 0)
+    chars = 0
+    for msg in messages:
+        content = msg["content"]
+        chars += len(content) if isinstance(content, str) else len(str(content))
+    return chars // CHARS_PER_TOKEN + MESSAGE_OVERHEAD_TOKENS * len(messages) + _tools_token_estimate[1]
+
+
+def _is_tool_result(msg: ChatMessage) -> bool:
+    return (
+        msg.role == "user"
+        and isinstance(msg.content, list)
+        and any(isinstance(b, dict) and b.get("type") == "tool_result" for b in msg.content)
+    )
+
+
+_OMITTED_TOOL_OUTPUT_RE = re.compile(r"\n\[\d+ more characters of this earlier tool output omitted\]$")
+
+
+def _compact_tool_output(content, limit: int):
+    """
+    Texto de una salida de tool recortado a `limit` caracteres; los bloques no textuales se omiten.
+    Recortar una salida ya recortada la deja igual (el log compactado guarda salidas recortadas).
+    """
+    if isinstance(content, str):
+        text = content
+    else:
+        parts = []
+        for block in content or []:
+            if isinstance(block, dict) and block.get("type") == "text":
+                parts.append(block.get("text", ""))
+            else:
+                parts.append(f"[{block.get('type', 'content') if isinstance(block, dict) else 'content'} omitted]")
+        text = "\n".join(parts)
+    if len(text) <= limit:
+        return text
+    omitted = _OMITTED_TOOL_OUTPUT_RE.search(text)
+    if omitted is not None and omitted.start() <= limit:
+        return text
+    return text[:limit] + f"\n[{len(text) - limit} more characters of this earlier tool output omitted]"
+
+
+def _transcript(messages: List[ChatMessage]) -> str:
+    """Mensajes en texto plano para el resumidor; las salidas de tools van recortadas."""
+    lines = []
+    for msg in messages:
+        if isinstance(msg.content, str):
+            if msg.content:
+                lines.append(f"{msg.role.upper()}: {msg.content}")
+            continue
+        for block in msg.content:
+            kind = block.get("type") if isinstance(block, dict) else None
+            if kind == "text" and block.get("text"):
+                lines.append(f"{msg.role.upper()}: {block['text']}")
+            elif kind == "tool_use":
+                args = json.dumps(block.get("input"), ensure_ascii=False, default=str)[:300]
+                lines.append(f"TOOL CALL {block.get('name')}: {args}")
+            elif kind == "tool_result":
+                lines.append(f"TOOL RESULT: {_compact_tool_output(block.get('content'), 500)}")
+    return "\n".join(lines)
+
+
+async def _summarize(previous: str, transcript: str) -> str:
+    """Una llamada al modelo de resumen, pasando por el scheduler compartido (sin reintentos)."""
+    prompt = f"Current summary:\n{previous or '(empty)'}\n\nNew transcript:\n{transcript}"
+    estimated = (len(prompt) + len(SUMMARY_SYSTEM_PROMPT)) // CHARS_PER_TOKEN
+    headers = None
+    await scheduler.acquire(estimated)
     try:
-        data = {'messages': []}
-        
-        for msg in conversation_history:
-            msg_dict = asdict(msg)
-            msg_dict['timestamp'] = msg.timestamp.isoformat()
-            data['messages'].append(msg_dict)
-        
-        with open(session_file, 'w') as f:
-            json.dump(data, f, indent=2)
+        raw = await client.messages.with_raw_response.create(
+            model=SUMMARY_MODEL,
+            max_tokens=SUMMARY_MAX_TOKENS,
+            system=SUMMARY_SYSTEM_PROMPT,
+            messages=[{"role": "user", "content": prompt}],
+        )
+        headers = raw.headers
+        message = raw.parse()
+    finally:
+        scheduler.release(estimated, headers)
+    return "".join(b.text for b in message.content if b.type == "text").strip()
+
+
+def _compacted_tool_message(msg: ChatMessage, limit: int) -> ChatMessage:
+    """Copia de un mensaje de tool_result con cada salida recortada; se calcula una vez por mensaje."""
+    if msg.compacted is None or msg.compacted[0] != limit:
+        blocks = []
+        for block in msg.content:
+            if isinstance(block, dict) and block.get("type") == "tool_result":
+                block = {**block, "content": _compact_tool_output(block.get("content"), limit)}
+            blocks.append(block)
+        msg.compacted = (limit, ChatMessage(role=msg.role, content=blocks, timestamp=msg.timestamp))
+    return msg.compacted[1]
+
+
+async def _execute_tool_block(content_block, tool_hub: Optional[mcp_manager.MCPHub] = None,
+                              owner: Optional[str] = None) -> Dict[str, Any]:
+    tool_hub = tool_hub or hub
+    tool_name = content_block.name
+    arguments = content_block.input
+    tool_use_id = content_block.id
+
+    logger.info(f"Executing tool: {tool_name} with args: {arguments}")
+
+    if "__" in tool_name:
+        server_name, actual_tool_name = tool_name.split("__", 1)
+    else:
+        logger.error(f"Invalid tool name format: {tool_name}")
+        return {
+            "type": "tool_result",
+            "tool_use_id": tool_use_id,
+            "content": "Error: Invalid tool name format. Expected format: server__tool_name"
+        }
+
+    try:
+        if _tool_semaphore is not None:
+            async with _tool_semaphore:
+                result = await tool_hub.call_tool(server_name, actual_tool_name, arguments, owner)
+        else:
+            result = await tool_hub.call_tool(server_name, actual_tool_name, arguments, owner)
+        logger.info(f"Tool {tool_name} completed successfully")
+
+        return {
+            "type": "tool_result",
+            "tool_use_id": tool_use_id,
+            "content": result
+        }
     except Exception as e:
-        logger.error(f"Failed to save session: {e}")
+        logger.error(f"Tool {tool_name} failed: {e}")
+        return {
+            "type": "tool_result",
+            "tool_use_id": tool_use_id,
+            "content": f"Error executing {actual_tool_name}: {str(e)}"
+        }
 
 
-def prepare_messages_for_api() -> List[Dict[str, Any]]:
-    recent_messages = conversation_history[-max_context_messages:]
-    
-    api_messages = []
-    for msg in recent_messages:
-        if msg.role in ["user", "assistant"]:
-            api_messages.append({
-                "role": msg.role,
-                "content": msg.content
-            })
-    
-    return api_messages
-
-
-async def handle_tool_calls(message: Message) -> List[Dict[str, Any]]:
+def _speculate(block, started: Dict[str, tuple], tool_hub: mcp_manager.MCPHub,
+               owner: Optional[str] = None) -> None:
+    """Lanza ya la llamada de un bloque tool_use completo si la tool es de sólo lectura."""
+    if block is None or block.type != "tool_use" or not tool_hub.is_read_only(block.name):
+        return
+    task = asyncio.create_task(_execute_tool_block(block, tool_hub, owner), name=f"speculative-{block.name}")
+    started[block.id] = (block.input, task)
+    speculation_stats["started"] += 1
+
+
+def _discard_speculative(started: Dict[str, tuple]) -> None:
+    """Cancela las llamadas especulativas que ya no se van a usar (reintento, respuesta sin tools)."""
+    for _, task in started.values():
+        task.cancel()
+        speculation_stats["discarded"] += 1
+    started.clear()
+
+
+async def handle_tool_calls(message: "Message", tool_hub: Optional[mcp_manager.MCPHub] = None,
+                            started: Optional[Dict[str, tuple]] = None,
+                            owner: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Ejecuta los tool_use de `message` en nombre de la conversación `owner`. Las llamadas que ya
+    empezaron durante el stream (`started`, tool_use_id -> (input, task)) se esperan en vez de
+    repetirse.
+    """
+    tool_blocks = [block for block in message.content if block.type == "tool_use"]
+    started = started if started is not None else {}
+
+    def run(block):
+        early = started.pop(block.id, None)
+        if early is not None and early[0] == block.input:
+            speculation_stats["used"] += 1
+            return early[1]
+        if early is not None:
+            early[1].cancel()
+            speculation_stats["discarded"] += 1
+        return _execute_tool_block(block, tool_hub, owner)
+
+    if not parallel_tools or len(tool_blocks) < 2:
+        return [await run(block) for block in tool_blocks]
+
+    # Se lanzan todas a la vez; gather conserva el orden de los tool_use_id
+    # y cada bloque captura sus propios errores, así que un fallo no tumba al resto.
+    results = await asyncio.gather(*(run(block) for block in tool_blocks), return_exceptions=True)
+
     tool_results = []
-    
-    for content_block in message.content:
-        if content_block.type == "tool_use":
-            tool_name = content_block.name
-            arguments = content_block.input
-            tool_use_id = content_block.id
-            
-            logger.info(f"Executing tool: {tool_name} with args: {arguments}")
-            
-            if "__" in tool_name:
-                server_name, actual_tool_name = tool_name.split("__", 1)
-            else:
-                logger.error(f"Invalid tool name format: {tool_name}")
-                tool_results.append({
-                    "type": "tool_result",
-                    "tool_use_id": tool_use_id,
-                    "content": "Error: Invalid tool name format. Expected format: server__tool_name"
-                })
-                continue
-            
-            try:
-                result = await mcp_manager.call_tool(server_name, actual_tool_name, arguments)
-                logger.info(f"Tool {tool_name} completed successfully")
-                
-                tool_results.append({
-                    "type": "tool_result",
-                    "tool_use_id": tool_use_id,
-                    "content": str(result)
-                })
-            except Exception as e:
-                logger.error(f"Tool {tool_name} failed: {e}")
-                tool_results.append({
-                    "type": "tool_result",
-                    "tool_use_id": tool_use_id,
-                    "content": f"Error executing {actual_tool_name}: {str(e)}"
-                })
-    
+    for block, result in zip(tool_blocks, results):
+        if isinstance(result, BaseException):
+            logger.error(f"Tool {block.name} failed: {result}")
+            result = {
+                "type": "tool_result",
+                "tool_use_id": block.id,
+                "content": f"Error executing {block.name}: {str(result)}"
+            }
+        tool_results.append(result)
+
     return tool_results
 
-async def send_message_stream(user_input: str):
-    user_msg = ChatMessage(
-        role="user",
-        content=user_input,
-        timestamp=datetime.now()
-    )
-    conversation_history.append(user_msg)
-    
-    try:
-        messages = prepare_messages_for_api()
-        tools = mcp_manager.get_all_tools_for_anthropic()
-        
-        assistant_content = ""
-        all_tool_calls = []
-        current_messages = messages
-        
-        while True:
-            kwargs = {
-                "model": MODEL,
-                "max_tokens": MAX_TOKENS,
-                "messages": current_messages
-            }
-            
-            if tools:
-                kwargs["tools"] = tools
-            
-            current_tool_calls = []
-            
-            async with client.messages.stream(**kwargs) as stream:
-                async for chunk in stream:
-                    if chunk.type == "content_block_delta":
-                        if chunk.delta.type == "text_delta":
-                            text_chunk = chunk.delta.text
-                            assistant_content += text_chunk
-                            yield text_chunk
-                    elif chunk.type == "content_block_start":
-                        if chunk.content_block.type == "tool_use":
-                            current_tool_calls.append({
-                                "id": chunk.content_block.id,
-                                "name": chunk.content_block.name,
-                                "input": chunk.content_block.input
-                            })
-                
-                final_message = await stream.get_final_message()
-            
-            if final_message.stop_reason != "tool_use":
+def _tools_with_cache_breakpoint(tools: List[Dict[str, Any]], tool_hub: mcp_manager.MCPHub) -> List[Dict[str, Any]]:
+    """Copia de la lista de tools con cache_control en la última; se recalcula sólo si cambia."""
+    global _cached_tools_key, _cached_tools
+    # La selección por turno cambia el subconjunto sin cambiar la versión del catálogo
+    key = (id(tool_hub), tool_hub.get_tools_version(), tuple(t["name"] for t in tools))
+    if key != _cached_tools_key:
+        _cached_tools = list(tools)
+        if _cached_tools:
+            _cached_tools[-1] = {**_cached_tools[-1], "cache_control": CACHE_CONTROL}
+        _cached_tools_key = key
+    return _cached_tools
+
+
+def _block_to_dict(block) -> Dict[str, Any]:
+    if isinstance(block, dict):
+        return dict(block)
+    return block.model_dump(exclude_none=True)
+
+
+def _with_cache_breakpoints(messages: List[Dict[str, Any]], indexes: List[int]) -> List[Dict[str, Any]]:
+    """
+    Devuelve una copia de los mensajes con cache_control en el último bloque de cada índice.
+    Los mensajes originales no se modifican.
+    """
+    result = list(messages)
+    for i in set(indexes):
+        if i < 0 or i >= len(result):
+            continue
+        content = result[i]["content"]
+        if isinstance(content, str):
+            if not content:
+                continue
+            blocks = [{"type": "text", "text": content}]
+        else:
+            blocks = [_block_to_dict(b) for b in content]
+            if not blocks:
+                continue
+        blocks[-1] = {**blocks[-1], "cache_control": CACHE_CONTROL}
+        result[i] = {"role": result[i]["role"], "content": blocks}
+    return result
+
+
+class ChatSession:
+    """
+    Una conversación: historial, log en disco y ajustes de contexto propios. Todas las
+    sesiones comparten el cliente de Anthropic, el hub MCP y el límite global de tools, así
+    que un proceso puede atender muchas conversaciones a la vez. Los turnos de una misma
+    sesión se serializan con un lock; sesiones distintas avanzan en paralelo.
+    """
+
+    def __init__(self, session_id: str, path: Optional[Path], legacy_path: Optional[Path] = None,
+                 tool_hub: Optional[mcp_manager.MCPHub] = None):
+        self.session_id = session_id
+        # Sin archivo (path=None) la sesión vive sólo en memoria, p.ej. en el modo batch
+        self.session_file = path
+        self.legacy_session_file = legacy_path
+        self.hub = tool_hub or hub
+        self.history: List[ChatMessage] = []
+        self.max_context_messages = max_context_messages
+        self.context_token_budget = context_token_budget
+        self.prompt_caching = prompt_caching
+        self.tool_output_turns = tool_output_turns
+        self.compact_log_bytes = compact_log_bytes
+        # Tamaño del log cuando se compactó por última vez (ver compact_log_bytes)
+        self._compacted_log_bytes = 0
+        # Resumen de los mensajes [0, summary_covered) del log completo (ver summarize_context)
+        self.summarize = summarize_context
+        self.summary = ""
+        self.summary_covered = 0
+        self._summary_dirty = False
+        self._summary_task: Optional[asyncio.Task] = None
+        # Se incrementa en clear() para descartar un resumen calculado sobre el historial anterior
+        self._summary_generation = 0
+        # Notas del cliente (p.ej. resultado de /upload) que se anteponen al próximo mensaje del usuario
+        self.pending_notes: List[str] = []
+        # Uso de tokens de la última petición/turno (estimado antes de enviar y real según la API)
+        self.last_turn_usage: Dict[str, int] = {}
+        # Error con el que terminó el último turno (None si fue bien); el texto ya se mostró al usuario
+        self.last_error: Optional[Exception] = None
+        # Segundos desde el inicio del último turno hasta el primer texto del modelo (los avisos de
+        # reintento no cuentan); None si el turno no produjo texto
+        self.last_ttft: Optional[float] = None
+        # Cuántos mensajes de history ya están escritos en session_file
+        self._persisted_count = 0
+        # El log deja de reflejar el historial (/clear, líneas rotas) y hay que reescribirlo
+        self._needs_compaction = False
+        # Dónde empieza en el archivo el primer mensaje de history (lo anterior sigue en disco)
+        self._prefix_bytes = 0
+        self._older_index: Optional[array] = None
+        self._older_stats: Optional[Dict[str, int]] = None
+        # El índice y los contadores se construyen tanto desde el loop como desde hilos (to_thread)
+        self._older_lock = threading.RLock()
+        self._turn_lock = asyncio.Lock()
+        # Con prompt caching, tools ya enviadas en esta sesión (el set sólo crece, ver _select_tools)
+        self._sent_tools: set = set()
+
+    def configure(self, max_context: int, context_budget: int, enable_prompt_cache: bool,
+                  keep_tool_output_turns: Optional[int] = None, summarize: Optional[bool] = None):
+        self.max_context_messages = max_context
+        self.context_token_budget = context_budget
+        self.prompt_caching = enable_prompt_cache
+        if keep_tool_output_turns is not None:
+            self.tool_output_turns = keep_tool_output_turns
+        if summarize is not None:
+            self.summarize = summarize
+
+    # ----- Persistencia -----
+
+    async def load(self):
+        if self.session_file is None:
+            return
+        try:
+            self._older_index = None
+            self._older_stats = None
+            window = max(load_window, self.max_context_messages)
+            loaded = await asyncio.to_thread(_read_session, self.session_file, self.legacy_session_file, window)
+            if loaded is None:
+                return
+            self._prefix_bytes, messages, migrated = loaded
+            # Se modifica en sitio: conversation_history es un alias de la sesión por defecto
+            self.history[:] = messages
+            self._persisted_count = len(self.history)
+            if migrated:
+                await self.compact()
+                logger.info(f"Migrated {self.legacy_session_file} to {self.session_file}")
+
+            await self._load_summary()
+            logger.info(f"Loaded {len(self.history)} messages from session {self.session_id}")
+        except Exception as e:
+            logger.error(f"Failed to load session {self.session_id}: {e}")
+
+    def _build_older_index(self) -> array:
+        """
+        Offsets de inicio de cada línea anterior a _prefix_bytes. Se construye una sola vez y
+        recorre la parte antigua del log: desde el loop conviene llamarla con asyncio.to_thread.
+        """
+        with self._older_lock:
+            if self._older_index is not None:
+                return self._older_index
+            if self.session_file is None:
+                self._older_index = array('Q')
+                return self._older_index
+
+            prefix_bytes = self._prefix_bytes
+            index = array('Q')
+            if prefix_bytes > 0 and self.session_file.exists():
+                with open(self.session_file, 'rb') as f:
+                    index.append(0)
+                    pos = 0
+                    while pos < prefix_bytes:
+                        block = f.read(min(_READ_BLOCK, prefix_bytes - pos))
+                        if not block:
+                            break
+                        idx = block.find(b'\n')
+                        while idx != -1:
+                            index.append(pos + idx + 1)
+                            idx = block.find(b'\n', idx + 1)
+                        pos += len(block)
+                # El último offset apunta a _prefix_bytes, no a una línea
+                index.pop()
+            # Un /clear durante la construcción deja el índice obsoleto: no se guarda
+            if self._prefix_bytes == prefix_bytes:
+                self._older_index = index
+            return index
+
+    def _read_older_lines(self, start: int, stop: int) -> List[bytes]:
+        index = self._build_older_index()
+        if start >= stop:
+            return []
+        begin = index[start]
+        end = index[stop] if stop < len(index) else self._prefix_bytes
+        with open(self.session_file, 'rb') as f:
+            f.seek(begin)
+            return f.read(end - begin).split(b'\n')[:-1]
+
+    def total_messages(self) -> int:
+        return len(self._build_older_index()) + len(self.history)
+
+    def get_messages(self, start: int, stop: Optional[int] = None) -> List[ChatMessage]:
+        """
+        Devuelve los mensajes [start, stop) del historial completo. Los que no están en memoria
+        se leen del log usando el índice de offsets, sin cargar el resto del archivo.
+        """
+        older_count = len(self._build_older_index())
+        total = older_count + len(self.history)
+        stop = total if stop is None else min(stop, total)
+        start = max(0, start)
+
+        messages = []
+        if start < older_count:
+            lines = self._read_older_lines(start, min(stop, older_count))
+            messages.extend(_parse_lines(lines, self.session_file))
+        if stop > older_count:
+            messages.extend(self.history[max(0, start - older_count):stop - older_count])
+        return messages
+
+    def _get_older_stats(self) -> Dict[str, int]:
+        """Cuenta los mensajes que siguen en disco paginando el log; se ejecuta en un hilo."""
+        with self._older_lock:
+            if self._older_stats is not None:
+                return self._older_stats
+            stats = {"total": 0, "user": 0, "assistant": 0}
+            index = self._build_older_index()
+            older_count = len(index)
+            page = 1000
+            for start in range(0, older_count, page):
+                for line in self._read_older_lines(start, min(start + page, older_count)):
+                    try:
+                        record = _loads(line)
+                    except ValueError:
+                        continue
+                    # Las vueltas de tools (contenido estructurado) no cuentan como mensajes
+                    if isinstance(record.get('content'), list):
+                        continue
+                    stats["total"] += 1
+                    if record.get('role') in ("user", "assistant"):
+                        stats[record['role']] += 1
+            if self._older_index is index:
+                self._older_stats = stats
+            return stats
+
+    async def compact(self):
+        """
+        Reescribe el log de forma atómica (archivo temporal + os.replace) en el hilo de escritura.
+        Las líneas anteriores a la ventana en memoria se copian tal cual del archivo original.
+        """
+        if self.session_file is None:
+            return
+        path, prefix_bytes, messages = self.session_file, self._prefix_bytes, list(self.history)
+        self._persisted_count = len(messages)
+        self._needs_compaction = False
+        await writer.replace(path, lambda f: _write_log(f, path, prefix_bytes, messages), self._write_failed)
+
+    async def save(self):
+        """
+        Persiste sólo los mensajes nuevos desde el último guardado, así el coste por turno no
+        depende del tamaño del historial. Si el historial se reescribió (p.ej. /clear) se compacta.
+        Sólo encola la escritura: serializar y escribir lo hace el hilo de `writer`.
+        """
+        if self.session_file is None:
+            return
+        try:
+            with tracing.span("session.save", "io", session=self.session_id) as info:
+                if self._summary_dirty:
+                    await self._save_summary()
+                if self._needs_compaction or self._persisted_count > len(self.history):
+                    info["compacted"] = True
+                    await self.compact()
+                    return
+                if self._log_too_large():
+                    info["compacted"] = True
+                    self._compact_old_tool_outputs()
+                    await self.compact()
+                    return
+
+                pending = self.history[self._persisted_count:]
+                if not pending:
+                    return
+
+                # Un único write por turno (o por varios turnos, si se acumulan en la cola)
+                self._persisted_count += len(pending)
+                info["messages"] = len(pending)
+                await writer.append(self.session_file,
+                                    lambda: b''.join(_message_to_record(msg) + b'\n' for msg in pending),
+                                    self._write_failed)
+        except Exception as e:
+            logger.error(f"Failed to save session {self.session_id}: {e}")
+
+    def _log_too_large(self) -> bool:
+        if not self.compact_log_bytes or not self.tool_output_turns or not compacted_tool_output_chars:
+            return False
+        try:
+            size = self.session_file.stat().st_size
+        except OSError:
+            return False
+        # Se exige que el log se haya duplicado desde la última vez: el coste de reescribirlo,
+        # repartido entre los mensajes añadidos, queda constante
+        if size <= max(self.compact_log_bytes, 2 * self._compacted_log_bytes):
+            return False
+        self._compacted_log_bytes = size
+        return True
+
+    def _compact_old_tool_outputs(self):
+        """
+        Recorta en memoria las salidas de tools de los turnos anteriores a los últimos
+        2 * tool_output_turns, que _select_turns ya envía recortadas con el mismo límite: el
+        contexto (y el prefijo que cachea la API) no cambia. Las líneas anteriores a la ventana en
+        memoria se copian tal cual al compactar.
+        """
+        starts = [i for i, m in enumerate(self.history) if m.role == "user" and not _is_tool_result(m)]
+        keep = 2 * self.tool_output_turns
+        if len(starts) <= keep:
+            return
+        for i in range(starts[-keep]):
+            msg = self.history[i]
+            if _is_tool_result(msg):
+                self.history[i] = _compacted_tool_message(msg, compacted_tool_output_chars)
+
+    def _write_failed(self, error: Exception):
+        # El hilo de escritura ya lo registró. No se sabe qué llegó al disco: el próximo guardado
+        # reescribe el log entero
+        self._needs_compaction = True
+
+    # ----- Conversación -----
+
+    def prepare_messages_for_api(self) -> List[Dict[str, Any]]:
+        """
+        Llena la ventana de contexto desde el turno más reciente hacia atrás hasta agotar
+        context_token_budget. Se recorta por turnos completos (mensaje del usuario + respuestas),
+        así un tool_use nunca queda separado de su tool_result y la conversación siempre empieza
+        por el usuario. El turno actual se incluye siempre aunque exceda el presupuesto.
+        Los tool_result de los turnos antiguos se envían recortados (ver tool_output_turns).
+        """
+        selected, used = self._select_turns()
+
+        self.last_turn_usage.clear()
+        self.last_turn_usage.update({
+            "context_messages": len(selected),
+            "context_tokens_estimate": used,
+            "input_tokens": 0,
+            "output_tokens": 0,
+            "cache_read_tokens": 0,
+            "cache_creation_tokens": 0,
+            "requests": 0,
+        })
+
+        # Un mensaje vacío (respuesta final sin texto tras usar tools) no se puede enviar
+        return [{"role": msg.role, "content": msg.content} for msg in selected if msg.content]
+
+    def _select_turns(self) -> Tuple[List[ChatMessage], int]:
+        """
+        Mensajes que entran en el contexto (un sufijo de history) y sus tokens estimados,
+        contando el resumen de los anteriores si lo hay.
+        """
+        candidates = [m for m in self.history if m.role in ["user", "assistant"]]
+        if self.max_context_messages:
+            candidates = candidates[-self.max_context_messages:]
+
+        turns: List[List[ChatMessage]] = []
+        for msg in candidates:
+            if msg.role == "user" and not _is_tool_result(msg):
+                turns.append([msg])
+            elif turns:
+                turns[-1].append(msg)
+
+        # La frontera de recorte avanza de tool_output_turns en tool_output_turns turnos, así el
+        # prefijo que cachea la API no cambia en cada turno
+        keep = self.tool_output_turns
+        compact_until = (len(turns) - keep) // keep * keep if keep and compacted_tool_output_chars else 0
+        for i in range(max(0, compact_until)):
+            turns[i] = [_compacted_tool_message(m, compacted_tool_output_chars) if _is_tool_result(m) else m
+                        for m in turns[i]]
+
+        selected: List[ChatMessage] = []
+        used = len(self.summary_prompt()) // CHARS_PER_TOKEN if self.summary else 0
+        for turn in reversed(turns):
+            cost = sum(estimate_tokens(m) for m in turn)
+            if selected and used + cost > self.context_token_budget:
                 break
-            
-            if current_tool_calls:
-                all_tool_calls.extend(current_tool_calls)
-                yield "\n\nExecuting tools...\n"
-                
-                tool_results = await handle_tool_calls(final_message)
-                
-                if tool_results:
-                    current_messages.append({
-                        "role": "assistant", 
-                        "content": final_message.content
-                    })
-                    
-                    current_messages.append({
-                        "role": "user", 
-                        "content": tool_results
-                    })
-                    
-                    continue
+            selected[:0] = turn
+            used += cost
+        return selected, used
+
+    # ----- Resumen de los turnos fuera de contexto -----
+
+    def _summary_file(self) -> Path:
+        return self.session_file.with_suffix(".summary.json")
+
+    async def _load_summary(self):
+        path = self._summary_file()
+        try:
+            data = await asyncio.to_thread(lambda: _loads(path.read_bytes()) if path.exists() else None)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable summary of session {self.session_id}: {e}")
+            return
+        if data:
+            self.summary = data.get("summary") or ""
+            self.summary_covered = int(data.get("covered") or 0)
+
+    async def _save_summary(self):
+        """Escribe el resumen de forma atómica junto al log de la sesión."""
+        data = {
+            "summary": self.summary,
+            "covered": self.summary_covered,
+            "updated": datetime.now().isoformat(),
+        }
+        self._summary_dirty = False
+        await writer.replace(self._summary_file(), lambda f: f.write(_dumps(data)))
+
+    def summary_prompt(self) -> str:
+        """System prompt con el resumen de la conversación anterior a la ventana de contexto."""
+        if not self.summary:
+            return ""
+        return ("Summary of the earlier part of this conversation (those messages are no longer "
+                f"included):\n{self.summary}")
+
+    def _schedule_summary(self):
+        if not self.summarize or client is None:
+            return
+        if self._summary_task is not None and not self._summary_task.done():
+            return
+        self._summary_task = asyncio.create_task(self._update_summary(), name=f"summary-{self.session_id}")
+
+    async def _update_summary(self):
+        """
+        Pliega en el resumen los mensajes que ya no entran en el contexto. Corre en segundo plano
+        después de cada turno, así que nunca retrasa una respuesta; el turno siguiente usa el
+        resumen que haya en ese momento.
+        """
+        generation = self._summary_generation
+        selected, _ = self._select_turns()
+        # Índice absoluto (en el log completo) del primer mensaje que sigue en contexto. Indexar
+        # y leer la parte del log que no está en memoria se hace en un hilo
+        older_count = len(await asyncio.to_thread(self._build_older_index))
+        target = older_count + len(self.history) - len(selected)
+        start = max(self.summary_covered, target - SUMMARY_MAX_BACKFILL)
+        if start >= target:
+            return
+
+        messages = await asyncio.to_thread(self.get_messages, start, target)
+        pos = 0
+        try:
+            while pos < len(messages):
+                chunk, size = [], 0
+                while pos < len(messages) and size < SUMMARY_CHUNK_CHARS:
+                    text = _transcript([messages[pos]])
+                    if text:
+                        chunk.append(text)
+                        size += len(text)
+                    pos += 1
+                if chunk:
+                    with tracing.span("chat.summarize", "chat", session=self.session_id, chars=size):
+                        summary = await _summarize(self.summary, "\n".join(chunk))
+                    # /clear durante la llamada: el resumen es de una conversación que ya no existe
+                    if generation != self._summary_generation:
+                        return
+                    if summary:
+                        self.summary = summary
+                self.summary_covered = start + pos
+                self._summary_dirty = True
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Failed to summarize session {self.session_id}: {e}")
+        if self._summary_dirty and generation == self._summary_generation:
+            await self.save()
+
+    async def _stop_summary(self):
+        task = self._summary_task
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def add_context_note(self, note: str):
+        self.pending_notes.append(note)
+
+    async def send_message_stream(self, user_input: str):
+        async with self._turn_lock:
+            turn = self._run_turn(user_input)
+            try:
+                async for chunk in turn:
+                    yield chunk
+            finally:
+                # Si el consumidor cierra el generador a mitad del turno (/cancel), el turno se
+                # cierra ya (stream, tools en vuelo, historial) y no cuando lo recoja el GC
+                await turn.aclose()
+
+    async def _run_turn(self, user_input: str):
+        from anthropic._exceptions import APIError, APIStatusError, RateLimitError, APIConnectionError
+
+        if self.pending_notes:
+            notes = "\n".join(f"[{n}]" for n in self.pending_notes)
+            self.pending_notes.clear()
+            user_input = f"{notes}\n\n{user_input}"
+
+        user_msg = ChatMessage(
+            role="user",
+            content=user_input,
+            timestamp=datetime.now()
+        )
+        self.history.append(user_msg)
+        usage_totals = self.last_turn_usage
+        self.last_error = None
+        self.last_ttft = None
+        turn_start = time.perf_counter()
+        # Llamadas a tools lanzadas durante el stream de la petición en curso
+        speculative: Dict[str, tuple] = {}
+        request_text = ""
+        answered = False
+
+        try:
+            messages = self.prepare_messages_for_api()
+            # Fijo durante todo el turno aunque el resumidor termine mientras tanto (caché de prompt)
+            system_prompt = self.summary_prompt()
+            # Sólo se envían las tools relevantes para el mensaje y las usadas hace poco; las que el
+            # modelo use o encuentre con client__search_tools se suman en las vueltas siguientes
+            recent_tools = self._recent_tool_names()
+            requested_tools = set()
+            tools = self._select_tools(user_input, recent_tools)
+
+            assistant_content = ""
+            all_tool_calls = []
+            current_messages = messages
+            # Último mensaje del historial previo al turno actual: prefijo estable entre turnos
+            stable_prefix_index = len(messages) - 2
+
+            while True:
+                kwargs = {
+                    "model": MODEL,
+                    "max_tokens": MAX_TOKENS,
+                    "messages": current_messages
+                }
+
+                if system_prompt:
+                    kwargs["system"] = system_prompt
+
+                if tools:
+                    kwargs["tools"] = tools
+
+                if self.prompt_caching:
+                    kwargs["messages"] = _with_cache_breakpoints(
+                        current_messages, [stable_prefix_index, len(current_messages) - 1]
+                    )
+                    if tools:
+                        kwargs["tools"] = _tools_with_cache_breakpoint(tools, self.hub)
+
+                # Si la petición falla se reintenta desde este mismo punto del loop de tools:
+                # current_messages ya contiene los tool_result anteriores
+                attempt = 0
+                estimated = _estimate_request_tokens(current_messages, tools)
+                estimated += len(system_prompt) // CHARS_PER_TOKEN
+                while True:
+                    current_tool_calls = []
+                    request_text = ""
+                    headers = None
+                    _discard_speculative(speculative)
+                    queued_at = time.perf_counter()
+                    await scheduler.acquire(estimated)
+                    request_start = time.perf_counter()
+                    if request_start - queued_at > 0.001:
+                        tracing.record("api.queue", queued_at, request_start, "api")
+                    first_token = None
+                    try:
+                        async with client.messages.stream(**kwargs) as stream:
+                            headers = stream.response.headers
+                            async for chunk in stream:
+                                if first_token is None and chunk.type == "content_block_delta":
+                                    first_token = time.perf_counter()
+                                    tracing.record("api.ttft", request_start, first_token, "api",
+                                                   session=self.session_id)
+                                if chunk.type == "content_block_delta":
+                                    if chunk.delta.type == "text_delta":
+                                        text_chunk = chunk.delta.text
+                                        request_text += text_chunk
+                                        if self.last_ttft is None:
+                                            self.last_ttft = time.perf_counter() - turn_start
+                                        yield text_chunk
+                                elif chunk.type == "content_block_start":
+                                    if chunk.content_block.type == "tool_use":
+                                        current_tool_calls.append({
+                                            "id": chunk.content_block.id,
+                                            "name": chunk.content_block.name,
+                                            "input": chunk.content_block.input
+                                        })
+                                elif chunk.type == "content_block_stop" and self.hub.speculative_tools:
+                                    # El evento trae el bloque acumulado: con el input ya completo,
+                                    # la tool corre mientras el modelo sigue generando
+                                    _speculate(getattr(chunk, "content_block", None), speculative, self.hub,
+                                               self.session_id)
+
+                            final_message = await stream.get_final_message()
+                        tracing.record("api.stream", request_start, time.perf_counter(), "api",
+                                       session=self.session_id, attempt=attempt + 1,
+                                       stop_reason=final_message.stop_reason)
+                        break
+                    except (APIStatusError, APIConnectionError) as e:
+                        tracing.record("api.stream", request_start, time.perf_counter(), "api",
+                                       session=self.session_id, attempt=attempt + 1,
+                                       error=type(e).__name__)
+                        if isinstance(e, APIStatusError):
+                            headers = e.response.headers
+                        if request_text:
+                            # El texto de este intento ya llegó a la interfaz y no se puede retirar:
+                            # un reintento mostraría la respuesta parcial seguida de la completa.
+                            # Sólo se reintenta antes del primer trozo de texto
+                            raise
+                        attempt += 1
+                        delay = scheduler.retry_delay(e, attempt)
+                        if delay is None:
+                            raise
+                        logger.warning(f"[{self.session_id}] Request failed ({e}); retry {attempt} in {delay:.1f}s")
+                        yield f"\n[{e.__class__.__name__}, retrying in {delay:.1f}s...]\n"
+                        await asyncio.sleep(delay)
+                    finally:
+                        scheduler.release(estimated, headers)
+                # El texto de un intento fallido no se guarda en el historial
+                assistant_content = request_text
+
+                usage = getattr(final_message, "usage", None)
+                if usage is not None:
+                    usage_totals["input_tokens"] += usage.input_tokens or 0
+                    usage_totals["output_tokens"] += usage.output_tokens or 0
+                    usage_totals["cache_read_tokens"] += getattr(usage, "cache_read_input_tokens", 0) or 0
+                    usage_totals["cache_creation_tokens"] += (
+                        getattr(usage, "cache_creation_input_tokens", 0) or 0
+                    )
+                usage_totals["requests"] = usage_totals.get("requests", 0) + 1
+                logger.info(f"[{self.session_id}] Request used {getattr(usage, 'input_tokens', '?')} input tokens "
+                            f"(context estimate {usage_totals.get('context_tokens_estimate')})")
+
+                if final_message.stop_reason != "tool_use":
+                    break
+
+                if current_tool_calls:
+                    # Los argumentos completos sólo están en el mensaje final (llegan por deltas)
+                    all_tool_calls.extend({"id": b.id, "name": b.name, "input": b.input}
+                                          for b in final_message.content if b.type == "tool_use")
+                    yield "\n\nExecuting tools...\n"
+
+                    with tracing.span("tools.batch", "tools", count=len(current_tool_calls),
+                                      speculative=len(speculative)):
+                        tool_results = await handle_tool_calls(final_message, self.hub, speculative, self.session_id)
+
+                    for block in final_message.content:
+                        if block.type != "tool_use":
+                            continue
+                        requested_tools.add(block.name)
+                        if block.name == SEARCH_TOOL_NAME:
+                            requested_tools.update(self.hub.search_tools((block.input or {}).get("query", "")))
+                    tools = self._select_tools(user_input, recent_tools, requested_tools)
+
+                    if tool_results:
+                        # La vuelta completa queda en el historial: en los turnos siguientes el
+                        # modelo ve las salidas de las tools y no necesita volver a llamarlas
+                        now = datetime.now()
+                        round_messages = [
+                            ChatMessage(role="assistant", timestamp=now, content=[
+                                _block_to_dict(b) for b in final_message.content
+                                if not (b.type == "text" and not b.text)
+                            ]),
+                            ChatMessage(role="user", content=tool_results, timestamp=now),
+                        ]
+                        self.history.extend(round_messages)
+                        current_messages.extend({"role": m.role, "content": m.content} for m in round_messages)
+
+                        continue
+                    else:
+                        break
                 else:
                     break
-            else:
-                break
-        
-        assistant_msg = ChatMessage(
-            role="assistant",
-            content=assistant_content,
-            timestamp=datetime.now(),
-            tool_calls=all_tool_calls if all_tool_calls else None
-        )
-        conversation_history.append(assistant_msg)
-        
-        await save_session()
-        
-    except RateLimitError as e:
-        yield f"\nRate limit exceeded. Please wait a moment and try again."
-    except APIConnectionError as e:
-        yield f"\nConnection error: {e}"
-    except APIError as e:
-        yield f"\nAPI error: {e}"
-    except Exception as e:
-        logger.error(f"Error sending message: {e}")
-        yield f"\nUnexpected error: {e}"
+
+            assistant_msg = ChatMessage(
+                role="assistant",
+                content=assistant_content,
+                timestamp=datetime.now(),
+                tool_calls=all_tool_calls if all_tool_calls else None
+            )
+            self.history.append(assistant_msg)
+            answered = True
+
+            await self.save()
+            self._schedule_summary()
+
+        except (asyncio.CancelledError, GeneratorExit):
+            # /cancel: la task se canceló esperando al stream o a las tools, o se cerró el generador
+            # con aclose(). Cerrar el stream y cancelar las tools en vuelo lo hacen los context
+            # managers y gather; aquí sólo se deja constancia en el historial para que el siguiente
+            # turno no empiece con una pregunta sin respuesta
+            self.last_error = asyncio.CancelledError("turn cancelled")
+            if not answered:
+                self.history.append(ChatMessage(
+                    role="assistant",
+                    content=(request_text + "\n\n" if request_text else "") + "[Cancelled by the user]",
+                    timestamp=datetime.now()
+                ))
+            try:
+                await self.save()
+            except BaseException:
+                pass
+            raise
+        except RateLimitError as e:
+            self.last_error = e
+            yield f"\nRate limit exceeded. Please wait a moment and try again."
+        except APIConnectionError as e:
+            self.last_error = e
+            yield f"\nConnection error: {e}"
+        except APIError as e:
+            self.last_error = e
+            yield f"\nAPI error: {e}"
+        except Exception as e:
+            self.last_error = e
+            logger.error(f"Error sending message: {e}")
+            yield f"\nUnexpected error: {e}"
+        finally:
+            _discard_speculative(speculative)
+            tracing.record("chat.turn", turn_start, time.perf_counter(), "chat", session=self.session_id,
+                           error=type(self.last_error).__name__ if self.last_error else None)
+
+    def _select_tools(self, query: str, recent=(), extra=()) -> List[Dict[str, Any]]:
+        """
+        Tools de una petición. Las tools van al principio del prefijo que cachea la API: con
+        prompt_caching un subconjunto distinto en cada mensaje invalidaría toda la caché, así que
+        el set de la sesión sólo crece y se envía siempre en el orden del catálogo. Se pierde algo
+        de recorte a cambio de que el prefijo cambie sólo cuando entra una tool nueva.
+        """
+        tools = self.hub.select_tools(query, recent, extra)
+        if not self.prompt_caching:
+            return tools
+        self._sent_tools.update(t["name"] for t in tools)
+        stable = [t for t in self.hub.get_all_tools_for_anthropic() if t["name"] in self._sent_tools]
+        if SEARCH_TOOL_NAME in self._sent_tools:
+            stable.append(SEARCH_TOOL)
+        return stable
+
+    def _recent_tool_names(self) -> set:
+        """Tools usadas en los últimos turnos (recent_turns del selector) de esta conversación."""
+        names = set()
+        turns = 0
+        for msg in reversed(self.history):
+            if msg.role == "user" and not _is_tool_result(msg):
+                # El primero que aparece es el mensaje del turno actual
+                if turns >= self.hub.tool_selector.recent_turns:
+                    break
+                turns += 1
+            elif msg.role == "assistant":
+                # Resumen del turno (también en sesiones antiguas) y bloques tool_use de cada vuelta
+                names.update(call["name"] for call in msg.tool_calls or ())
+                if isinstance(msg.content, list):
+                    names.update(b["name"] for b in msg.content if isinstance(b, dict) and b.get("type") == "tool_use")
+        return names
+
+    def clear(self):
+        self.history.clear()
+        self._prefix_bytes = 0
+        self._older_index = None
+        self._older_stats = None
+        self._needs_compaction = True
+        self.summary = ""
+        self.summary_covered = 0
+        self._summary_generation += 1
+        self._summary_dirty = self.session_file is not None
+        self._sent_tools.clear()
+
+    async def get_stats(self):
+        # Los mensajes que siguen en disco se cuentan paginando el log en un hilo (una vez, luego
+        # queda en caché)
+        older = await asyncio.to_thread(self._get_older_stats)
+        messages = [m for m in self.history if not isinstance(m.content, list)]
+        user_messages = len([m for m in messages if m.role == "user"])
+        assistant_messages = len([m for m in messages if m.role == "assistant"])
+
+        return {
+            "total": older["total"] + len(messages),
+            "user": older["user"] + user_messages,
+            "assistant": older["assistant"] + assistant_messages,
+            "context_window": self.max_context_messages,
+            "context_budget": self.context_token_budget,
+            "last_context_messages": self.last_turn_usage.get("context_messages", 0),
+            "last_context_tokens": self.last_turn_usage.get("context_tokens_estimate", 0),
+            "last_input_tokens": self.last_turn_usage.get("input_tokens", 0),
+            "last_output_tokens": self.last_turn_usage.get("output_tokens", 0),
+            "prompt_caching": self.prompt_caching,
+            "last_cache_read_tokens": self.last_turn_usage.get("cache_read_tokens", 0),
+            "last_cache_creation_tokens": self.last_turn_usage.get("cache_creation_tokens", 0),
+            "max_parallel_tools": max_parallel_tools,
+            "rate_limit": scheduler.get_stats(),
+            "tool_selection": self.hub.tool_selector.get_stats(),
+            "session_writer": writer.get_stats(),
+            "speculative_tools": dict(speculation_stats, enabled=self.hub.speculative_tools),
+            "summary_covered": self.summary_covered,
+            "summary_tokens": len(self.summary) // CHARS_PER_TOKEN,
+        }
+
+
+# ----- Registro de sesiones -----
+
+default_session = ChatSession("default", session_file, legacy_session_file)
+_open_sessions: Dict[str, ChatSession] = {"default": default_session}
+_SESSION_ID_RE = re.compile(r'^[A-Za-z0-9_.-]{1,128}$')
+
+async def open_session(session_id: str, path: Optional[Path] = None) -> ChatSession:
+    """
+    Devuelve la sesión `session_id`, creándola y cargando su log si no estaba abierta.
+    Por defecto el log vive en sessions_dir/<session_id>.jsonl.
+    """
+    session = _open_sessions.get(session_id)
+    if session is not None:
+        return session
+    if path is None:
+        if not _SESSION_ID_RE.match(session_id) or session_id.startswith('.'):
+            raise ValueError(f"Invalid session id '{session_id}'")
+        path = sessions_dir / f"{session_id}.jsonl"
+    session = ChatSession(session_id, Path(path))
+    _open_sessions[session_id] = session
+    await session.load()
+    return session
+
+
+async def close_session(session_id: str):
+    session = _open_sessions.pop(session_id, None)
+    if session is None:
+        return
+    if session is default_session:
+        _open_sessions[session_id] = session
+        return
+    await session._stop_summary()
+    await session.save()
+    # Si se vuelve a abrir, load() tiene que leer el log ya escrito
+    await writer.flush()
+
+
+def get_open_sessions() -> List[str]:
+    return list(_open_sessions)
+
+
+# ----- Interfaz de módulo: operan sobre la sesión por defecto -----
+
+# Alias al historial de la sesión por defecto (misma lista, se modifica en sitio)
+conversation_history = default_session.history
+last_turn_usage = default_session.last_turn_usage
+
+async def load_session():
+    await default_session.load()
+
+async def compact_session():
+    await default_session.compact()
+
+async def save_session():
+    await default_session.save()
+
+def total_messages() -> int:
+    return default_session.total_messages()
+
+def get_messages(start: int, stop: Optional[int] = None) -> List[ChatMessage]:
+    return default_session.get_messages(start, stop)
+
+def prepare_messages_for_api() -> List[Dict[str, Any]]:
+    return default_session.prepare_messages_for_api()
+
+def add_context_note(note: str):
+    default_session.add_context_note(note)
+
+def send_message_stream(user_input: str):
+    return default_session.send_message_stream(user_input)
 
 def clear_history():
-    global conversation_history
-    conversation_history.clear()
-
-def get_conversation_stats():
-    total_messages = len(conversation_history)
-    user_messages = len([m for m in conversation_history if m.role == "user"])
-    assistant_messages = len([m for m in conversation_history if m.role == "assistant"])
-    
-    return {
-        "total": total_messages,
-        "user": user_messages,
-        "assistant": assistant_messages,
-        "context_window": max_context_messages
-    }
+    default_session.clear()
+
+async def get_conversation_stats():
+    return await default_session.get_stats()
 
 async def cleanup():
-    await mcp_manager.cleanup()
-    await save_session()
+    await hub.cleanup()
+    for session in list(_open_sessions.values()):
+        await session._stop_summary()
+        await session.save()
+    await writer.flush()
+    if tracing.export_path:
+        try:
+            tracing.export_chrome_trace(tracing.export_path)
+        except OSError as e:
+            logger.error(f"Failed to export trace: {e}")
     if client:
         await client.close()
@@ -1,15 +1,23 @@
 import os
+import time
 import asyncio
 import logging
-from pathlib import Path
-from rich.panel import Panel
+from typing import Optional
+
+# Antes de importar Textual y el resto: el span startup.import_main mide cuánto tardan
+_PROCESS_START = time.perf_counter()
+
 # Textual TUI
-from textual.app import App, ComposeResult
-from textual.containers import Horizontal, Vertical, ScrollableContainer
-from textual.widgets import Header, Footer, Input, Static, Button
-import claude_bot
-import mcp_manager
-from dotenv import load_dotenv
+from textual.app import App, ComposeResult  # noqa: E402
+from textual.containers import Horizontal, Vertical, ScrollableContainer  # noqa: E402
+from textual.widgets import Header, Footer, Input, Static, Button  # noqa: E402
+import claude_bot  # noqa: E402
+import mcp_manager  # noqa: E402
+import tracing  # noqa: E402
+from dotenv import load_dotenv  # noqa: E402
+from rich.markup import escape  # noqa: E402
+
+tracing.record("startup.import_main", _PROCESS_START, time.perf_counter(), "startup")
 
 load_dotenv()
 
@@ -87,6 +95,14 @@ BASE = "#24273a"
 TEXT = "#cad3f5"
 RED = "#ed8796"
 
+# Render del transcript: cada mensaje es su propio widget y los chunks en streaming se
+# agrupan y se pintan como mucho una vez por frame
+RENDER_INTERVAL = 1 / 30
+# Vista con ventana: sólo se mantienen montados los últimos MAX_RENDERED_MESSAGES widgets; al
+# llegar arriba del todo se vuelven a montar desde el log de la sesión, de HISTORY_PAGE en HISTORY_PAGE
+MAX_RENDERED_MESSAGES = 200
+HISTORY_PAGE = 50
+
 
 class ChatApp(App):
     CSS = f"""
@@ -122,6 +138,16 @@ class ChatApp(App):
         padding: 1 1;
     }}
 
+    .message {{
+        background: transparent;
+        color: {TEXT};
+        padding: 1 1 0 1;
+    }}
+
+    .assistant-message {{
+        text-align: right;
+    }}
+
     #sidebar {{
         border: round {BLUE};
         background: {MANTLE};
@@ -160,15 +186,33 @@ class ChatApp(App):
     }}
     """
 
-    def __init__(self, api_key: str, mcp_servers: list, max_context: int = 20, **kwargs):
+    def __init__(self, api_key: str, mcp_servers: list, max_context: int = 0,
+                 max_parallel_tools: int = 8, context_budget: int = 8000,
+                 prompt_cache: bool = False, keep_tool_output_turns: int = 4,
+                 summarize: bool = True, **kwargs):
         super().__init__(**kwargs)
         self.api_key = api_key
         self.mcp_servers = mcp_servers
         self.max_context = max_context
-        self._conversation_text = ""  
-        self._sending_task = None
+        self.max_parallel_tools = max_parallel_tools
+        self.context_budget = context_budget
+        self.prompt_cache = prompt_cache
+        self.keep_tool_output_turns = keep_tool_output_turns
+        self.summarize = summarize
+        # Mensajes y subidas en curso (lo que /cancel interrumpe)
+        self._pending_tasks = set()
+        self._startup_task = None
         self._assistant_streaming = False
+        self._stream_widget = None
+        self._stream_text = ""
+        self._stream_parts = []
+        self._flush_timer = None
         self._ascii_visible = True  
+        # Índice (en el log de la sesión) del mensaje más antiguo que se puede ver en el transcript;
+        # lo anterior se monta al hacer scroll hasta arriba. Los widgets de mensajes de la sesión
+        # guardan su índice en session_index
+        self._history_cursor = 0
+        self._loading_history = False
 
     def compose(self) -> ComposeResult:
         yield Header(show_clock=True)
@@ -179,7 +223,7 @@ class ChatApp(App):
                     id="messages",
                 )
                 yield Input(
-                    placeholder="Type a message and press Enter — commands: /help /quit /clear /tools /stats",
+                    placeholder="Type a message and press Enter — commands: /help /quit /clear /tools /stats /perf /upload /cancel",
                     id="input",
                 )
             yield ScrollableContainer(
@@ -188,41 +232,48 @@ class ChatApp(App):
             )
         yield Footer()
     async def _start_mcp(self) -> None:
+        """
+        Arranque en segundo plano, una sola vez: los módulos pesados se importan en un hilo y los
+        servidores MCP conectan sin bloquear la entrada; el sidebar se actualiza con cada estado.
+        """
         try:
-            await claude_bot.initialize(
-                api_key=self.api_key, mcp_servers=self.mcp_servers, max_context=self.max_context
-            )
-            await self._refresh_sidebar()
-        except Exception as e:
-            ...
-        # quitar ASCII después de conectar
-        await self._remove_startup_art_async()
-    
-    async def on_mount(self) -> None:
-        self.set_timer(3.0, lambda: asyncio.create_task(self._start_mcp()))
-        try:
-            await claude_bot.initialize(
-                api_key=self.api_key, mcp_servers=self.mcp_servers, max_context=self.max_context
-            )
+            with tracing.span("startup.preload", "startup"):
+                await asyncio.to_thread(claude_bot.preload)
+            with tracing.span("startup.initialize", "startup"):
+                await claude_bot.initialize(
+                    api_key=self.api_key, mcp_servers=self.mcp_servers, max_context=self.max_context,
+                    max_parallel=self.max_parallel_tools, context_budget=self.context_budget,
+                    enable_prompt_cache=self.prompt_cache, wait_for_servers=False,
+                    keep_tool_output_turns=self.keep_tool_output_turns, summarize=self.summarize,
+                )
         except Exception as e:
             logger.exception("claude_bot.initialize() failed")
             try:
-                sidebar = self.query_one("#sidebar", Static)
-                sidebar.update(f"Error initializing tools: {e}")
+                self.query_one("#sidebar_content", Static).update(f"Error initializing tools: {e}")
             except Exception:
                 pass
+            return
+        # Lo cargado de sesiones anteriores no se pinta al arrancar, pero se puede ver con scroll.
+        # Contar los mensajes construye el índice del log, que recorre la parte antigua: en un hilo
+        self._history_cursor = await asyncio.to_thread(claude_bot.total_messages)
+        await self._refresh_sidebar()
 
-        try:
-            await self._refresh_sidebar()
-        except Exception:
-            logger.exception("Error refreshing sidebar")
+    def _on_server_status(self, name: str, status: str, error) -> None:
+        # Llamado desde mcp_manager en cada cambio de conexión (reconexiones incluidas)
+        self.call_later(self._refresh_sidebar)
 
+    async def on_mount(self) -> None:
+        mcp_manager.subscribe_status(self._on_server_status)
         try:
             input_widget = self.query_one("#input", Input)
             if input_widget is not None:
                 input_widget.focus()
         except Exception:
             logger.exception("Failed to focus the input widget")
+        tracing.record("startup.interactive", _PROCESS_START, time.perf_counter(), "startup")
+
+        self._startup_task = asyncio.create_task(self._start_mcp())
+        self.watch(self.query_one("#messages", ScrollableContainer), "scroll_y", self._on_messages_scroll)
 
         self.set_timer(3.0, lambda: asyncio.create_task(self._remove_startup_art_async()))
 
@@ -245,6 +296,11 @@ class ChatApp(App):
                     lines.append(f" • {name} - {desc}")
         else:
             lines.append("No MCP tools available")
+
+        for server_name, status in mcp_manager.get_server_status().items():
+            if status != "ready":
+                error = mcp_manager.server_errors.get(server_name, "")
+                lines.append(f"[{RED}]{server_name}: {status}[/{RED}] {error}".rstrip())
         content.update("\n".join(lines))
     
         try:
@@ -252,46 +308,151 @@ class ChatApp(App):
         except Exception:
             pass
 
-    async def append_message(self, chunk: str, role: str = "assistant") -> None:
-        inner = self.query_one("#messages_content", Static)
+    async def _mount_message(self, text: str, role: str) -> Static:
+        messages_container = self.query_one("#messages", ScrollableContainer)
+        widget = Static(text, classes=f"message {role}-message")
+        await messages_container.mount(widget)
+
+        # Los mensajes más antiguos se desmontan; siguen en la sesión y vuelven con el scroll
+        rendered = list(messages_container.query(".message"))
+        excess = len(rendered) - MAX_RENDERED_MESSAGES
+        if excess > 0:
+            await messages_container.remove_children(rendered[:excess])
+            indexes = [w.session_index for w in rendered[excess:] if getattr(w, "session_index", None) is not None]
+            self._history_cursor = min(indexes) if indexes else claude_bot.total_messages()
+        return widget
+
+    def _on_messages_scroll(self, scroll_y: float) -> None:
+        if scroll_y <= 0 and self._history_cursor > 0 and not self._loading_history:
+            self._loading_history = True
+            asyncio.create_task(self._load_older_page())
+
+    async def _load_older_page(self) -> None:
+        """Monta encima del transcript la página anterior de mensajes, leída del log de la sesión."""
+        try:
+            stop = self._history_cursor
+            start = max(0, stop - HISTORY_PAGE)
+            messages = await asyncio.to_thread(claude_bot.get_messages, start, stop)
+            widgets = []
+            for index, msg in enumerate(messages, start):
+                # Las vueltas de tools (contenido estructurado) no se pintan, igual que en vivo
+                if not isinstance(msg.content, str) or not msg.content:
+                    continue
+                if msg.role == "user":
+                    text = f"[bold green]You:[/bold green] {escape(msg.content)}"
+                else:
+                    text = f"[bold cyan]LainBot:[/bold cyan] {escape(msg.content)}"
+                widget = Static(text, classes=f"message {msg.role}-message")
+                widget.session_index = index
+                widgets.append(widget)
+
+            container = self.query_one("#messages", ScrollableContainer)
+            rendered = list(container.query(".message"))
+            # Se conserva la distancia al final para que la vista no salte al insertar arriba
+            from_bottom = container.max_scroll_y - container.scroll_y
+            if widgets:
+                await container.mount_all(widgets, before=rendered[0] if rendered else None)
+                self.call_after_refresh(
+                    lambda: container.scroll_to(y=container.max_scroll_y - from_bottom, animate=False))
+            self._history_cursor = start
+        except Exception:
+            logger.exception("Failed to load older messages")
+        finally:
+            self._loading_history = False
+
+    def _flush_stream(self) -> None:
+        self._flush_timer = None
+        if self._stream_widget is None or not self._stream_parts:
+            return
+        with tracing.span("ui.flush", "ui", parts=len(self._stream_parts)):
+            self._stream_text += "".join(self._stream_parts)
+            self._stream_parts.clear()
+            self._stream_widget.update(self._stream_text)
+            self.query_one("#messages", ScrollableContainer).scroll_end(animate=False)
+
+    def _end_assistant_message(self) -> None:
+        if self._flush_timer is not None:
+            self._flush_timer.stop()
+        self._flush_stream()
+        self._stream_widget = None
+        self._stream_text = ""
+        self._assistant_streaming = False
+
+    async def append_message(self, chunk: str, role: str = "assistant") -> Optional[Static]:
+        """Añade un mensaje o un chunk al transcript; devuelve el widget si se creó uno nuevo."""
+        with tracing.span("ui.append_message", "ui", role=role):
+            return await self._append_message(chunk, role)
+
+    async def _append_message(self, chunk: str, role: str) -> Optional[Static]:
         if self._ascii_visible:
-            inner.update("")
+            self.query_one("#messages_content", Static).display = False
             self._ascii_visible = False
 
         if role == "user":
-            self._conversation_text += f"\n[left][bold green]You:[/bold green] {chunk}[/left]\n"
-            self._assistant_streaming = False
+            self._end_assistant_message()
+            widget = await self._mount_message(f"[bold green]You:[/bold green] {chunk}", "user")
+        elif not self._assistant_streaming:
+            self._stream_text = f"[bold cyan]LainBot:[/bold cyan] {chunk}"
+            widget = self._stream_widget = await self._mount_message(self._stream_text, "assistant")
+            self._assistant_streaming = True
         else:
-            if not self._assistant_streaming:
-                self._conversation_text += f"\n[right][bold cyan]LainBot:[/bold cyan] {chunk}[/right]"
-                self._assistant_streaming = True
-            else:
-                self._conversation_text += chunk
+            # Sólo se acumula; el widget se actualiza en el próximo frame
+            self._stream_parts.append(chunk)
+            if self._flush_timer is None:
+                self._flush_timer = self.set_timer(RENDER_INTERVAL, self._flush_stream)
+            return None
 
-        messages_container = self.query_one("#messages", ScrollableContainer)
-        inner.update(self._conversation_text)
         try:
-            await messages_container.scroll_end(animate=False)
+            await self.query_one("#messages", ScrollableContainer).scroll_end(animate=False)
         except Exception:
             pass
+        return widget
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._pending_tasks.add(task)
+        task.add_done_callback(self._pending_tasks.discard)
 
     async def handle_send(self, message: str) -> None:
+        stream = claude_bot.send_message_stream(message)
         try:
-            await self.append_message(message, role="user")
-            async for chunk in claude_bot.send_message_stream(message):
+            user_widget = await self.append_message(message, role="user")
+            # El primer mensaje espera al cliente y la sesión, no a los servidores MCP
+            if self._startup_task is not None and not self._startup_task.done():
+                await asyncio.shield(self._startup_task)
+            async for chunk in stream:
+                if user_widget is not None and not hasattr(user_widget, "session_index"):
+                    # Con el primer chunk el turno ya guardó el mensaje y tiene el lock de la sesión:
+                    # es el último del log
+                    user_widget.session_index = claude_bot.total_messages() - 1
                 await self.append_message(chunk, role="assistant")
-            self._assistant_streaming = False
-            try:
-                await claude_bot.save_session()
-            except Exception:
-                pass
+            self._end_assistant_message()
+        except asyncio.CancelledError:
+            # Si la cancelación llegó mientras se pintaba un trozo, el generador sigue abierto con
+            # el turno a medias: cerrarlo libera el lock de la sesión, el stream y las tools
+            await stream.aclose()
+            await self.append_message("\n[yellow]Cancelled[/yellow]\n", role="assistant")
+            self._end_assistant_message()
         except Exception as e:
             logger.exception("Error while sending message")
             await self.append_message(f"\n[red]Error: {e}[/red]\n")
 
+    async def action_cancel(self) -> None:
+        """Interrumpe la respuesta en curso, sus llamadas a tools y los mensajes en cola."""
+        tasks = [t for t in self._pending_tasks if not t.done()]
+        if not tasks:
+            await self.append_message("Nothing to cancel\n", role="assistant")
+            return
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
     async def action_show_help(self) -> None:
         await self.append_message(
-            "/help: show help. /quit: exit. /clear: clear history. /tools: show MCP tools. /stats: show stats\n",
+            "/help: show help. /quit: exit. /clear: clear history. /tools: show MCP tools. /stats: show stats."
+            " /upload <path>: upload a file to the dataset server."
+            " /cancel: stop the current reply and its tool calls."
+            " /perf [startup|export <file>|reset]: latency summary, startup profile and trace export\n",
             role="assistant",
         )
 
@@ -300,25 +461,118 @@ class ChatApp(App):
         await self.append_message("(Updated MCP tools list on the right)\n", role="assistant")
 
     async def action_show_stats(self) -> None:
-        stats = claude_bot.get_conversation_stats()
+        stats = await claude_bot.get_conversation_stats()
         text = (
             f"Total messages: {stats['total']}\n"
             f"User messages: {stats['user']}\n"
             f"Assistant messages: {stats['assistant']}\n"
-            f"Context window: {stats['context_window']} messages\n"
+            f"Context budget: {stats['context_budget']} tokens"
+            f" (message cap: {stats['context_window'] or 'none'})\n"
+            f"Last context: {stats['last_context_messages']} messages,"
+            f" ~{stats['last_context_tokens']} tokens\n"
+            f"Last turn usage: {stats['last_input_tokens']} input /"
+            f" {stats['last_output_tokens']} output tokens\n"
+        )
+        cache = mcp_manager.get_result_cache_stats()
+        text += (
+            f"Tool result cache: {cache['hits']} hits / {cache['misses']} misses,"
+            f" {cache['entries']} entries ({cache['bytes']} bytes)\n"
+        )
+        calls = mcp_manager.get_call_stats()
+        text += f"Tool calls: {calls['timeouts']} timed out, {calls['cancelled']} cancelled\n"
+        limits = stats["rate_limit"]
+        text += (
+            f"Rate limiter: {limits['requests']} requests, {limits['delayed']} delayed"
+            f" ({limits['delay_s']}s), {limits['retries']} retries"
+            f" ({limits['rate_limited']} rate limited)\n"
+        )
+        selection = stats["tool_selection"]
+        text += (
+            f"Tool selection: {selection['avg_tools_sent']} of {selection['avg_tools_total']} tools"
+            f" per request, {selection['searches']} searches\n"
         )
+        speculative = stats["speculative_tools"]
+        if speculative["enabled"]:
+            text += (
+                f"Speculative tools: {speculative['used']} of {speculative['started']} early calls used,"
+                f" {speculative['discarded']} discarded\n"
+            )
+        saves = stats["session_writer"]
+        text += (
+            f"Session writer: {saves['writes']} writes for {saves['ops']} saves"
+            f" ({saves['coalesced']} coalesced, {saves['pending']} pending)\n"
+        )
+        if stats["summary_covered"]:
+            text += (
+                f"Summary: {stats['summary_covered']} earlier messages in"
+                f" ~{stats['summary_tokens']} tokens\n"
+            )
+        if stats["prompt_caching"]:
+            text += (
+                f"Prompt cache: {stats['last_cache_read_tokens']} read /"
+                f" {stats['last_cache_creation_tokens']} created tokens\n"
+            )
         await self.append_message(text, role="assistant")
 
+    async def action_show_perf(self, args: str = "") -> None:
+        parts = args.split(maxsplit=1)
+        if parts and parts[0] == "export":
+            path = parts[1] if len(parts) > 1 else (tracing.export_path or "trace.json")
+            try:
+                count = await asyncio.to_thread(tracing.export_chrome_trace, path)
+            except OSError as e:
+                await self.append_message(f"[red]Trace export failed: {e}[/red]\n", role="assistant")
+                return
+            await self.append_message(
+                f"Wrote {count} spans to {path} (open in chrome://tracing or ui.perfetto.dev)\n",
+                role="assistant",
+            )
+            return
+        if parts and parts[0] == "startup":
+            lines = [f"{'phase':<28}{'start ms':>10}{'dur ms':>10}"]
+            for event in tracing.events(prefixes=("startup.", "mcp.connect.")):
+                start_ms = event["ts"] / 1000 - (_PROCESS_START - tracing.ORIGIN) * 1000
+                lines.append(f"{event['name'][:27]:<28}{start_ms:>10.1f}{event['dur'] / 1000:>10.1f}")
+            await self.append_message("\n".join(lines) + "\n", role="assistant")
+            return
+        if parts and parts[0] == "reset":
+            tracing.reset()
+            await self.append_message("Perf counters reset\n", role="assistant")
+            return
+
+        rows = tracing.summary()
+        if not rows:
+            await self.append_message("No spans recorded yet\n", role="assistant")
+            return
+        lines = [f"{'span':<28}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"]
+        for name, row in rows.items():
+            lines.append(
+                f"{name[:27]:<28}{row['count']:>7}{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}"
+                f"{row['p99_ms']:>10.1f}{row['max_ms']:>10.1f}"
+            )
+        await self.append_message("\n".join(lines) + "\n", role="assistant")
+
+    async def action_upload(self, path: str) -> None:
+        await self.append_message(f"Uploading {path}...\n", role="assistant")
+        try:
+            result = await mcp_manager.upload_file(path)
+        except Exception as e:
+            await self.append_message(f"[red]Upload failed: {e}[/red]\n", role="assistant")
+            return
+        summary = " ".join(b.get("text", "") for b in result if b.get("type") == "text").strip()
+        # El modelo sólo ve el resultado (ID del dataset), nunca el contenido del archivo
+        claude_bot.add_context_note(f"El usuario subió el archivo {path}. Resultado: {summary}")
+        await self.append_message(f"Uploaded {path}: {summary}\n", role="assistant")
+
     async def action_clear(self) -> None:
         claude_bot.clear_history()
         try:
             await claude_bot.save_session()
         except Exception:
             pass
-        self._conversation_text = ""
-        inner = self.query_one("#messages_content", Static)
-        inner.update(self._conversation_text)
-        self._assistant_streaming = False
+        self._end_assistant_message()
+        await self.query_one("#messages", ScrollableContainer).query(".message").remove()
+        self._history_cursor = 0
 
     async def on_input_submitted(self, event: Input.Submitted) -> None:
         text = event.value.strip()
@@ -338,21 +592,34 @@ class ChatApp(App):
                 await self.action_show_tools()
             elif cmd == "/stats":
                 await self.action_show_stats()
+            elif cmd == "/cancel":
+                await self.action_cancel()
+            elif cmd.split(maxsplit=1)[0] == "/perf":
+                parts = text.split(maxsplit=1)
+                await self.action_show_perf(parts[1].strip() if len(parts) > 1 else "")
+            elif cmd.split(maxsplit=1)[0] == "/upload":
+                parts = text.split(maxsplit=1)
+                if len(parts) < 2:
+                    await self.append_message("Usage: /upload <path>\n", role="assistant")
+                else:
+                    self._spawn(self.action_upload(parts[1].strip()))
             else:
                 await self.append_message(f"Unknown command: {text}\n", role="assistant")
             return
 
-        asyncio.create_task(self.handle_send(text))
+        self._spawn(self.handle_send(text))
 
     async def on_shutdown_request(self) -> None:
+        mcp_manager.unsubscribe_status(self._on_server_status)
+        for task in list(self._pending_tasks):
+            task.cancel()
         try:
             await claude_bot.cleanup()
         except Exception:
             pass
 
     async def _remove_startup_art_async(self) -> None:
-        inner = self.query_one("#messages_content", Static)
-        inner.update(self._conversation_text)
+        self.query_one("#messages_content", Static).display = False
         self._ascii_visible = False
         try:
             messages_container = self.query_one("#messages", ScrollableContainer)
@@ -373,28 +640,17 @@ def main():
         raise SystemExit(1)
 
     config_file = os.getenv("MCP_CONFIG", "mcp_config.json")
-    mcp_servers = []
-    if Path(config_file).exists():
-        import json
-        with open(config_file, "r") as f:
-            cfg = json.load(f)
-        for s in cfg.get("servers", []):
-            mcp_servers.append(
-                mcp_manager.MCPServerConfig(
-                    name=s.get("name"),
-                    command=s.get("command"),
-                    args=s.get("args"),
-                    env=s.get("env"),
-                    url=s.get("url"),
-                    transport=s.get("transport", "stdio"),
-                    description=s.get("description", ""),
-                )
-            )
+    mcp_servers = mcp_manager.load_config(config_file)
 
     app = ChatApp(
         api_key=api_key,
         mcp_servers=mcp_servers,
-        max_context=int(os.getenv("MAX_CONTEXT_MESSAGES", "20"))
+        max_context=int(os.getenv("MAX_CONTEXT_MESSAGES", "0")),
+        max_parallel_tools=int(os.getenv("MAX_PARALLEL_TOOLS", "8")),
+        context_budget=int(os.getenv("CONTEXT_TOKEN_BUDGET", "8000")),
+        prompt_cache=os.getenv("PROMPT_CACHING", "0").lower() in ("1", "true", "yes"),
+        keep_tool_output_turns=int(os.getenv("TOOL_OUTPUT_TURNS", "4")),
+        summarize=os.getenv("CONTEXT_SUMMARY", "1").lower() in ("1", "true", "yes"),
     )
     app.run()
 
@@ -1,12 +1,24 @@
 import os
+import json
+import base64
+import time
+import random
 import asyncio
+import secrets
 import logging
-from typing import List, Dict, Any, Optional
-from dataclasses import dataclass
+from pathlib import Path
+from datetime import timedelta
+from contextlib import AsyncExitStack
+from typing import List, Dict, Any, Optional, Callable, TYPE_CHECKING
+from dataclasses import dataclass, field
+from collections import OrderedDict
 
-from mcp import ClientSession, StdioServerParameters
-from mcp.client.stdio import stdio_client
-from mcp.client.streamable_http import streamablehttp_client
+import tracing
+from tool_selector import ToolSelector, SEARCH_TOOL_NAME
+
+# El SDK de mcp y sus transportes se importan al conectar, no al cargar el módulo (arranque rápido)
+if TYPE_CHECKING:
+    from mcp import ClientSession
 
 logger = logging.getLogger(__name__)
 
@@ -19,264 +31,1150 @@ class MCPServerConfig:
     url: Optional[str] = None
     transport: str = "stdio"
     description: str = ""
+    max_concurrency: int = 4
+    connect_timeout: float = 30.0
+    # Supervisor: reconexión con backoff exponencial + jitter y pings periódicos
+    reconnect: bool = True
+    health_interval: float = 30.0
+    health_timeout: float = 10.0
+    max_backoff: float = 60.0
+    # Tools de sólo lectura cuyos resultados se pueden cachear (por nombre original)
+    cacheable_tools: List[str] = field(default_factory=list)
+    cache_ttl: float = 300.0
+    # Tool que recibe archivos como {"file_bytes": base64, "filename"}; no se expone al modelo,
+    # los archivos se suben desde el cliente con upload_file
+    upload_tool: Optional[str] = None
+    # streamable-http: sesiones abiertas en paralelo contra el servidor, cada una con su cliente
+    # HTTP keep-alive; cada llamada va a la menos ocupada. http2 requiere el paquete h2
+    pool_size: int = 1
+    http2: bool = False
+    # Tope en segundos de cada call_tool (None = el tool_timeout global) y topes por tool
+    # (nombre original -> segundos), que tienen prioridad
+    request_timeout: Optional[float] = None
+    tool_timeouts: Dict[str, float] = field(default_factory=dict)
+    # Tools sin efectos secundarios (además de las cacheable_tools) que se pueden ejecutar de forma
+    # especulativa mientras el modelo sigue generando la respuesta (ver MCPHub.speculative_tools)
+    read_only_tools: List[str] = field(default_factory=list)
+
+ANTHROPIC_IMAGE_TYPES = ("image/jpeg", "image/png", "image/gif", "image/webp")
+MAX_STORED_RESULTS = 32
+UPLOAD_READ_CHUNK = 3 * 256 * 1024  # múltiplo de 3: los trozos en base64 se concatenan sin padding
+# Las conexiones HTTP ociosas se mantienen más que el intervalo de health check (httpx usa 5s),
+# así las llamadas esporádicas no pagan otra vez el handshake TCP/TLS
+HTTP_KEEPALIVE_EXPIRY = 120.0
+# Tools que resuelve el propio cliente, expuestas con el prefijo de este pseudo-servidor
+LOCAL_SERVER = "client"
+LOCAL_TOOLS: List[Dict[str, Any]] = [
+    {
+        "name": f"{LOCAL_SERVER}__upload_file",
+        "description": ("[client] Sube un archivo local (p.ej. un Excel) al servidor de datasets "
+                        "y devuelve el ID del dataset. Sólo recibe la ruta, nunca el contenido, y "
+                        "sólo acepta archivos dentro de la carpeta de subidas configurada"),
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "path": {"type": "string", "description": "Ruta del archivo en la máquina del usuario"},
+                "server": {"type": "string", "description": "Servidor destino (opcional)"},
+            },
+            "required": ["path"]
+        }
+    },
+    {
+        "name": f"{LOCAL_SERVER}__fetch_result",
+        "description": "[client] Devuelve la parte omitida de un resultado de tool truncado",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "handle": {"type": "string", "description": "Handle indicado en el aviso de truncado"},
+                "offset": {"type": "integer", "description": "Byte desde el que continuar (por defecto 0)"},
+                "length": {"type": "integer", "description": "Bytes a devolver (opcional)"},
+            },
+            "required": ["handle"]
+        }
+    }
+]
+
+# Schemas que reemplazan el inputSchema publicado por el servidor estadístico (por nombre de tool)
+SCHEMAS_OVERRIDE: Dict[str, Dict[str, Any]] = {
+    "list_datasets": {"type": "object", "properties": {}, "required": []},
+    "describe": {
+        "type": "object",
+        "properties": {
+            "dataset_id": {"type": "string", "description": "ID del dataset a describir"},
+            "sheet_name": {"type": "string", "description": "Nombre de la hoja (opcional)"}
+        },
+        "required": ["dataset_id"]
+    },
+    "proportion": {
+        "type": "object",
+        "properties": {
+            "dataset_id": {"type": "string"},
+            "sheet_name": {"type": "string"},
+            "numerator_filter": {"type": "string"},
+            "denominator_filter": {"type": "string"}
+        },
+        "required": ["dataset_id", "sheet_name", "numerator_filter", "denominator_filter"]
+    },
+    "odds_ratio_rr": {
+        "type": "object",
+        "properties": {
+            "dataset_id": {"type": "string"},
+            "sheet_name": {"type": "string"},
+            "exposure_col": {"type": "string"},
+            "outcome_col": {"type": "string"},
+            "exposure_val": {"type": "string"},
+            "outcome_val": {"type": "string"}
+        },
+        "required": ["dataset_id", "sheet_name", "exposure_col", "outcome_col", "exposure_val", "outcome_val"]
+    },
+    "chi_square": {
+        "type": "object",
+        "properties": {
+            "dataset_id": {"type": "string"},
+            "sheet_name": {"type": "string"},
+            "col1": {"type": "string"},
+            "col2": {"type": "string"},
+            "correction": {"type": "boolean"}
+        },
+        "required": ["dataset_id", "sheet_name", "col1", "col2"]
+    },
+    "ttest": {
+        "type": "object",
+        "properties": {
+            "dataset_id": {"type": "string"},
+            "sheet_name": {"type": "string"},
+            "group_col": {"type": "string"},
+            "value_col": {"type": "string"},
+            "group1": {"type": "string"},
+            "group2": {"type": "string"}
+        },
+        "required": ["dataset_id", "sheet_name", "group_col", "value_col", "group1", "group2"]
+    },
+    "plot": {
+        "type": "object",
+        "properties": {
+            "dataset_id": {"type": "string"},
+            "sheet_name": {"type": "string"},
+            "kind": {"type": "string", "description": "Tipo de gráfico: hist, scatter, etc."},
+            "x": {"type": "string"},
+            "y": {"type": "string"},
+            "options": {"type": "object"}
+        },
+        "required": ["dataset_id", "sheet_name", "kind"]
+    },
+    "debug_info": {"type": "object", "properties": {}, "required": []}
+}
 
-# Estado global
-sessions: Dict[str, ClientSession] = {}
-available_tools: Dict[str, List] = {}
-_server_tasks: Dict[str, asyncio.Task] = {}
 
-# ----- Helpers: tasks que mantienen la conexión dentro del mismo task -----
+# ----- Helpers sin estado -----
 
-async def _stdio_server_task(cfg: MCPServerConfig):
-    name = cfg.name
-    env = os.environ.copy()
-    if cfg.env:
-        env.update(cfg.env)
+async def _health_loop(cfg: MCPServerConfig, *sessions: "ClientSession"):
+    """Mantiene vivas las conexiones; un ping fallido sale con excepción para que se reconecte."""
+    if not cfg.health_interval:
+        await asyncio.Event().wait()
+    while True:
+        await asyncio.sleep(cfg.health_interval)
+        try:
+            await asyncio.gather(*(asyncio.wait_for(s.send_ping(), cfg.health_timeout) for s in sessions))
+        except asyncio.TimeoutError:
+            raise ConnectionError(f"health check timed out after {cfg.health_timeout:.1f}s")
 
-    server_params = StdioServerParameters(
-        command=cfg.command,
-        args=cfg.args or [],
-        env=env
-    )
 
-    try:
-        # El 'async with' se ejecuta y se cierra dentro de este mismo task
-        async with stdio_client(server_params) as (read_stream, write_stream):
-            async with ClientSession(read_stream, write_stream) as session:
-                await session.initialize()
-                sessions[name] = session
-
-                try:
-                    tools_resp = await session.list_tools()
-                    available_tools[name] = tools_resp.tools
-                except Exception:
-                    logger.exception("list_tools failed for %s", name)
-                    available_tools[name] = []
-
-                logger.info("Connected to stdio MCP server '%s' with %d tools", name, len(available_tools[name]))
-                for t in available_tools[name]:
-                    logger.info("  - %s: %s", t.name, t.description or "")
-
-                # Mantener el task vivo hasta que sea cancelado
-                await asyncio.Event().wait()
-    except asyncio.CancelledError:
-        logger.info("Stdio server task for '%s' cancelled, cleaning up...", name)
-        raise
-    except Exception:
-        logger.exception("Error in stdio server task for '%s'", name)
-    finally:
-        sessions.pop(name, None)
-        available_tools.pop(name, None)
-        logger.info("Stdio server '%s' fully cleaned up", name)
-
-
-async def _streamable_http_server_task(cfg: MCPServerConfig):
-    name = cfg.name
-    url = cfg.url
-    try:
-        # El async with se ejecuta y cierra en este mismo task --> evita problemas con cancel scopes
-        async with streamablehttp_client(url) as (read_stream, write_stream, aclose):
-            async with ClientSession(read_stream, write_stream) as session:
-                await session.initialize()
-                sessions[name] = session
-
-                try:
-                    tools_resp = await session.list_tools()
-                    available_tools[name] = tools_resp.tools
-                except Exception:
-                    logger.exception("list_tools failed for %s", name)
-                    available_tools[name] = []
-
-                logger.info("Connected to streamable-http MCP server '%s' at %s with %d tools",
-                            name, url, len(available_tools[name]))
-                for t in available_tools[name]:
-                    logger.info("  - %s: %s", t.name, t.description or "")
-
-                # Mantener el task vivo hasta que sea cancelado
-                await asyncio.Event().wait()
-    except asyncio.CancelledError:
-        logger.info("Streamable-HTTP task for '%s' cancelled, cleaning up...", name)
-        raise
-    except Exception:
-        logger.exception("Error in streamable-http server task for '%s'", name)
-    finally:
-        sessions.pop(name, None)
-        available_tools.pop(name, None)
-        logger.info("Streamable-HTTP server '%s' fully cleaned up", name)
-
-
-# ----- Interfaz pública -----
-
-async def start_servers(servers_config: List[MCPServerConfig]):
+def _http_client_factory(http2: bool):
+    """Factory de httpx.AsyncClient para streamablehttp_client: keep-alive largo y, si se pide, HTTP/2."""
+    import httpx
+
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logger.warning("http2 requested but the 'h2' package is not installed; using HTTP/1.1")
+            http2 = False
+
+    def factory(headers=None, timeout=None, auth=None):
+        return httpx.AsyncClient(
+            follow_redirects=True,
+            timeout=timeout or httpx.Timeout(30.0),
+            headers=headers,
+            auth=auth,
+            http2=http2,
+            limits=httpx.Limits(keepalive_expiry=HTTP_KEEPALIVE_EXPIRY),
+        )
+    return factory
+
+
+def _backoff_delay(cfg: MCPServerConfig, attempt: int) -> float:
+    # Exponencial con "full jitter" para no reconectar todos los clientes a la vez
+    return random.uniform(0, min(cfg.max_backoff, 2 ** attempt))
+
+
+def _utf8_boundary(data: bytes, pos: int) -> int:
+    """Retrocede `pos` hasta el inicio de un carácter UTF-8 (los bytes 10xxxxxx son de continuación)."""
+    pos = max(0, min(pos, len(data)))
+    while 0 < pos < len(data) and data[pos] & 0xC0 == 0x80:
+        pos -= 1
+    return pos
+
+
+def _truncate_utf8(text: str, limit: int) -> tuple:
+    """Corta `text` a como mucho `limit` bytes UTF-8 sin partir caracteres."""
+    data = text.encode("utf-8")
+    if len(data) <= limit:
+        return text, ""
+    head = data[:_utf8_boundary(data, limit)].decode("utf-8")
+    return head, text[len(head):]
+
+
+def _convert_content_block(block) -> Dict[str, Any]:
+    kind = getattr(block, "type", None)
+    if kind == "text":
+        return {"type": "text", "text": block.text}
+    if kind == "image" and block.mimeType in ANTHROPIC_IMAGE_TYPES:
+        return {
+            "type": "image",
+            "source": {"type": "base64", "media_type": block.mimeType, "data": block.data},
+        }
+    if kind == "resource":
+        resource = block.resource
+        text = getattr(resource, "text", None)
+        if text is not None:
+            return {"type": "text", "text": f"[resource {resource.uri}]\n{text}"}
+        mime = getattr(resource, "mimeType", None)
+        if mime in ANTHROPIC_IMAGE_TYPES:
+            return {
+                "type": "image",
+                "source": {"type": "base64", "media_type": mime, "data": resource.blob},
+            }
+        return {"type": "text", "text": f"[binary resource {resource.uri} ({mime or 'unknown type'}) omitted]"}
+    if kind == "resource_link":
+        return {"type": "text", "text": f"[resource link {block.uri}] {getattr(block, 'name', '')}".rstrip()}
+    mime = getattr(block, "mimeType", None)
+    return {"type": "text", "text": f"[{kind or 'unknown'} content ({mime or 'unknown type'}) omitted]"}
+
+
+def _encode_file(path: Path) -> str:
+    parts = []
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(UPLOAD_READ_CHUNK)
+            if not chunk:
+                break
+            parts.append(base64.b64encode(chunk).decode("ascii"))
+    return "".join(parts)
+
+
+class MCPHub:
     """
-    Inicia un task por servidor. Cada task mantiene la conexión usando 'async with'
-    y por tanto el enter/exit ocurren en el mismo task (evita el error de anyio).
+    Pool de conexiones MCP compartido por todas las conversaciones del proceso. Cada
+    ClientSession admite varias peticiones en vuelo (se multiplexan por id de JSON-RPC),
+    así que muchas ChatSession pueden usar el mismo servidor a la vez; el límite por
+    servidor lo pone max_concurrency.
     """
-    for cfg in servers_config:
+
+    def __init__(self):
+        self.sessions: Dict[str, "ClientSession"] = {}
+        self.available_tools: Dict[str, List] = {}
+        self._server_tasks: Dict[str, asyncio.Task] = {}
+        # Límite de llamadas concurrentes por servidor (configurable con "max_concurrency")
+        self._server_semaphores: Dict[str, asyncio.Semaphore] = {}
+        # Estado de conexión por servidor: connecting | ready | failed | timeout | disconnected | reconnecting
+        self.server_status: Dict[str, str] = {}
+        self.server_errors: Dict[str, str] = {}
+        self._ready_events: Dict[str, asyncio.Event] = {}
+        # Se marca cuando el intento de conexión actual de cada servidor queda listo
+        self._connected_events: Dict[str, asyncio.Event] = {}
+        self._connect_started: Dict[str, float] = {}
+        # Sesiones extra de los servidores streamable-http con pool_size > 1 y llamadas en vuelo
+        # de cada una; sessions[name] es siempre la primera del pool
+        self._session_pools: Dict[str, List["ClientSession"]] = {}
+        self._pool_load: Dict[str, List[int]] = {}
+        # Configuración de cada servidor tal como se pasó a start_servers
+        self._server_configs: Dict[str, MCPServerConfig] = {}
+        # Caché LRU de resultados de tools idempotentes: (server, tool, args canónicos) -> (expira, valor, bytes)
+        self.result_cache_enabled: bool = True
+        self.result_cache_max_bytes: int = 8 * 1024 * 1024
+        self._result_cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._result_cache_bytes: int = 0
+        self._result_cache_stats: Dict[str, int] = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+        # Tope de tamaño del contenido de un tool_result; lo que sobra queda guardado y se puede
+        # pedir con la tool local client__fetch_result
+        self.max_result_bytes: int = 32 * 1024
+        # handle -> (conversación que hizo la llamada, texto). El hub es compartido por todas las
+        # sesiones: los handles son aleatorios y sólo los puede leer la conversación dueña
+        self._stored_results: "OrderedDict[str, tuple]" = OrderedDict()
+        # Callbacks (name, status, error) que se llaman en cada cambio de estado
+        self._status_listeners: List[Callable[[str, str, Optional[str]], None]] = []
+        # Caché de tools convertidas al formato de Anthropic, versionada por servidor
+        self._tools_version: Dict[str, int] = {}
+        self._anthropic_tools_cache: Dict[str, List[Dict[str, Any]]] = {}
+        self._combined_tools_cache: Optional[List[Dict[str, Any]]] = None
+        # Schemas de la última ejecución (tools_cache_file): se anuncian mientras el servidor
+        # conecta y una llamada a una de sus tools espera sólo a ese servidor
+        self.tools_cache_file: Optional[Path] = None
+        self._tools_cache_data: Dict[str, Dict[str, Any]] = {}
+        self._provisional_tools: Dict[str, List[Dict[str, Any]]] = {}
+        # Se dispara (y se reemplaza) en cada cambio de estado de cualquier servidor
+        self._status_changed = asyncio.Event()
+        # Con speculative_tools las llamadas a tools de sólo lectura empiezan en cuanto su bloque
+        # tool_use termina de llegar por el stream, sin esperar al final de la respuesta
+        self.speculative_tools: bool = False
+        # Carpeta de la que el modelo puede subir archivos con client__upload_file (None = el modelo
+        # no puede subir nada). /upload, que escribe el usuario, no tiene esta restricción
+        self.upload_root: Optional[Path] = None
+        # Tope por defecto de una llamada a tool de los servidores sin request_timeout (None = sin tope)
+        self.default_tool_timeout: Optional[float] = None
+        self._call_stats: Dict[str, int] = {"timeouts": 0, "cancelled": 0}
+        # Recorte del catálogo por petición; las tools locales van siempre
+        self.tool_selector = ToolSelector()
+        self.tool_selector.configure(always_include=[t["name"] for t in LOCAL_TOOLS])
+
+    # ----- Estado de conexión -----
+
+    def _mark_status(self, name: str, status: str, error: Optional[str] = None) -> None:
+        self.server_status[name] = status
+        if error:
+            self.server_errors[name] = error
+        else:
+            self.server_errors.pop(name, None)
+        # Cualquier estado distinto de "connecting" libera a quien espera en wait_until_ready
+        if status != "connecting" and name in self._ready_events:
+            self._ready_events[name].set()
+        if status == "ready" and name in self._connected_events:
+            self._connected_events[name].set()
+        if name in self._provisional_tools and name not in self.available_tools:
+            # Las tools provisionales sólo se anuncian mientras el servidor está conectando
+            self._tools_changed(name)
+        self._status_changed.set()
+        self._status_changed = asyncio.Event()
+
+        for listener in list(self._status_listeners):
+            try:
+                listener(name, status, error)
+            except Exception:
+                logger.exception("Status listener failed for %s", name)
+
+    def subscribe_status(self, listener: Callable[[str, str, Optional[str]], None]) -> None:
+        """Registra un callback que recibe (server, status, error) en cada cambio de conexión."""
+        if listener not in self._status_listeners:
+            self._status_listeners.append(listener)
+
+    def unsubscribe_status(self, listener: Callable[[str, str, Optional[str]], None]) -> None:
+        if listener in self._status_listeners:
+            self._status_listeners.remove(listener)
+
+    # ----- Tasks que mantienen la conexión dentro del mismo task -----
+
+    async def _server_supervisor(self, cfg: MCPServerConfig, runner):
+        """
+        Ejecuta cada intento de conexión en un task hijo (el enter/exit de los 'async with'
+        sigue ocurriendo en un solo task). Aplica connect_timeout a cada intento y, si la
+        conexión cae o falla, reintenta con backoff mientras cfg.reconnect esté activo.
+        """
+        name = cfg.name
+        attempt = 0
+        while True:
+            if attempt:
+                self._mark_status(name, "connecting", self.server_errors.get(name))
+            connected = self._connected_events[name] = asyncio.Event()
+            self._connect_started[name] = time.perf_counter()
+            conn_task = asyncio.create_task(runner(cfg), name=f"mcp-conn-{name}")
+            try:
+                ready_wait = asyncio.create_task(connected.wait())
+                done, _ = await asyncio.wait(
+                    {conn_task, ready_wait},
+                    timeout=cfg.connect_timeout or None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                ready_wait.cancel()
+                if not done:
+                    logger.error("Server '%s' did not become ready within %.1fs", name, cfg.connect_timeout)
+                    self._mark_status(name, "timeout", f"connect timeout after {cfg.connect_timeout:.1f}s")
+                    conn_task.cancel()
+
+                await asyncio.gather(conn_task, return_exceptions=True)
+            finally:
+                if not conn_task.done():
+                    conn_task.cancel()
+                    await asyncio.gather(conn_task, return_exceptions=True)
+
+            was_ready = connected.is_set()
+            if not cfg.reconnect:
+                return
+            # Una conexión que llegó a estar lista reinicia el backoff
+            attempt = 1 if was_ready else attempt + 1
+            delay = _backoff_delay(cfg, attempt)
+            logger.warning("Server '%s' lost (%s); reconnecting in %.1fs",
+                           name, self.server_errors.get(name, self.server_status.get(name)), delay)
+            self._mark_status(name, "reconnecting", self.server_errors.get(name))
+            await asyncio.sleep(delay)
+
+    async def _on_connected(self, cfg: MCPServerConfig, session: "ClientSession", where: str):
+        name = cfg.name
+        self.sessions[name] = session
+        try:
+            tools_resp = await session.list_tools()
+            self._set_server_tools(name, tools_resp.tools)
+        except Exception:
+            logger.exception("list_tools failed for %s", name)
+            self._set_server_tools(name, [])
+
+        tracing.record(f"mcp.connect.{name}", self._connect_started.get(name, time.perf_counter()),
+                       time.perf_counter(), "startup", transport=where)
+        self._mark_status(name, "ready")
+        logger.info("Connected to %s MCP server '%s' with %d tools", where, name, len(self.available_tools[name]))
+        for t in self.available_tools[name]:
+            logger.info("  - %s: %s", t.name, t.description or "")
+        await self._update_tools_cache(cfg)
+
+    def _on_disconnected(self, name: str) -> None:
+        self._drop_server(name)
+        if self.server_status.get(name) in ("connecting", "ready"):
+            self._mark_status(name, "disconnected")
+
+    async def _stdio_server_task(self, cfg: MCPServerConfig):
+        from mcp import ClientSession, StdioServerParameters
+        from mcp.client.stdio import stdio_client
+
         name = cfg.name
-        transport = (cfg.transport or "stdio").lower()
-        if name in _server_tasks:
-            logger.warning("Server '%s' ya estaba iniciado, saltando", name)
-            continue
-
-        if transport == "stdio":
-            if not cfg.command:
-                logger.error("Command missing for stdio server '%s'", name)
+        env = os.environ.copy()
+        if cfg.env:
+            env.update(cfg.env)
+
+        server_params = StdioServerParameters(
+            command=cfg.command,
+            args=cfg.args or [],
+            env=env
+        )
+
+        try:
+            # El 'async with' se ejecuta y se cierra dentro de este mismo task
+            async with stdio_client(server_params) as (read_stream, write_stream):
+                async with ClientSession(read_stream, write_stream) as session:
+                    await session.initialize()
+                    await self._on_connected(cfg, session, "stdio")
+
+                    # Mantener el task vivo hasta que sea cancelado o falle el health check
+                    await _health_loop(cfg, session)
+        except asyncio.CancelledError:
+            logger.info("Stdio server task for '%s' cancelled, cleaning up...", name)
+            raise
+        except Exception as e:
+            logger.exception("Error in stdio server task for '%s'", name)
+            self._mark_status(name, "failed", str(e))
+        finally:
+            self._on_disconnected(name)
+            logger.info("Stdio server '%s' fully cleaned up", name)
+
+    async def _streamable_http_server_task(self, cfg: MCPServerConfig):
+        from mcp import ClientSession
+        from mcp.client.streamable_http import streamablehttp_client
+
+        name = cfg.name
+        url = cfg.url
+        factory = _http_client_factory(cfg.http2)
+        try:
+            # Los async with se ejecutan y cierran en este mismo task --> evita problemas con cancel scopes
+            async with AsyncExitStack() as stack:
+                pool = []
+                for _ in range(max(1, cfg.pool_size)):
+                    read_stream, write_stream, _ = await stack.enter_async_context(
+                        streamablehttp_client(url, httpx_client_factory=factory)
+                    )
+                    pool.append(await stack.enter_async_context(ClientSession(read_stream, write_stream)))
+                await asyncio.gather(*(session.initialize() for session in pool))
+                if len(pool) > 1:
+                    self._session_pools[name] = pool
+                    self._pool_load[name] = [0] * len(pool)
+                await self._on_connected(cfg, pool[0], f"streamable-http ({url}, {len(pool)} session(s))")
+
+                # Mantener el task vivo hasta que sea cancelado o falle el health check
+                await _health_loop(cfg, *pool)
+        except asyncio.CancelledError:
+            logger.info("Streamable-HTTP task for '%s' cancelled, cleaning up...", name)
+            raise
+        except Exception as e:
+            logger.exception("Error in streamable-http server task for '%s'", name)
+            self._mark_status(name, "failed", str(e))
+        finally:
+            self._on_disconnected(name)
+            logger.info("Streamable-HTTP server '%s' fully cleaned up", name)
+
+    # ----- Caché de schemas entre ejecuciones -----
+
+    @staticmethod
+    def _config_fingerprint(cfg: MCPServerConfig) -> List[Any]:
+        return [cfg.transport, cfg.command, cfg.args, cfg.url, cfg.upload_tool]
+
+    def _load_tools_cache(self, servers_config: List[MCPServerConfig]) -> None:
+        if self.tools_cache_file is None or not self.tools_cache_file.exists():
+            return
+        try:
+            with open(self.tools_cache_file, "r", encoding="utf-8") as f:
+                self._tools_cache_data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable tools cache %s: %s", self.tools_cache_file, e)
+            return
+        for cfg in servers_config:
+            entry = self._tools_cache_data.get(cfg.name)
+            # Si cambió el comando o la URL, el servidor puede exponer otras tools
+            if entry and entry.get("config") == self._config_fingerprint(cfg):
+                self._provisional_tools[cfg.name] = entry["tools"]
+
+    async def _update_tools_cache(self, cfg: MCPServerConfig) -> None:
+        tools = self._convert_server_tools(cfg.name)
+        self._provisional_tools[cfg.name] = tools
+        if self.tools_cache_file is None:
+            return
+        self._tools_cache_data[cfg.name] = {"config": self._config_fingerprint(cfg), "tools": tools}
+        snapshot = json.dumps(self._tools_cache_data, ensure_ascii=False)
+        try:
+            await asyncio.to_thread(self._write_tools_cache, snapshot)
+        except OSError as e:
+            logger.warning("Could not write tools cache %s: %s", self.tools_cache_file, e)
+
+    def _write_tools_cache(self, data: str) -> None:
+        tmp_file = self.tools_cache_file.with_name(self.tools_cache_file.name + ".tmp")
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp_file, self.tools_cache_file)
+
+    async def _wait_for_server(self, name: str, timeout: float) -> None:
+        """Espera a que un servidor que está (re)conectando quede listo, como mucho `timeout`."""
+        deadline = time.monotonic() + timeout
+        while name not in self.sessions and self.server_status.get(name) in ("connecting", "reconnecting"):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            changed = self._status_changed
+            try:
+                await asyncio.wait_for(changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return
+
+    # ----- Arranque -----
+
+    async def start_servers(self, servers_config: List[MCPServerConfig], wait: bool = False,
+                            timeout: Optional[float] = None) -> Dict[str, str]:
+        """
+        Inicia un task por servidor. Cada task mantiene la conexión usando 'async with'
+        y por tanto el enter/exit ocurren en el mismo task (evita el error de anyio).
+        Cada task es un supervisor que reconecta con backoff si la conexión se cae.
+        Todos conectan en paralelo; cada uno tiene su connect_timeout. Con wait=True se
+        espera (como mucho `timeout` segundos) a que todos estén listos o hayan fallado.
+        """
+        self._load_tools_cache(servers_config)
+        for cfg in servers_config:
+            name = cfg.name
+            transport = (cfg.transport or "stdio").lower()
+            if name in self._server_tasks:
+                logger.warning("Server '%s' ya estaba iniciado, saltando", name)
                 continue
-            task = asyncio.create_task(_stdio_server_task(cfg), name=f"mcp-stdio-{name}")
-        elif transport in ("sse", "streamable-http", "streamable-http"):
-            if not cfg.url:
-                logger.error("URL missing for streamable-http server '%s'", name)
+
+            if transport == "stdio":
+                if not cfg.command:
+                    logger.error("Command missing for stdio server '%s'", name)
+                    self._mark_status(name, "failed", "command missing")
+                    continue
+                runner = self._stdio_server_task
+                task_name = f"mcp-stdio-{name}"
+            elif transport in ("sse", "streamable-http", "streamable-http"):
+                if not cfg.url:
+                    logger.error("URL missing for streamable-http server '%s'", name)
+                    self._mark_status(name, "failed", "url missing")
+                    continue
+                runner = self._streamable_http_server_task
+                task_name = f"mcp-http-{name}"
+            else:
+                logger.error("Unsupported transport '%s' for server '%s'", transport, name)
+                self._mark_status(name, "failed", f"unsupported transport '{transport}'")
                 continue
-            task = asyncio.create_task(_streamable_http_server_task(cfg), name=f"mcp-http-{name}")
-        else:
-            logger.error("Unsupported transport '%s' for server '%s'", transport, name)
-            continue
 
-        _server_tasks[name] = task
-        logger.info("Spawned connection task for server '%s' (transport=%s)", name, transport)
+            self._server_configs[name] = cfg
+            self._ready_events[name] = asyncio.Event()
+            self._mark_status(name, "connecting")
+            self._server_tasks[name] = asyncio.create_task(self._server_supervisor(cfg, runner), name=task_name)
+            self._server_semaphores[name] = asyncio.Semaphore(max(1, cfg.max_concurrency or 1))
+            logger.info("Spawned connection task for server '%s' (transport=%s)", name, transport)
+
+        if wait:
+            return await self.wait_until_ready(timeout)
+        return self.get_server_status()
 
+    async def wait_until_ready(self, timeout: Optional[float] = None,
+                               names: Optional[List[str]] = None) -> Dict[str, str]:
+        """
+        Barrera de arranque: espera a que los servidores indicados (todos por defecto) estén
+        listos o hayan fallado, como mucho `timeout` segundos. Los que sigan conectando al
+        vencer el plazo se reportan como "connecting" y continúan en segundo plano.
+        """
+        targets = [n for n in (names or list(self._ready_events)) if n in self._ready_events]
+        waiters = [asyncio.create_task(self._ready_events[n].wait()) for n in targets]
+        if waiters:
+            _, pending = await asyncio.wait(waiters, timeout=timeout)
+            for w in pending:
+                w.cancel()
+        statuses = self.get_server_status()
+        logger.info("MCP servers status: %s", statuses)
+        return statuses
 
-async def call_tool(server_name: str, tool_name: str, arguments: Dict[str, Any]) -> Any:
-    if server_name not in sessions:
-        raise ValueError(f"Server '{server_name}' not connected")
+    def get_server_status(self) -> Dict[str, str]:
+        return self.server_status.copy()
 
-    session = sessions[server_name]
-    try:
-        result = await session.call_tool(tool_name, arguments)
-        if getattr(result, "content", None) and len(result.content) > 0:
-            return result.content[0].text
+    # ----- Caché de resultados -----
+
+    def configure_result_cache(self, enabled: bool = True, max_bytes: int = 8 * 1024 * 1024) -> None:
+        self.result_cache_enabled = enabled
+        self.result_cache_max_bytes = max_bytes
+        if not enabled:
+            self.clear_result_cache()
         else:
-            return str(result)
-    except Exception:
-        logger.exception("Tool call failed for %s.%s", server_name, tool_name)
-        raise
+            self._evict_results()
 
+    def clear_result_cache(self, server_name: Optional[str] = None) -> None:
+        for key in [k for k in self._result_cache if server_name is None or k[0] == server_name]:
+            self._result_cache_bytes -= self._result_cache.pop(key)[2]
+        self._result_cache_stats["invalidations"] += 1
 
-def get_all_tools_for_anthropic() -> List[Dict[str, Any]]:
-    schemas_override = {
-        "upload_excel": {
-            "type": "object",
-            "properties": {
-                "file_bytes": {"type": "string", "description": "Archivo Excel en base64"},
-                "filename": {"type": "string", "description": "Nombre del archivo"},
-            },
-            "required": ["file_bytes", "filename"]
-        },
-        "list_datasets": {"type": "object", "properties": {}, "required": []},
-        "describe": {
-            "type": "object",
-            "properties": {
-                "dataset_id": {"type": "string", "description": "ID del dataset a describir"},
-                "sheet_name": {"type": "string", "description": "Nombre de la hoja (opcional)"}
-            },
-            "required": ["dataset_id"]
-        },
-        "proportion": {
-            "type": "object",
-            "properties": {
-                "dataset_id": {"type": "string"},
-                "sheet_name": {"type": "string"},
-                "numerator_filter": {"type": "string"},
-                "denominator_filter": {"type": "string"}
-            },
-            "required": ["dataset_id", "sheet_name", "numerator_filter", "denominator_filter"]
-        },
-        "odds_ratio_rr": {
-            "type": "object",
-            "properties": {
-                "dataset_id": {"type": "string"},
-                "sheet_name": {"type": "string"},
-                "exposure_col": {"type": "string"},
-                "outcome_col": {"type": "string"},
-                "exposure_val": {"type": "string"},
-                "outcome_val": {"type": "string"}
-            },
-            "required": ["dataset_id", "sheet_name", "exposure_col", "outcome_col", "exposure_val", "outcome_val"]
-        },
-        "chi_square": {
-            "type": "object",
-            "properties": {
-                "dataset_id": {"type": "string"},
-                "sheet_name": {"type": "string"},
-                "col1": {"type": "string"},
-                "col2": {"type": "string"},
-                "correction": {"type": "boolean"}
-            },
-            "required": ["dataset_id", "sheet_name", "col1", "col2"]
-        },
-        "ttest": {
-            "type": "object",
-            "properties": {
-                "dataset_id": {"type": "string"},
-                "sheet_name": {"type": "string"},
-                "group_col": {"type": "string"},
-                "value_col": {"type": "string"},
-                "group1": {"type": "string"},
-                "group2": {"type": "string"}
-            },
-            "required": ["dataset_id", "sheet_name", "group_col", "value_col", "group1", "group2"]
-        },
-        "plot": {
-            "type": "object",
-            "properties": {
-                "dataset_id": {"type": "string"},
-                "sheet_name": {"type": "string"},
-                "kind": {"type": "string", "description": "Tipo de gráfico: hist, scatter, etc."},
-                "x": {"type": "string"},
-                "y": {"type": "string"},
-                "options": {"type": "object"}
-            },
-            "required": ["dataset_id", "sheet_name", "kind"]
-        },
-        "debug_info": {"type": "object", "properties": {}, "required": []}
-    }
+    def get_result_cache_stats(self) -> Dict[str, int]:
+        return {**self._result_cache_stats, "entries": len(self._result_cache), "bytes": self._result_cache_bytes}
+
+    def _cache_key(self, server_name: str, tool_name: str, arguments: Dict[str, Any]) -> Optional[tuple]:
+        cfg = self._server_configs.get(server_name)
+        if not self.result_cache_enabled or cfg is None or tool_name not in cfg.cacheable_tools:
+            return None
+        try:
+            canonical = json.dumps(arguments or {}, sort_keys=True, separators=(",", ":"), default=str)
+        except (TypeError, ValueError):
+            return None
+        return (server_name, tool_name, canonical)
+
+    def _cache_get(self, key: tuple) -> Optional[Any]:
+        entry = self._result_cache.get(key)
+        if entry is None:
+            return None
+        expires_at, value, size = entry
+        if expires_at < time.monotonic():
+            del self._result_cache[key]
+            self._result_cache_bytes -= size
+            return None
+        self._result_cache.move_to_end(key)
+        return value
+
+    def _cache_put(self, key: tuple, value: Any) -> None:
+        size = len(str(value).encode("utf-8", errors="replace"))
+        if size > self.result_cache_max_bytes:
+            return
+        old = self._result_cache.pop(key, None)
+        if old is not None:
+            self._result_cache_bytes -= old[2]
+        ttl = self._server_configs[key[0]].cache_ttl
+        self._result_cache[key] = (time.monotonic() + ttl, value, size)
+        self._result_cache_bytes += size
+        self._evict_results()
+
+    def _evict_results(self) -> None:
+        while self._result_cache and self._result_cache_bytes > self.result_cache_max_bytes:
+            _, (_, _, size) = self._result_cache.popitem(last=False)
+            self._result_cache_bytes -= size
+            self._result_cache_stats["evictions"] += 1
+
+    # ----- Resultados de tools -----
+
+    def configure_tool_results(self, max_bytes: int = 32 * 1024) -> None:
+        self.max_result_bytes = max_bytes
+
+    def _store_result(self, text: str, owner: Optional[str] = None) -> str:
+        handle = f"res-{secrets.token_hex(8)}"
+        self._stored_results[handle] = (owner, text)
+        while len(self._stored_results) > MAX_STORED_RESULTS:
+            self._stored_results.popitem(last=False)
+        return handle
+
+    def _convert_tool_result(self, result, owner: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Convierte todos los bloques de un CallToolResult a contenido de tool_result de Anthropic
+        y aplica max_result_bytes: el texto que no entra se guarda bajo un handle de `owner`.
+        """
+        content = getattr(result, "content", None) or []
+        blocks = [_convert_content_block(b) for b in content]
+        if not blocks:
+            structured = getattr(result, "structuredContent", None)
+            text = json.dumps(structured, ensure_ascii=False) if structured is not None else "(empty result)"
+            blocks = [{"type": "text", "text": text}]
+
+        capped = []
+        remaining = self.max_result_bytes
+        overflow = []
+        for block in blocks:
+            if block["type"] == "text":
+                if overflow:
+                    overflow.append(block["text"])
+                    continue
+                head, rest = _truncate_utf8(block["text"], max(remaining, 0))
+                if head:
+                    capped.append({"type": "text", "text": head})
+                remaining -= len(head.encode("utf-8"))
+                if rest:
+                    overflow.append(rest)
+            else:
+                size = len(block["source"]["data"])
+                if size > remaining:
+                    capped.append({"type": "text", "text": "[image omitted: exceeds tool result size cap]"})
+                else:
+                    capped.append(block)
+                    remaining -= size
+
+        if not capped and not overflow:
+            capped.append({"type": "text", "text": "(empty result)"})
+        if overflow:
+            rest = "\n".join(overflow)
+            handle = self._store_result(rest, owner)
+            capped.append({
+                "type": "text",
+                "text": (f"\n[truncated: {len(rest.encode('utf-8'))} more bytes. "
+                         f"Call {LOCAL_SERVER}__fetch_result with handle=\"{handle}\" to read more]")
+            })
+        return capped
+
+    def _fetch_result(self, arguments: Dict[str, Any], owner: Optional[str] = None) -> List[Dict[str, Any]]:
+        handle = arguments.get("handle")
+        stored = self._stored_results.get(handle)
+        # Un handle de otra conversación se trata igual que uno que no existe
+        if stored is None or stored[0] != owner:
+            raise ValueError(f"Unknown or expired result handle '{handle}'")
+
+        data = stored[1].encode("utf-8")
+        offset = _utf8_boundary(data, int(arguments.get("offset") or 0))
+        length = int(arguments.get("length") or self.max_result_bytes)
+        length = max(1, min(length, self.max_result_bytes))
+        # Las páginas terminan en un límite de carácter: juntas reproducen el resultado exacto
+        end = _utf8_boundary(data, offset + length)
+        if end <= offset < len(data):
+            # length menor que un carácter: se devuelve ese carácter entero
+            end = offset + 1
+            while end < len(data) and data[end] & 0xC0 == 0x80:
+                end += 1
+        text = data[offset:end].decode("utf-8")
+        if end < len(data):
+            text += (f"\n[{len(data) - end} more bytes. Call {LOCAL_SERVER}__fetch_result with "
+                     f"handle=\"{handle}\" offset={end}]")
+        return [{"type": "text", "text": text}]
+
+    # ----- Subida de archivos -----
+
+    def get_upload_servers(self) -> List[str]:
+        return [n for n, cfg in self._server_configs.items() if cfg.upload_tool and n in self.sessions]
+
+    async def upload_file(self, path: str, server_name: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Sube un archivo local a la upload_tool de un servidor sin pasar por el modelo: se lee
+        y codifica por trozos fuera del event loop y se envía directo por la sesión MCP.
+        """
+        candidates = self.get_upload_servers()
+        if server_name is None:
+            if not candidates:
+                raise ValueError("No connected server accepts file uploads")
+            server_name = candidates[0]
+        elif server_name not in candidates:
+            raise ValueError(f"Server '{server_name}' does not accept uploads or is not connected")
+
+        file_path = Path(path).expanduser()
+        if not file_path.is_file():
+            raise ValueError(f"File not found: {file_path}")
+
+        file_bytes = await asyncio.to_thread(_encode_file, file_path)
+        logger.info("Uploading %s (%d bytes) to %s", file_path, file_path.stat().st_size, server_name)
+        upload_tool = self._server_configs[server_name].upload_tool
+        return await self.call_tool(server_name, upload_tool, {"file_bytes": file_bytes, "filename": file_path.name})
+
+    # ----- Llamadas a tools -----
+
+    def _model_upload_path(self, path: str) -> Path:
+        """
+        Ruta real de un archivo que pide subir el modelo. Un resultado de tool manipulado no debe
+        poder sacar ~/.ssh, .env o mcp_config.json: sólo se aceptan archivos bajo upload_root,
+        resolviendo enlaces simbólicos y "..".
+        """
+        if self.upload_root is None:
+            raise ValueError("File uploads by the model are disabled (set upload_root in mcp_config.json); "
+                             "ask the user to run /upload <path>")
+        root = self.upload_root.expanduser().resolve()
+        candidate = Path(path).expanduser()
+        if not candidate.is_absolute():
+            candidate = root / candidate
+        real = candidate.resolve()
+        if not real.is_relative_to(root):
+            raise ValueError(f"Uploads are limited to files under {root}")
+        return real
+
+    async def _call_local_tool(self, tool_name: str, arguments: Dict[str, Any],
+                               owner: Optional[str] = None) -> List[Dict[str, Any]]:
+        if tool_name == "upload_file":
+            path = self._model_upload_path(arguments.get("path", ""))
+            return await self.upload_file(str(path), arguments.get("server"))
+        if tool_name == "fetch_result":
+            return self._fetch_result(arguments, owner)
+        if tool_name == SEARCH_TOOL_NAME.split("__", 1)[1]:
+            return self._search_tools(arguments.get("query", ""))
+        raise ValueError(f"Unknown local tool '{tool_name}'")
 
-    anthropic_tools = []
-    for server_name, tools in available_tools.items():
-        for tool in tools:
+    async def call_tool(self, server_name: str, tool_name: str, arguments: Dict[str, Any],
+                        owner: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Llama a una tool y devuelve todos los bloques del resultado (texto, imágenes, recursos)
+        como contenido de tool_result de Anthropic, recortado a max_result_bytes. `owner` es la
+        conversación que llama: sólo ella puede pedir con fetch_result lo que quede recortado.
+        """
+        if server_name == LOCAL_SERVER:
+            return await self._call_local_tool(tool_name, arguments, owner)
+        if server_name not in self.sessions and server_name in self._server_configs:
+            # Tool anunciada desde la caché de schemas: esperar sólo a este servidor
+            with tracing.span(f"mcp.wait_ready.{server_name}", "mcp"):
+                await self._wait_for_server(server_name, self._server_configs[server_name].connect_timeout or 30.0)
+        if server_name not in self.sessions:
+            raise ValueError(f"Server '{server_name}' not connected")
+
+        key = self._cache_key(server_name, tool_name, arguments)
+        if key is not None:
+            cached = self._cache_get(key)
+            if cached is not None:
+                self._result_cache_stats["hits"] += 1
+                logger.debug("Result cache hit for %s.%s", server_name, tool_name)
+                # Se guarda el resultado sin convertir: cada conversación recibe sus propios handles
+                return self._convert_tool_result(cached, owner)
+            self._result_cache_stats["misses"] += 1
+        elif (self._server_configs.get(server_name) and self._server_configs[server_name].cacheable_tools
+              and not self.is_read_only(f"{server_name}__{tool_name}")):
+            # Una tool que no es de sólo lectura puede cambiar el estado del servidor
+            if any(k[0] == server_name for k in self._result_cache):
+                self.clear_result_cache(server_name)
+
+        timeout = self._tool_timeout(server_name, tool_name)
+        semaphore = self._server_semaphores.get(server_name)
+        try:
+            with tracing.span(f"mcp.{server_name}", "mcp", tool=tool_name) as span_args:
+                if semaphore is not None:
+                    async with semaphore:
+                        result = await self._call_pooled(server_name, tool_name, arguments, timeout, span_args)
+                else:
+                    result = await self._call_pooled(server_name, tool_name, arguments, timeout, span_args)
+            if key is not None and not getattr(result, "isError", False):
+                self._cache_put(key, result)
+            return self._convert_tool_result(result, owner)
+        except TimeoutError as e:
+            logger.warning("Tool call failed for %s.%s: %s", server_name, tool_name, e)
+            raise
+        except Exception:
+            logger.exception("Tool call failed for %s.%s", server_name, tool_name)
+            raise
+
+    def _tool_timeout(self, server_name: str, tool_name: str) -> Optional[timedelta]:
+        """Tope de una llamada: el de la tool, el del servidor o el global, en ese orden."""
+        cfg = self._server_configs.get(server_name)
+        seconds = self.default_tool_timeout
+        if cfg is not None:
+            seconds = cfg.tool_timeouts.get(tool_name, cfg.request_timeout or seconds)
+        return timedelta(seconds=seconds) if seconds else None
+
+    async def _call_pooled(self, server_name: str, tool_name: str, arguments: Dict[str, Any],
+                           timeout: Optional[timedelta], span_args: Dict[str, Any]):
+        """call_tool sobre la sesión del pool con menos llamadas en vuelo (o la única que haya)."""
+        pool = self._session_pools.get(server_name)
+        if not pool:
+            return await self._call_session(self.sessions[server_name], tool_name, arguments, timeout)
+        # Se guarda la lista de carga: si el servidor reconecta mientras tanto, el pool nuevo trae otra
+        load = self._pool_load[server_name]
+        slot = min(range(len(pool)), key=load.__getitem__)
+        span_args["slot"] = slot
+        load[slot] += 1
+        try:
+            return await self._call_session(pool[slot], tool_name, arguments, timeout)
+        finally:
+            load[slot] -= 1
+
+    async def _call_session(self, session: "ClientSession", tool_name: str, arguments: Dict[str, Any],
+                            timeout: Optional[timedelta]):
+        """
+        call_tool con tope de tiempo. Si la llamada se cancela (/cancel, llamada especulativa
+        descartada) o vence el tope, se avisa al servidor con notifications/cancelled para que
+        deje de trabajar en ella en vez de acumular trabajo huérfano.
+        """
+        from mcp.shared.exceptions import McpError
+
+        kwargs = {"read_timeout_seconds": timeout} if timeout else {}
+        # send_request toma el siguiente id sin ceder el control antes: es el de esta llamada
+        request_id = getattr(session, "_request_id", None)
+        try:
+            return await session.call_tool(tool_name, arguments, **kwargs)
+        except asyncio.CancelledError:
+            self._call_stats["cancelled"] += 1
+            await self._notify_cancelled(session, request_id, "cancelled by the client")
+            raise
+        except McpError as e:
+            if timeout is None or e.error.code != 408:
+                raise
+            self._call_stats["timeouts"] += 1
+            await self._notify_cancelled(session, request_id, "timed out")
+            raise TimeoutError(f"{tool_name} timed out after {timeout.total_seconds():g}s") from e
+
+    async def _notify_cancelled(self, session: "ClientSession", request_id: Optional[int], reason: str) -> None:
+        from mcp import types
+
+        if request_id is None:
+            return
+        notification = types.ClientNotification(types.CancelledNotification(
+            method="notifications/cancelled",
+            params=types.CancelledNotificationParams(requestId=request_id, reason=reason),
+        ))
+        try:
+            # Con tope propio: el aviso no debe colgarse si la conexión está caída
+            await asyncio.wait_for(session.send_notification(notification), 2.0)
+        except Exception as e:
+            logger.debug("Could not send cancellation for request %s: %s", request_id, e)
+
+    def get_call_stats(self) -> Dict[str, int]:
+        return dict(self._call_stats)
+
+    # ----- Catálogo de tools -----
+
+    def _tools_changed(self, server_name: str) -> None:
+        """Invalida la caché de schemas de un servidor (connect, disconnect o re-list)."""
+        self._tools_version[server_name] = self._tools_version.get(server_name, 0) + 1
+        self._anthropic_tools_cache.pop(server_name, None)
+        self._combined_tools_cache = None
+
+    def _set_server_tools(self, server_name: str, tools: List) -> None:
+        self.available_tools[server_name] = tools
+        self._tools_changed(server_name)
+
+    def _drop_server(self, server_name: str) -> None:
+        self.sessions.pop(server_name, None)
+        self._session_pools.pop(server_name, None)
+        self._pool_load.pop(server_name, None)
+        self.available_tools.pop(server_name, None)
+        self._tools_changed(server_name)
+
+    async def refresh_tools(self, server_name: str) -> List:
+        """Vuelve a pedir list_tools a un servidor conectado e invalida su caché."""
+        if server_name not in self.sessions:
+            raise ValueError(f"Server '{server_name}' not connected")
+        tools_resp = await self.sessions[server_name].list_tools()
+        self._set_server_tools(server_name, tools_resp.tools)
+        return tools_resp.tools
+
+    def _convert_server_tools(self, server_name: str) -> List[Dict[str, Any]]:
+        cached = self._anthropic_tools_cache.get(server_name)
+        if cached is not None:
+            return cached
+        if server_name not in self.available_tools and server_name in self._provisional_tools:
+            return self._provisional_tools[server_name]
+
+        cfg = self._server_configs.get(server_name)
+        converted = []
+        for tool in self.available_tools.get(server_name, []):
+            if cfg is not None and tool.name == cfg.upload_tool:
+                continue
             safe_tool_name = tool.name.replace(".", "_")
             # OJO: el override se busca por el nombre original de la tool
-            schema = schemas_override.get(tool.name) or getattr(tool, "inputSchema", None) or {
+            schema = SCHEMAS_OVERRIDE.get(tool.name) or getattr(tool, "inputSchema", None) or {
                 "type": "object",
                 "properties": {},
                 "required": []
             }
-            anthropic_tools.append({
+            converted.append({
                 "name": f"{server_name}__{safe_tool_name}",
                 "description": f"[{server_name}] {tool.description or tool.name}",
                 "input_schema": schema
             })
 
-    logger.info("Tools expuestas a Anthropic: %s", anthropic_tools)
-    return anthropic_tools
+        self._anthropic_tools_cache[server_name] = converted
+        logger.debug("Tools de '%s' convertidas (version %d): %s",
+                     server_name, self._tools_version.get(server_name, 0), converted)
+        return converted
+
+    def _tool_servers(self) -> List[str]:
+        """Servidores conectados más los que aún conectan y tienen schemas en caché."""
+        names = list(self.available_tools)
+        for name in self._provisional_tools:
+            if name not in self.available_tools and self.server_status.get(name) in ("connecting", "reconnecting"):
+                names.append(name)
+        return names
+
+    def is_read_only(self, tool_name: str) -> bool:
+        """Si la tool (server__tool) está marcada sin efectos secundarios en mcp_config.json."""
+        server_name, _, name = tool_name.partition("__")
+        cfg = self._server_configs.get(server_name)
+        return cfg is not None and (name in cfg.read_only_tools or name in cfg.cacheable_tools)
+
+    def get_tools_version(self) -> tuple:
+        """Versión combinada del set de tools; cambia sólo cuando algún servidor cambia."""
+        return tuple(sorted(self._tools_version.items()))
 
-def get_available_tools():
-    return available_tools.copy()
+    def get_all_tools_for_anthropic(self) -> List[Dict[str, Any]]:
+        """
+        Devuelve la lista de tools en formato Anthropic. Se cachea por servidor y sólo se
+        reconstruye cuando un servidor conecta, desconecta o vuelve a listar sus tools.
+        La lista devuelta es compartida: no modificarla.
+        """
+        if self._combined_tools_cache is None:
+            anthropic_tools = []
+            for server_name in self._tool_servers():
+                anthropic_tools.extend(self._convert_server_tools(server_name))
+            # Sin upload_root el modelo no puede subir archivos: ni siquiera ve la tool
+            anthropic_tools.extend(t for t in LOCAL_TOOLS
+                                   if self.upload_root is not None or t["name"] != f"{LOCAL_SERVER}__upload_file")
+            self._combined_tools_cache = anthropic_tools
+            logger.info("Tools expuestas a Anthropic: %d (version %s)",
+                        len(anthropic_tools), self.get_tools_version())
+        return self._combined_tools_cache
 
+    def _tool_contexts(self) -> Dict[str, str]:
+        """Descripción de cada servidor (mcp_config.json), indexada junto a sus tools."""
+        return {name: cfg.description for name, cfg in self._server_configs.items() if cfg.description}
 
-async def cleanup():
+    def select_tools(self, query: str, recent=(), extra=()) -> List[Dict[str, Any]]:
+        """Tools a enviar en una petición sobre `query`; ver ToolSelector.select."""
+        return self.tool_selector.select(self.get_all_tools_for_anthropic(), query, recent, extra,
+                                         self._tool_contexts())
+
+    def search_tools(self, query: str) -> List[str]:
+        """Nombres de las tools del catálogo completo más relevantes para `query`."""
+        return self.tool_selector.search(self.get_all_tools_for_anthropic(), query, self._tool_contexts())
+
+    def _search_tools(self, query: str) -> List[Dict[str, Any]]:
+        self.tool_selector.stats["searches"] += 1
+        by_name = {t["name"]: t for t in self.get_all_tools_for_anthropic()}
+        found = [by_name[n] for n in self.search_tools(query)]
+        if not found:
+            return [{"type": "text", "text": f"No tools match '{query}'. Try other keywords."}]
+        lines = [f"- {t['name']}: {t.get('description') or ''}" for t in found]
+        return [{"type": "text", "text": "Now available:\n" + "\n".join(lines)}]
+
+    def get_available_tools(self):
+        return self.available_tools.copy()
+
+    async def cleanup(self):
+        """
+        Cancela todos los tasks y espera su terminación. Cada task cerrará sus contextos en el mismo task.
+        """
+        tasks = list(self._server_tasks.values())
+        if not tasks:
+            return
+
+        logger.info("Cancelling %d MCP server tasks...", len(tasks))
+        for t in tasks:
+            t.cancel()
+
+        # esperar a que todos terminen (no propagar excepciones salvo logs)
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for name, res in zip(list(self._server_tasks.keys()), results):
+            if isinstance(res, Exception) and not isinstance(res, asyncio.CancelledError):
+                logger.warning("Task %s finished with exception: %s", name, res)
+            else:
+                logger.debug("Task %s finished cleanly", name)
+
+        self._server_tasks.clear()
+        self._server_semaphores.clear()
+        self._ready_events.clear()
+        self._connected_events.clear()
+        for name in list(self.available_tools):
+            self._drop_server(name)
+        self.sessions.clear()
+        logger.info("Cleanup complete: all MCP server tasks stopped.")
+
+
+# ----- Interfaz de módulo: hub por defecto del proceso -----
+
+default_hub = MCPHub()
+
+# Alias a los dicts del hub por defecto (mismos objetos, no copias)
+sessions = default_hub.sessions
+available_tools = default_hub.available_tools
+server_status = default_hub.server_status
+server_errors = default_hub.server_errors
+
+subscribe_status = default_hub.subscribe_status
+unsubscribe_status = default_hub.unsubscribe_status
+start_servers = default_hub.start_servers
+wait_until_ready = default_hub.wait_until_ready
+get_server_status = default_hub.get_server_status
+configure_result_cache = default_hub.configure_result_cache
+clear_result_cache = default_hub.clear_result_cache
+get_result_cache_stats = default_hub.get_result_cache_stats
+get_call_stats = default_hub.get_call_stats
+configure_tool_results = default_hub.configure_tool_results
+get_upload_servers = default_hub.get_upload_servers
+upload_file = default_hub.upload_file
+call_tool = default_hub.call_tool
+refresh_tools = default_hub.refresh_tools
+get_tools_version = default_hub.get_tools_version
+get_all_tools_for_anthropic = default_hub.get_all_tools_for_anthropic
+select_tools = default_hub.select_tools
+search_tools = default_hub.search_tools
+get_available_tools = default_hub.get_available_tools
+cleanup = default_hub.cleanup
+
+
+def load_config(path: str, target: Optional[MCPHub] = None) -> List[MCPServerConfig]:
     """
-    Cancela todos los tasks y espera su terminación. Cada task cerrará sus contextos en el mismo task.
+    Lee mcp_config.json: devuelve la configuración de cada servidor y aplica al hub los
+    bloques globales (tool_results, result_cache, tools_cache, tool_selection, speculative_tools,
+    tool_timeout, upload_root).
+    Si el archivo no existe devuelve [].
     """
-    tasks = list(_server_tasks.values())
-    if not tasks:
-        return
-
-    logger.info("Cancelling %d MCP server tasks...", len(tasks))
-    for t in tasks:
-        t.cancel()
-
-    # esperar a que todos terminen (no propagar excepciones salvo logs)
-    results = await asyncio.gather(*tasks, return_exceptions=True)
-    for name, res in zip(list(_server_tasks.keys()), results):
-        if isinstance(res, Exception) and not isinstance(res, asyncio.CancelledError):
-            logger.warning("Task %s finished with exception: %s", name, res)
-        else:
-            logger.debug("Task %s finished cleanly", name)
-
-    _server_tasks.clear()
-    sessions.clear()
-    available_tools.clear()
-    logger.info("Cleanup complete: all MCP server tasks stopped.")
+    target = target or default_hub
+    if not Path(path).exists():
+        return []
+    with open(path, "r") as f:
+        cfg = json.load(f)
 
+    servers = []
+    for s in cfg.get("servers", []):
+        servers.append(
+            MCPServerConfig(
+                name=s.get("name"),
+                command=s.get("command"),
+                args=s.get("args"),
+                env=s.get("env"),
+                url=s.get("url"),
+                transport=s.get("transport", "stdio"),
+                description=s.get("description", ""),
+                max_concurrency=s.get("max_concurrency", 4),
+                connect_timeout=s.get("connect_timeout", 30.0),
+                reconnect=s.get("reconnect", True),
+                health_interval=s.get("health_interval", 30.0),
+                health_timeout=s.get("health_timeout", 10.0),
+                max_backoff=s.get("max_backoff", 60.0),
+                cacheable_tools=s.get("cacheable_tools", []),
+                cache_ttl=s.get("cache_ttl", 300.0),
+                upload_tool=s.get("upload_tool"),
+                pool_size=s.get("pool_size", 1),
+                http2=s.get("http2", False),
+                request_timeout=s.get("request_timeout"),
+                tool_timeouts=s.get("tool_timeouts", {}),
+                read_only_tools=s.get("read_only_tools", []),
+            )
+        )
+    target.configure_tool_results(
+        max_bytes=cfg.get("tool_results", {}).get("max_bytes", 32 * 1024),
+    )
+    target.tools_cache_file = Path(cfg["tools_cache"]) if cfg.get("tools_cache") else None
+    target.speculative_tools = bool(cfg.get("speculative_tools", False))
+    target.upload_root = Path(cfg["upload_root"]) if cfg.get("upload_root") else None
+    target._combined_tools_cache = None
+    target.default_tool_timeout = cfg.get("tool_timeout")
+    selection_cfg = cfg.get("tool_selection", {})
+    target.tool_selector.configure(
+        enabled=selection_cfg.get("enabled"),
+        max_tools=selection_cfg.get("max_tools"),
+        min_tools=selection_cfg.get("min_tools"),
+        recent_turns=selection_cfg.get("recent_turns"),
+        always_include=(selection_cfg["always_include"] + [t["name"] for t in LOCAL_TOOLS]
+                        if "always_include" in selection_cfg else None),
+    )
+    cache_cfg = cfg.get("result_cache", {})
+    target.configure_result_cache(
+        enabled=cache_cfg.get("enabled", True),
+        max_bytes=cache_cfg.get("max_bytes", 8 * 1024 * 1024),
+    )
+    return servers
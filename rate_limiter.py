@@ -0,0 +1,188 @@
+import time
+import random
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+# Códigos que la API documenta como transitorios (529 = overloaded)
+RETRYABLE_STATUS = (408, 409, 429, 500, 502, 503, 504, 529)
+
+
+def _parse_reset(value: Optional[str]) -> Optional[float]:
+    """Convierte un header *-reset (RFC 3339) a segundos desde ahora."""
+    if not value:
+        return None
+    try:
+        reset_at = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return max(0.0, (reset_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class _Bucket:
+    """
+    Estado de un límite (peticiones, tokens de entrada o de salida). La API usa un token
+    bucket que se rellena de forma continua, así que entre respuestas se rellena localmente
+    a razón de limit/60 por segundo.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.limit: Optional[float] = None
+        self.remaining: Optional[float] = None
+        self._updated = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        if self.limit and self.remaining is not None:
+            self.remaining = min(self.limit, self.remaining + (now - self._updated) * self.limit / 60.0)
+        self._updated = now
+
+    def update(self, limit: Optional[str], remaining: Optional[str], reserved: float) -> None:
+        # El valor del servidor no incluye lo que otras peticiones ya tienen reservado y aún no llegó
+        if limit is None or remaining is None:
+            return
+        try:
+            self.limit = float(limit)
+            self.remaining = float(remaining) - reserved
+        except ValueError:
+            return
+        self._updated = time.monotonic()
+
+    def wait_time(self, amount: float) -> float:
+        """Segundos hasta poder gastar `amount`; 0 si hay saldo o el límite es desconocido."""
+        self.refill()
+        if not self.limit or self.remaining is None:
+            return 0.0
+        # Una petición mayor que el límite entero sólo tiene que esperar a que el bucket se llene
+        amount = min(amount, self.limit)
+        if self.remaining >= amount:
+            return 0.0
+        return (amount - self.remaining) * 60.0 / self.limit
+
+    def spend(self, amount: float) -> None:
+        if self.remaining is not None:
+            self.remaining -= amount
+
+
+class RateLimitScheduler:
+    """
+    Se interpone entre el bot y client.messages.stream. Lleva los presupuestos de peticiones y
+    tokens por minuto a partir de los headers anthropic-ratelimit-* de cada respuesta, retrasa
+    las peticiones que los excederían y decide cuándo y cuánto esperar para reintentar errores
+    transitorios. Es compartido por todas las sesiones porque el cupo es de la API key.
+    """
+
+    def __init__(self, max_retries: int = 4, max_backoff: float = 60.0):
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self.requests = _Bucket("requests")
+        self.input_tokens = _Bucket("input_tokens")
+        self.output_tokens = _Bucket("output_tokens")
+        self._paused_until = 0.0
+        self._reserved_requests = 0
+        self._reserved_tokens = 0
+        # Las esperas se hacen de una en una para que el orden de llegada se respete
+        self._lock = asyncio.Lock()
+        self.stats: Dict[str, Any] = {"requests": 0, "delayed": 0, "delay_s": 0.0, "retries": 0, "rate_limited": 0}
+
+    def configure(self, max_retries: Optional[int] = None, max_backoff: Optional[float] = None) -> None:
+        if max_retries is not None:
+            self.max_retries = max_retries
+        if max_backoff is not None:
+            self.max_backoff = max_backoff
+
+    async def acquire(self, input_tokens: int) -> None:
+        """Espera hasta que la petición quepa en los presupuestos y la reserva."""
+        async with self._lock:
+            waited = 0.0
+            while True:
+                delay = max(
+                    self._paused_until - time.monotonic(),
+                    self.requests.wait_time(1),
+                    self.input_tokens.wait_time(input_tokens),
+                    self.output_tokens.wait_time(1),
+                )
+                if delay <= 0:
+                    break
+                waited += delay
+                await asyncio.sleep(delay)
+
+            self.requests.spend(1)
+            self.input_tokens.spend(input_tokens)
+            self._reserved_requests += 1
+            self._reserved_tokens += input_tokens
+            self.stats["requests"] += 1
+            if waited:
+                self.stats["delayed"] += 1
+                self.stats["delay_s"] += waited
+                logger.info("Request delayed %.2fs to stay under the rate limit", waited)
+
+    def release(self, input_tokens: int, headers=None) -> None:
+        """Libera la reserva de una petición y actualiza los presupuestos con sus headers."""
+        self._reserved_requests = max(0, self._reserved_requests - 1)
+        self._reserved_tokens = max(0, self._reserved_tokens - input_tokens)
+        if headers is None:
+            return
+        get = headers.get
+        self.requests.update(get("anthropic-ratelimit-requests-limit"),
+                             get("anthropic-ratelimit-requests-remaining"), self._reserved_requests)
+        self.input_tokens.update(get("anthropic-ratelimit-input-tokens-limit"),
+                                 get("anthropic-ratelimit-input-tokens-remaining"), self._reserved_tokens)
+        self.output_tokens.update(get("anthropic-ratelimit-output-tokens-limit"),
+                                  get("anthropic-ratelimit-output-tokens-remaining"), 0)
+
+    def retry_delay(self, error: Exception, attempt: int) -> Optional[float]:
+        """
+        Segundos a esperar antes del reintento `attempt` (1, 2, ...), o None si el error no es
+        reintentable o se agotaron los reintentos. Un 429 pausa a todas las sesiones.
+        """
+        from anthropic._exceptions import RateLimitError, APIConnectionError, APIStatusError
+
+        if attempt > self.max_retries:
+            return None
+        response = None
+        if isinstance(error, APIStatusError):
+            if error.status_code not in RETRYABLE_STATUS:
+                return None
+            response = error.response
+        elif not isinstance(error, APIConnectionError):
+            return None
+
+        delay = None
+        if response is not None:
+            headers = response.headers
+            try:
+                delay = float(headers.get("retry-after")) if headers.get("retry-after") else None
+            except ValueError:
+                delay = None
+            if delay is None and isinstance(error, RateLimitError):
+                delay = max(filter(None, (
+                    _parse_reset(headers.get("anthropic-ratelimit-requests-reset")),
+                    _parse_reset(headers.get("anthropic-ratelimit-input-tokens-reset")),
+                    _parse_reset(headers.get("anthropic-ratelimit-output-tokens-reset")),
+                )), default=None)
+        if delay is None:
+            # Exponencial con "full jitter"
+            delay = random.uniform(0, min(self.max_backoff, 2 ** attempt))
+        delay = min(delay, self.max_backoff)
+
+        self.stats["retries"] += 1
+        if isinstance(error, RateLimitError):
+            self.stats["rate_limited"] += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        return delay
+
+    def get_stats(self) -> Dict[str, Any]:
+        for bucket in (self.requests, self.input_tokens, self.output_tokens):
+            bucket.refill()
+        return {
+            **self.stats,
+            "delay_s": round(self.stats["delay_s"], 2),
+            "requests_remaining": self.requests.remaining,
+            "input_tokens_remaining": self.input_tokens.remaining,
+            "output_tokens_remaining": self.output_tokens.remaining,
+        }
@@ -0,0 +1,160 @@
+import os
+import queue
+import asyncio
+import logging
+import threading
+from pathlib import Path
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Any, Optional, BinaryIO
+
+logger = logging.getLogger(__name__)
+
+# Operaciones en cola como máximo; con la cola llena quien guarda espera (sin bloquear el loop)
+# en vez de acumular memoria sin límite si el disco va lento
+MAX_PENDING = 256
+
+
+class _Op:
+    __slots__ = ("kind", "path", "render", "on_error", "loop")
+
+    def __init__(self, kind: str, path: Optional[Path], render, on_error: Optional[Callable[[Exception], None]]):
+        self.kind = kind
+        self.path = path
+        self.render = render
+        self.on_error = on_error
+        self.loop = asyncio.get_running_loop()
+
+
+class SessionWriter:
+    """
+    Hilo que escribe los logs de sesión fuera del event loop, así un fsync lento o la
+    reescritura de un log grande no congelan la interfaz ni el tráfico MCP. Las operaciones se
+    ejecutan en orden de llegada; cada vez que el hilo despierta toma todo lo pendiente y lo
+    agrupa por archivo: varios append seguidos van en un único write + fsync, y una reescritura
+    completa descarta lo anterior del mismo archivo (quien la pide ya incluye esos datos).
+
+    La serialización también ocurre en el hilo: render se llama allí, no en el loop.
+    """
+
+    def __init__(self, max_pending: int = MAX_PENDING):
+        self._queue: "queue.Queue[_Op]" = queue.Queue(max_pending)
+        self._thread: Optional[threading.Thread] = None
+        self._thread_lock = threading.Lock()
+        self.stats: Dict[str, int] = {"ops": 0, "writes": 0, "coalesced": 0, "bytes": 0, "errors": 0,
+                                      "backpressure": 0}
+
+    async def append(self, path: Path, render: Callable[[], bytes],
+                     on_error: Optional[Callable[[Exception], None]] = None) -> None:
+        """Añade al final de `path` los bytes que devuelva render()."""
+        await self._submit(_Op("append", path, render, on_error))
+
+    async def replace(self, path: Path, render: Callable[[BinaryIO], None],
+                      on_error: Optional[Callable[[Exception], None]] = None) -> None:
+        """Reescribe `path` de forma atómica: render(f) escribe el contenido en un temporal."""
+        await self._submit(_Op("replace", path, render, on_error))
+
+    async def flush(self) -> None:
+        """Espera a que todo lo encolado hasta ahora esté en disco."""
+        done: Future = Future()
+        await self._submit(_Op("flush", None, done, None))
+        await asyncio.wrap_future(done)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "pending": self._queue.qsize()}
+
+    async def _submit(self, op: _Op) -> None:
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(op)
+        except queue.Full:
+            self.stats["backpressure"] += 1
+            await asyncio.to_thread(self._queue.put, op)
+
+    def _ensure_thread(self) -> None:
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="session-writer", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            ops = [self._queue.get()]
+            while True:
+                try:
+                    ops.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._process(ops)
+            except Exception:
+                logger.exception("Session writer failed")
+
+    def _process(self, ops: List[_Op]) -> None:
+        plan: Dict[Path, List[_Op]] = {}
+        flushes: List[Future] = []
+        for op in ops:
+            if op.kind == "flush":
+                flushes.append(op.render)
+                continue
+            self.stats["ops"] += 1
+            pending = plan.setdefault(op.path, [])
+            if op.kind == "replace":
+                self.stats["coalesced"] += len(pending)
+                pending.clear()
+            pending.append(op)
+
+        for path, pending in plan.items():
+            i = 0
+            while i < len(pending):
+                if pending[i].kind == "replace":
+                    batch = pending[i:i + 1]
+                else:
+                    j = i
+                    while j < len(pending) and pending[j].kind == "append":
+                        j += 1
+                    batch = pending[i:j]
+                i += len(batch)
+                try:
+                    if batch[0].kind == "replace":
+                        self._replace(path, batch[0].render)
+                    else:
+                        self._append(path, b"".join(op.render() for op in batch))
+                        self.stats["coalesced"] += len(batch) - 1
+                    self.stats["writes"] += 1
+                except Exception as e:
+                    self.stats["errors"] += 1
+                    logger.error(f"Failed to write {path}: {e}")
+                    self._notify(batch, e)
+
+        for done in flushes:
+            done.set_result(None)
+
+    def _append(self, path: Path, payload: bytes) -> None:
+        # Una línea a medio escribir se descarta al cargar
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "ab") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        self.stats["bytes"] += len(payload)
+
+    def _replace(self, path: Path, render: Callable[[BinaryIO], None]) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = path.with_name(path.name + ".tmp")
+        with open(tmp_file, "wb") as f:
+            render(f)
+            f.flush()
+            os.fsync(f.fileno())
+            self.stats["bytes"] += f.tell()
+        os.replace(tmp_file, path)
+
+    @staticmethod
+    def _notify(batch: List[_Op], error: Exception) -> None:
+        for op in batch:
+            if op.on_error is None:
+                continue
+            try:
+                op.loop.call_soon_threadsafe(op.on_error, error)
+            except RuntimeError:
+                # El loop ya se cerró
+                pass
@@ -0,0 +1,18 @@
+import pytest
+
+import claude_bot
+from fakes import FakeAnthropic
+from rate_limiter import RateLimitScheduler
+
+
+@pytest.fixture
+def fake_anthropic(monkeypatch):
+    """Instala un FakeAnthropic como cliente de claude_bot y un scheduler sin esperas."""
+    def install(*scripts) -> FakeAnthropic:
+        client = FakeAnthropic(*scripts)
+        monkeypatch.setattr(claude_bot, "client", client)
+        return client
+
+    monkeypatch.setattr(claude_bot, "scheduler", RateLimitScheduler(max_backoff=0.0))
+    monkeypatch.setattr(claude_bot, "speculation_stats", {"started": 0, "used": 0, "discarded": 0})
+    return install
@@ -0,0 +1,85 @@
+"""Dobles de prueba del cliente de Anthropic para los tests de claude_bot."""
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+from anthropic._exceptions import InternalServerError
+from anthropic.types import TextBlock, ToolUseBlock
+
+_REQUEST = httpx.Request("POST", "https://api.anthropic.com/v1/messages")
+
+
+def text(value: str):
+    return ("text", value)
+
+
+def tool_use(block_id: str, name: str, arguments: dict):
+    return ("tool_use", ToolUseBlock(type="tool_use", id=block_id, name=name, input=arguments))
+
+
+def wait(event: asyncio.Event):
+    """El stream se detiene hasta que `event` se active (p.ej. hasta que empiece una tool)."""
+    return ("wait", event)
+
+
+def error(exc: BaseException):
+    return ("error", exc)
+
+
+def overloaded():
+    return InternalServerError("overloaded", response=httpx.Response(529, request=_REQUEST), body=None)
+
+
+class _Stream:
+    def __init__(self, steps):
+        self._steps = steps
+        self._content = []
+        self.response = SimpleNamespace(headers=httpx.Headers())
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def __aiter__(self):
+        for kind, value in self._steps:
+            if kind == "error":
+                raise value
+            if kind == "wait":
+                await value.wait()
+            elif kind == "text":
+                self._content.append(TextBlock(type="text", text=value))
+                delta = SimpleNamespace(type="text_delta", text=value)
+                yield SimpleNamespace(type="content_block_delta", delta=delta)
+            elif kind == "tool_use":
+                self._content.append(value)
+                # Como la API: el input llega por deltas, el bloque completo en content_block_stop
+                yield SimpleNamespace(type="content_block_start", content_block=SimpleNamespace(
+                    type="tool_use", id=value.id, name=value.name, input={}))
+                yield SimpleNamespace(type="content_block_stop", content_block=value)
+
+    async def get_final_message(self):
+        stop_reason = "tool_use" if any(b.type == "tool_use" for b in self._content) else "end_turn"
+        return SimpleNamespace(content=self._content, stop_reason=stop_reason,
+                               usage=SimpleNamespace(input_tokens=10, output_tokens=5))
+
+
+class FakeAnthropic:
+    """
+    Cliente con respuestas guionizadas: cada petición consume el siguiente guion, una lista de
+    pasos text(), tool_use(), wait() o error(), que lanza la excepción en ese punto del stream.
+    """
+
+    def __init__(self, *scripts):
+        self.scripts = list(scripts)
+        self.requests = []
+        self.messages = self
+
+    def stream(self, **kwargs):
+        self.requests.append(kwargs)
+        return _Stream(self.scripts.pop(0))
+
+
+async def collect(stream) -> str:
+    return "".join([chunk async for chunk in stream])
@@ -0,0 +1,36 @@
+import asyncio
+
+from claude_bot import ChatSession
+from fakes import collect, error, overloaded, text
+
+
+def _session() -> ChatSession:
+    session = ChatSession("test", None)
+    session.summarize = False
+    return session
+
+
+def test_error_before_any_text_is_retried(fake_anthropic):
+    client = fake_anthropic([error(overloaded())], [text("Hello"), text(" there")])
+    session = _session()
+
+    output = asyncio.run(collect(session.send_message_stream("hi")))
+
+    assert len(client.requests) == 2
+    assert output.startswith("\n[InternalServerError, retrying in")
+    assert output.endswith("Hello there")
+    assert session.history[-1].content == "Hello there"
+    assert session.last_error is None
+
+
+def test_error_after_text_is_not_retried(fake_anthropic):
+    client = fake_anthropic([text("Hel"), error(overloaded())], [text("Hello")])
+    session = _session()
+
+    output = asyncio.run(collect(session.send_message_stream("hi")))
+
+    # La respuesta parcial no va seguida de una segunda respuesta completa
+    assert len(client.requests) == 1
+    assert output.startswith("Hel\nAPI error:")
+    assert "retrying" not in output
+    assert session.last_error is not None
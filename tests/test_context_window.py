@@ -0,0 +1,117 @@
+from datetime import datetime
+
+import claude_bot
+from claude_bot import ChatMessage, ChatSession
+
+WHEN = datetime(2024, 1, 1)
+
+
+def _text_turn(i: int, size: int = 36) -> list:
+    # Cada mensaje cuesta size // CHARS_PER_TOKEN + MESSAGE_OVERHEAD_TOKENS tokens estimados
+    return [ChatMessage(role="user", content=f"{i:02d}" + "q" * (size - 2), timestamp=WHEN),
+            ChatMessage(role="assistant", content=f"{i:02d}" + "a" * (size - 2), timestamp=WHEN)]
+
+
+def _tool_turn(i: int) -> list:
+    return [
+        ChatMessage(role="user", content=f"question {i}", timestamp=WHEN),
+        ChatMessage(role="assistant", timestamp=WHEN,
+                    content=[{"type": "tool_use", "id": f"t{i}", "name": "data__lookup", "input": {"q": i}}]),
+        ChatMessage(role="user", timestamp=WHEN,
+                    content=[{"type": "tool_result", "tool_use_id": f"t{i}", "content": "r" * 200}]),
+        ChatMessage(role="assistant", content=f"answer {i}", timestamp=WHEN),
+    ]
+
+
+def _session(*turns, budget: int) -> ChatSession:
+    session = ChatSession("test", None)
+    session.summarize = False
+    session.context_token_budget = budget
+    for turn in turns:
+        session.history.extend(turn)
+    return session
+
+
+def test_older_turns_are_dropped_to_fit_the_budget():
+    # 13 tokens por mensaje, 26 por turno: caben tres turnos en 80
+    session = _session(*(_text_turn(i) for i in range(10)), budget=80)
+
+    selected, used = session._select_turns()
+
+    assert [m.content[:2] for m in selected] == ["07", "07", "08", "08", "09", "09"]
+    assert used == 78
+    assert session.prepare_messages_for_api()[0]["role"] == "user"
+    assert session.last_turn_usage["context_messages"] == 6
+
+
+def test_the_current_turn_is_kept_even_over_budget():
+    session = _session(_text_turn(0), [ChatMessage(role="user", content="x" * 4000, timestamp=WHEN)], budget=50)
+
+    selected, used = session._select_turns()
+
+    assert [m.content for m in selected] == ["x" * 4000]
+    assert used > 50
+
+
+def test_tool_use_and_its_result_stay_together():
+    turns = [_tool_turn(i) for i in range(6)]
+    cost = sum(claude_bot.estimate_tokens(m) for m in turns[0])
+
+    for budget in range(cost, 6 * cost, 7):
+        messages = _session(*turns, budget=budget).prepare_messages_for_api()
+
+        assert messages[0]["role"] == "user" and isinstance(messages[0]["content"], str)
+        ids_used = [b["id"] for m in messages if isinstance(m["content"], list)
+                    for b in m["content"] if b["type"] == "tool_use"]
+        ids_answered = [b["tool_use_id"] for m in messages if isinstance(m["content"], list)
+                        for b in m["content"] if b["type"] == "tool_result"]
+        assert ids_used == ids_answered
+
+
+
+def test_compact_tool_output_keeps_text_and_marks_the_rest():
+    content = [{"type": "text", "text": "a" * 8}, {"type": "image", "source": {}}, {"type": "text", "text": "b" * 8}]
+
+    assert claude_bot._compact_tool_output("short", 10) == "short"
+    assert claude_bot._compact_tool_output(content, 100) == "a" * 8 + "\n[image omitted]\n" + "b" * 8
+    assert claude_bot._compact_tool_output(content, 5) == (
+        "aaaaa\n[28 more characters of this earlier tool output omitted]")
+
+
+def _tool_outputs(messages) -> list:
+    return [b["content"] for m in messages if isinstance(m["content"], list)
+            for b in m["content"] if b["type"] == "tool_result"]
+
+
+def test_only_old_tool_output_is_trimmed(monkeypatch):
+    monkeypatch.setattr(claude_bot, "compacted_tool_output_chars", 10)
+    session = _session(*(_tool_turn(i) for i in range(7)), budget=100_000)
+    session.tool_output_turns = 2
+
+    outputs = _tool_outputs(session.prepare_messages_for_api())
+
+    # La frontera avanza de 2 en 2 turnos: con 7 turnos se recortan los 4 primeros
+    assert [len(o) for o in outputs] == [len(outputs[0])] * 4 + [200] * 3
+    assert outputs[0].startswith("r" * 10 + "\n[190 more")
+    # El historial guarda la salida entera
+    assert session.history[2].content[0]["content"] == "r" * 200
+
+
+def test_trimmed_prefix_is_stable_between_turns(monkeypatch):
+    monkeypatch.setattr(claude_bot, "compacted_tool_output_chars", 10)
+    session = _session(*(_tool_turn(i) for i in range(6)), budget=100_000)
+    session.tool_output_turns = 2
+
+    before = session.prepare_messages_for_api()
+    session.history.extend(_tool_turn(6))
+    after = session.prepare_messages_for_api()
+
+    # Un turno nuevo no mueve la frontera: los mensajes anteriores se envían igual
+    assert after[:len(before)] == before
+
+
+def test_zero_tool_output_turns_sends_everything_whole():
+    session = _session(*(_tool_turn(i) for i in range(6)), budget=100_000)
+    session.tool_output_turns = 0
+
+    assert _tool_outputs(session.prepare_messages_for_api()) == ["r" * 200] * 6
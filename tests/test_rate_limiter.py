@@ -0,0 +1,113 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import httpx
+import pytest
+from anthropic._exceptions import APIConnectionError, BadRequestError, InternalServerError, RateLimitError
+
+import rate_limiter
+from rate_limiter import RateLimitScheduler, _parse_reset
+
+_REQUEST = httpx.Request("POST", "https://api.anthropic.com/v1/messages")
+
+
+def _error(cls, status: int, headers=None):
+    return cls("error", response=httpx.Response(status, headers=headers or {}, request=_REQUEST), body=None)
+
+
+def _in(seconds: float) -> str:
+    return (datetime.now(timezone.utc) + timedelta(seconds=seconds)).isoformat().replace("+00:00", "Z")
+
+
+def test_parse_reset():
+    assert _parse_reset(_in(30)) == pytest.approx(30, abs=1)
+    # Un reset ya pasado no da esperas negativas
+    assert _parse_reset(_in(-30)) == 0.0
+    assert _parse_reset(None) is None
+    assert _parse_reset("soon") is None
+
+
+def test_retry_after_header_wins():
+    scheduler = RateLimitScheduler()
+    error = _error(RateLimitError, 429, {"retry-after": "7",
+                                         "anthropic-ratelimit-requests-reset": _in(30)})
+
+    assert scheduler.retry_delay(error, 1) == 7.0
+
+
+def test_rate_limit_without_retry_after_uses_the_latest_reset():
+    scheduler = RateLimitScheduler()
+    error = _error(RateLimitError, 429, {"anthropic-ratelimit-requests-reset": _in(5),
+                                         "anthropic-ratelimit-input-tokens-reset": _in(20)})
+
+    assert scheduler.retry_delay(error, 1) == pytest.approx(20, abs=1)
+
+
+def test_rate_limit_pauses_every_request(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(rate_limiter.time, "monotonic", lambda: now[0])
+    scheduler = RateLimitScheduler()
+
+    scheduler.retry_delay(_error(RateLimitError, 429, {"retry-after": "5"}), 1)
+
+    assert scheduler._paused_until == 105.0
+    assert scheduler.get_stats()["rate_limited"] == 1
+
+
+def test_delays_are_capped_by_max_backoff():
+    scheduler = RateLimitScheduler(max_backoff=10.0)
+
+    assert scheduler.retry_delay(_error(RateLimitError, 429, {"retry-after": "600"}), 1) == 10.0
+
+
+def test_transient_errors_back_off_with_jitter(monkeypatch):
+    monkeypatch.setattr(rate_limiter.random, "uniform", lambda low, high: high)
+    scheduler = RateLimitScheduler(max_backoff=10.0)
+    error = _error(InternalServerError, 529)
+
+    assert [scheduler.retry_delay(error, attempt) for attempt in (1, 2, 3, 4)] == [2, 4, 8, 10.0]
+    assert scheduler.retry_delay(APIConnectionError(request=_REQUEST), 1) == 2
+
+
+def test_non_retryable_errors_and_exhausted_retries():
+    scheduler = RateLimitScheduler(max_retries=2)
+
+    assert scheduler.retry_delay(_error(BadRequestError, 400), 1) is None
+    assert scheduler.retry_delay(ValueError("bug"), 1) is None
+    assert scheduler.retry_delay(_error(InternalServerError, 500), 3) is None
+    assert scheduler.get_stats()["retries"] == 0
+
+
+def test_headers_update_the_budget_minus_reservations(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(rate_limiter.time, "monotonic", lambda: now[0])
+    scheduler = RateLimitScheduler()
+
+    async def run():
+        await scheduler.acquire(100)
+        await scheduler.acquire(100)
+
+    asyncio.run(run())
+    scheduler.release(100, httpx.Headers({
+        "anthropic-ratelimit-requests-limit": "60",
+        "anthropic-ratelimit-requests-remaining": "10",
+        "anthropic-ratelimit-input-tokens-limit": "6000",
+        "anthropic-ratelimit-input-tokens-remaining": "1000",
+    }))
+
+    # La otra petición sigue reservada y el servidor aún no la ha descontado
+    assert scheduler.requests.remaining == 9
+    assert scheduler.input_tokens.remaining == 900
+    # Sin saldo para 1000 tokens: faltan 100 a 100 tokens/s
+    assert scheduler.input_tokens.wait_time(1000) == pytest.approx(1.0)
+    now[0] += 1.0
+    assert scheduler.input_tokens.wait_time(1000) == 0.0
+
+
+def test_requests_larger_than_the_limit_wait_for_a_full_bucket(monkeypatch):
+    monkeypatch.setattr(rate_limiter.time, "monotonic", lambda: 0.0)
+    scheduler = RateLimitScheduler()
+    scheduler.release(0, {"anthropic-ratelimit-input-tokens-limit": "600",
+                          "anthropic-ratelimit-input-tokens-remaining": "0"})
+
+    assert scheduler.input_tokens.wait_time(10_000) == pytest.approx(60.0)
@@ -0,0 +1,181 @@
+import re
+import asyncio
+
+import pytest
+from mcp import types
+
+import mcp_manager
+from mcp_manager import MCPHub, MCPServerConfig
+
+
+class FakeSession:
+    """Sesión MCP mínima: cuenta las llamadas y devuelve el nombre de la tool y sus argumentos."""
+
+    def __init__(self, is_error: bool = False):
+        self.calls = []
+        self.is_error = is_error
+
+    async def call_tool(self, tool_name, arguments, **kwargs):
+        self.calls.append((tool_name, arguments))
+        text = f"{tool_name} {sorted((arguments or {}).items())}"
+        return types.CallToolResult(content=[types.TextContent(type="text", text=text)], isError=self.is_error)
+
+
+def _hub(**servers) -> MCPHub:
+    hub = MCPHub()
+    for name, session in servers.items():
+        hub._server_configs[name] = MCPServerConfig(
+            name=name, command="unused", cacheable_tools=["get", "list"], read_only_tools=["stat"],
+        )
+        hub.sessions[name] = session
+    return hub
+
+
+def test_repeated_call_is_served_from_cache():
+    session = FakeSession()
+    hub = _hub(data=session)
+
+    async def run():
+        first = await hub.call_tool("data", "get", {"id": 1, "full": True})
+        # Mismos argumentos en otro orden: misma clave
+        second = await hub.call_tool("data", "get", {"full": True, "id": 1})
+        return first, second
+
+    first, second = asyncio.run(run())
+
+    assert first == second
+    assert len(session.calls) == 1
+    stats = hub.get_result_cache_stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 1, 1)
+
+
+def test_different_arguments_miss():
+    session = FakeSession()
+    hub = _hub(data=session)
+
+    async def run():
+        await hub.call_tool("data", "get", {"id": 1})
+        await hub.call_tool("data", "get", {"id": 2})
+
+    asyncio.run(run())
+
+    assert len(session.calls) == 2
+
+
+def test_tools_not_listed_are_not_cached():
+    session = FakeSession()
+    hub = _hub(data=session)
+
+    async def run():
+        await hub.call_tool("data", "stat", {})
+        await hub.call_tool("data", "stat", {})
+
+    asyncio.run(run())
+
+    assert len(session.calls) == 2
+    assert hub.get_result_cache_stats()["entries"] == 0
+
+
+def test_error_results_are_not_cached():
+    session = FakeSession(is_error=True)
+    hub = _hub(data=session)
+
+    async def run():
+        await hub.call_tool("data", "get", {})
+        await hub.call_tool("data", "get", {})
+
+    asyncio.run(run())
+
+    assert len(session.calls) == 2
+
+
+def test_disabled_cache_always_calls_the_server():
+    session = FakeSession()
+    hub = _hub(data=session)
+    hub.configure_result_cache(enabled=False)
+
+    async def run():
+        await hub.call_tool("data", "get", {})
+        await hub.call_tool("data", "get", {})
+
+    asyncio.run(run())
+
+    assert len(session.calls) == 2
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    hub = _hub(data=FakeSession())
+    hub._server_configs["data"].cache_ttl = 10.0
+    now = [1000.0]
+    monkeypatch.setattr(mcp_manager.time, "monotonic", lambda: now[0])
+    key = hub._cache_key("data", "get", {})
+
+    hub._cache_put(key, [{"type": "text", "text": "value"}])
+    now[0] += 9.0
+    assert hub._cache_get(key) is not None
+    now[0] += 2.0
+    assert hub._cache_get(key) is None
+    assert hub.get_result_cache_stats()["bytes"] == 0
+
+
+def test_least_recently_used_entry_is_evicted_first():
+    hub = _hub(data=FakeSession())
+    value = [{"type": "text", "text": "x" * 100}]
+    size = len(str(value).encode("utf-8"))
+    hub.configure_result_cache(max_bytes=size * 2)
+    a, b, c = (hub._cache_key("data", "get", {"id": i}) for i in range(3))
+
+    hub._cache_put(a, value)
+    hub._cache_put(b, value)
+    hub._cache_get(a)
+    hub._cache_put(c, value)
+
+    assert hub._cache_get(b) is None
+    assert hub._cache_get(a) is not None
+    assert hub._cache_get(c) is not None
+    assert hub.get_result_cache_stats()["evictions"] == 1
+
+
+def test_results_larger_than_the_cache_are_skipped():
+    hub = _hub(data=FakeSession())
+    hub.configure_result_cache(max_bytes=10)
+    key = hub._cache_key("data", "get", {})
+
+    hub._cache_put(key, [{"type": "text", "text": "x" * 100}])
+
+    assert hub.get_result_cache_stats()["entries"] == 0
+
+
+@pytest.mark.parametrize("tool, invalidates", [("write", True), ("stat", False), ("list", False)])
+def test_only_mutating_calls_invalidate_the_server_cache(tool, invalidates):
+    data, other = FakeSession(), FakeSession()
+    hub = _hub(data=data, other=other)
+
+    async def run():
+        await hub.call_tool("data", "get", {})
+        await hub.call_tool("other", "get", {})
+        await hub.call_tool("data", tool, {})
+        await hub.call_tool("data", "get", {})
+        await hub.call_tool("other", "get", {})
+
+    asyncio.run(run())
+
+    assert data.calls.count(("get", {})) == (2 if invalidates else 1)
+    # La caché de otros servidores no se toca
+    assert len(other.calls) == 1
+
+
+def test_cache_hits_get_handles_of_the_calling_conversation():
+    hub = _hub(data=FakeSession())
+    hub.configure_tool_results(max_bytes=4)
+
+    async def run():
+        first = await hub.call_tool("data", "get", {"id": 1}, owner="alice")
+        second = await hub.call_tool("data", "get", {"id": 1}, owner="bob")
+        return first, second
+
+    first, second = asyncio.run(run())
+
+    assert hub.get_result_cache_stats()["hits"] == 1
+    handles = [re.search(r'handle="([^"]+)"', blocks[-1]["text"]).group(1) for blocks in (first, second)]
+    assert [hub._stored_results[h][0] for h in handles] == ["alice", "bob"]
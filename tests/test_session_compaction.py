@@ -0,0 +1,102 @@
+import asyncio
+import json
+from datetime import datetime
+
+import claude_bot
+from claude_bot import ChatMessage, ChatSession
+
+
+def _turn(i: int, output: str) -> list:
+    when = datetime(2024, 1, 1)
+    return [
+        ChatMessage(role="user", content=f"question {i}", timestamp=when),
+        ChatMessage(role="assistant", timestamp=when,
+                    content=[{"type": "tool_use", "id": f"t{i}", "name": "lookup", "input": {}}]),
+        ChatMessage(role="user", timestamp=when,
+                    content=[{"type": "tool_result", "tool_use_id": f"t{i}", "content": output}]),
+        ChatMessage(role="assistant", content=f"answer {i}", timestamp=when),
+    ]
+
+
+def _session(path, turns: int, output: str) -> ChatSession:
+    session = ChatSession("test", path)
+    session.summarize = False
+    session.tool_output_turns = 1
+    for i in range(turns):
+        session.history.extend(_turn(i, output))
+    return session
+
+
+async def _save(session: ChatSession):
+    await session.save()
+    await claude_bot.writer.flush()
+
+
+def _tool_outputs(path) -> list:
+    outputs = []
+    for line in path.read_bytes().splitlines():
+        record = json.loads(line)
+        if isinstance(record["content"], list) and record["content"][0]["type"] == "tool_result":
+            outputs.append(record["content"][0]["content"])
+    return outputs
+
+
+def test_compacting_compacted_output_changes_nothing():
+    once = claude_bot._compact_tool_output("x" * 50, 10)
+
+    assert once.startswith("x" * 10)
+    assert claude_bot._compact_tool_output(once, 10) == once
+
+
+def test_large_log_is_rewritten_with_old_tool_output_cut(tmp_path, monkeypatch):
+    monkeypatch.setattr(claude_bot, "compacted_tool_output_chars", 10)
+    path = tmp_path / "s.jsonl"
+    session = _session(path, 4, "y" * 500)
+    asyncio.run(_save(session))
+    size = path.stat().st_size
+
+    session.compact_log_bytes = size - 1
+    session.history.extend(_turn(4, "z"))
+    asyncio.run(_save(session))
+
+    outputs = _tool_outputs(path)
+    # Los dos últimos turnos (2 * tool_output_turns) conservan la salida entera
+    assert [len(o) for o in outputs[:3]] == [len(outputs[0])] * 3
+    assert outputs[0].startswith("y" * 10) and len(outputs[0]) < 100
+    assert outputs[3:] == ["y" * 500, "z"]
+    assert path.stat().st_size < size
+    assert len(session.history) == 20
+    assert session._persisted_count == 20
+    # El contexto que se envía es el mismo que sin compactar (el prefijo cacheado sigue valiendo)
+    uncompacted = _session(None, 4, "y" * 500)
+    uncompacted.history.extend(_turn(4, "z"))
+    assert session.prepare_messages_for_api() == uncompacted.prepare_messages_for_api()
+
+
+def test_log_under_the_threshold_is_only_appended(tmp_path, monkeypatch):
+    monkeypatch.setattr(claude_bot, "compacted_tool_output_chars", 10)
+    path = tmp_path / "s.jsonl"
+    session = _session(path, 4, "y" * 500)
+    asyncio.run(_save(session))
+
+    session.compact_log_bytes = path.stat().st_size
+    session.history.extend(_turn(4, "z"))
+    asyncio.run(_save(session))
+
+    assert _tool_outputs(path) == ["y" * 500] * 4 + ["z"]
+
+
+def test_log_must_double_before_the_next_compaction(tmp_path, monkeypatch):
+    monkeypatch.setattr(claude_bot, "compacted_tool_output_chars", 10)
+    path = tmp_path / "s.jsonl"
+    session = _session(path, 1, "y")
+    asyncio.run(_save(session))
+    session.compact_log_bytes = 1
+
+    assert session._log_too_large()
+    size = path.stat().st_size
+    assert session._compacted_log_bytes == size
+    assert not session._log_too_large()
+    with open(path, "ab") as f:
+        f.write(b" " * (size + 1))
+    assert session._log_too_large()
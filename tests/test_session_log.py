@@ -0,0 +1,130 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+import claude_bot
+from claude_bot import ChatMessage, ChatSession
+
+
+def _message(i: int) -> ChatMessage:
+    return ChatMessage(role="user" if i % 2 == 0 else "assistant", content=f"message {i}",
+                       timestamp=datetime(2024, 1, 1))
+
+
+def _write_log(path, count: int) -> list:
+    """Escribe `count` mensajes y devuelve el offset de inicio de cada línea."""
+    offsets = []
+    with open(path, "wb") as f:
+        for i in range(count):
+            offsets.append(f.tell())
+            f.write(claude_bot._message_to_record(_message(i)) + b"\n")
+    return offsets
+
+
+@pytest.fixture(autouse=True)
+def small_blocks(monkeypatch):
+    # Bloques pequeños para que las lecturas crucen varios bloques con archivos de prueba
+    monkeypatch.setattr(claude_bot, "_READ_BLOCK", 64)
+
+
+def test_tail_reader_returns_last_lines_and_their_offset(tmp_path):
+    path = tmp_path / "s.jsonl"
+    offsets = _write_log(path, 30)
+
+    prefix_bytes, lines = claude_bot._read_tail_lines(path, 5)
+
+    assert prefix_bytes == offsets[25]
+    assert [m.content for m in claude_bot._parse_lines(lines, path)] == [f"message {i}" for i in range(25, 30)]
+
+
+def test_tail_reader_with_short_file_returns_everything(tmp_path):
+    path = tmp_path / "s.jsonl"
+    _write_log(path, 3)
+
+    prefix_bytes, lines = claude_bot._read_tail_lines(path, 10)
+
+    assert prefix_bytes == 0
+    assert len(lines) == 3
+
+
+def test_tail_reader_on_empty_file(tmp_path):
+    path = tmp_path / "s.jsonl"
+    path.write_bytes(b"")
+
+    assert claude_bot._read_tail_lines(path, 10) == (0, [])
+
+
+def test_torn_record_is_truncated(tmp_path):
+    path = tmp_path / "s.jsonl"
+    _write_log(path, 4)
+    size = path.stat().st_size
+    with open(path, "ab") as f:
+        f.write(b'{"role": "user", "content": "interrupted wr')
+
+    prefix_bytes, lines = claude_bot._read_tail_lines(path, 10)
+
+    assert prefix_bytes == 0
+    assert len(lines) == 4
+    assert path.stat().st_size == size
+
+
+def test_torn_only_record_truncates_to_empty(tmp_path):
+    path = tmp_path / "s.jsonl"
+    path.write_bytes(b'{"role": "us')
+
+    assert claude_bot._read_tail_lines(path, 10) == (0, [])
+    assert path.stat().st_size == 0
+
+
+def test_load_keeps_only_the_tail_in_memory(tmp_path, monkeypatch):
+    monkeypatch.setattr(claude_bot, "load_window", 10)
+    path = tmp_path / "s.jsonl"
+    offsets = _write_log(path, 50)
+    session = ChatSession("test", path)
+
+    asyncio.run(session.load())
+
+    assert [m.content for m in session.history] == [f"message {i}" for i in range(40, 50)]
+    assert session._prefix_bytes == offsets[40]
+
+
+def test_offset_index_and_paged_reads(tmp_path, monkeypatch):
+    monkeypatch.setattr(claude_bot, "load_window", 10)
+    path = tmp_path / "s.jsonl"
+    offsets = _write_log(path, 50)
+    session = ChatSession("test", path)
+    asyncio.run(session.load())
+
+    assert list(session._build_older_index()) == offsets[:40]
+    assert session.total_messages() == 50
+    assert [m.content for m in session.get_messages(0, 3)] == ["message 0", "message 1", "message 2"]
+    # Una página que cruza el límite entre el disco y la memoria
+    assert [m.content for m in session.get_messages(38, 42)] == [f"message {i}" for i in range(38, 42)]
+    assert len(session.get_messages(45)) == 5
+
+
+def test_stats_count_messages_still_on_disk(tmp_path, monkeypatch):
+    monkeypatch.setattr(claude_bot, "load_window", 10)
+    path = tmp_path / "s.jsonl"
+    _write_log(path, 50)
+    session = ChatSession("test", path)
+    asyncio.run(session.load())
+
+    older = session._get_older_stats()
+
+    assert older == {"total": 40, "user": 20, "assistant": 20}
+
+
+def test_clear_drops_the_index(tmp_path, monkeypatch):
+    monkeypatch.setattr(claude_bot, "load_window", 10)
+    path = tmp_path / "s.jsonl"
+    _write_log(path, 50)
+    session = ChatSession("test", path)
+    asyncio.run(session.load())
+    session._build_older_index()
+
+    session.clear()
+
+    assert session.total_messages() == 0
+    assert session.get_messages(0) == []
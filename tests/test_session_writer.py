@@ -0,0 +1,91 @@
+import asyncio
+import threading
+
+from session_writer import SessionWriter
+
+
+def _line(text: str):
+    return lambda: text.encode() + b"\n"
+
+
+def _content(text: str):
+    return lambda f: f.write(text.encode() + b"\n")
+
+
+async def _hold(writer: SessionWriter, tmp_path) -> threading.Event:
+    """Deja el hilo ocupado en otra escritura: lo que se encole después se procesa en un solo lote."""
+    release, started = threading.Event(), threading.Event()
+
+    def render() -> bytes:
+        started.set()
+        release.wait(5)
+        return b""
+
+    await writer.append(tmp_path / "gate", render)
+    await asyncio.to_thread(started.wait, 5)
+    return release
+
+
+def test_replace_drops_appends_queued_before_it_and_keeps_later_ones(tmp_path):
+    path = tmp_path / "s.jsonl"
+    path.write_bytes(b"old\n")
+    writer = SessionWriter()
+
+    async def run():
+        release = await _hold(writer, tmp_path)
+        await writer.append(path, _line("dropped"))
+        await writer.replace(path, _content("rewritten"))
+        await writer.append(path, _line("after 1"))
+        await writer.append(path, _line("after 2"))
+        release.set()
+        await writer.flush()
+
+    asyncio.run(run())
+
+    assert path.read_text() == "rewritten\nafter 1\nafter 2\n"
+    # El append anterior al replace y los dos posteriores (un único write) se agrupan
+    assert writer.stats["coalesced"] == 2
+    assert writer.stats["writes"] == 3
+
+
+def test_flush_waits_for_everything_queued(tmp_path):
+    writer = SessionWriter()
+    paths = [tmp_path / f"s{i}.jsonl" for i in range(3)]
+
+    async def run():
+        release = await _hold(writer, tmp_path)
+        for i in range(20):
+            await writer.append(paths[i % 3], _line(str(i)))
+        await writer.replace(tmp_path / "summary.json", _content("{}"))
+        release.set()
+        await writer.flush()
+
+    asyncio.run(run())
+
+    for n, path in enumerate(paths):
+        assert path.read_text().split() == [str(i) for i in range(n, 20, 3)]
+    assert (tmp_path / "summary.json").read_text() == "{}\n"
+    assert not (tmp_path / "summary.json.tmp").exists()
+    assert writer.get_stats()["pending"] == 0
+
+
+def test_failed_write_reports_to_its_caller_and_later_writes_go_on(tmp_path):
+    path = tmp_path / "s.jsonl"
+    writer = SessionWriter()
+    errors = []
+
+    def broken(f):
+        raise OSError("disk full")
+
+    async def run():
+        await writer.replace(path, broken, errors.append)
+        await writer.append(path, _line("next"))
+        await writer.flush()
+        # on_error se programa en el loop de quien escribió
+        await asyncio.sleep(0)
+
+    asyncio.run(run())
+
+    assert [str(e) for e in errors] == ["disk full"]
+    assert path.read_text() == "next\n"
+    assert writer.stats["errors"] == 1
@@ -0,0 +1,112 @@
+import asyncio
+from datetime import timedelta
+
+from mcp import types
+from mcp.shared.exceptions import McpError
+
+import claude_bot
+from claude_bot import ChatSession
+from fakes import collect, error, overloaded, text, tool_use, wait
+from mcp_manager import MCPHub, MCPServerConfig
+
+
+class FakeSession:
+    """
+    Sesión MCP que registra las llamadas, las cancelaciones y los notifications/cancelled.
+    Las llamadas cuyo número está en `hang` no terminan hasta que se cancelan.
+    """
+
+    def __init__(self, hang=(), fail=None):
+        self.calls = []
+        self.cancelled = []
+        self.notifications = []
+        self.hang = set(hang)
+        self.fail = fail
+        self.started = asyncio.Event()
+        # Como ClientSession: id de la próxima petición
+        self._request_id = 0
+
+    async def call_tool(self, tool_name, arguments, **kwargs):
+        request_id = self._request_id
+        self._request_id += 1
+        self.calls.append((tool_name, arguments, kwargs))
+        self.started.set()
+        if self.fail is not None:
+            raise self.fail
+        if len(self.calls) in self.hang:
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                self.cancelled.append(request_id)
+                raise
+        return types.CallToolResult(content=[types.TextContent(type="text", text=f"found {arguments['q']}")])
+
+    async def send_notification(self, notification):
+        self.notifications.append(notification.root.params)
+
+
+def _setup(session: FakeSession, **config) -> ChatSession:
+    hub = MCPHub()
+    hub.speculative_tools = True
+    hub._server_configs["data"] = MCPServerConfig(name="data", command="unused", read_only_tools=["lookup"], **config)
+    hub.sessions["data"] = session
+    chat = ChatSession("test", None, tool_hub=hub)
+    chat.summarize = False
+    return chat
+
+
+def _tool_result(request) -> dict:
+    return request["messages"][-1]["content"][0]
+
+
+def test_speculative_result_is_reused(fake_anthropic):
+    async def run():
+        session = FakeSession()
+        # El stream sigue sólo cuando la tool ya empezó: la llamada ocurre durante la respuesta
+        client = fake_anthropic([tool_use("t1", "data__lookup", {"q": 1}), wait(session.started), text("Looking")],
+                                [text("Found it")])
+        output = await collect(_setup(session).send_message_stream("find 1"))
+        return session, client, output
+
+    session, client, output = asyncio.run(run())
+
+    assert output.startswith("Looking") and output.endswith("Found it")
+    assert len(session.calls) == 1
+    assert _tool_result(client.requests[1])["content"] == [{"type": "text", "text": "found 1"}]
+    assert claude_bot.speculation_stats == {"started": 1, "used": 1, "discarded": 0}
+
+
+def test_retry_cancels_the_discarded_speculative_call(fake_anthropic):
+    async def run():
+        session = FakeSession(hang=[1])
+        client = fake_anthropic([tool_use("t1", "data__lookup", {"q": 1}), wait(session.started), error(overloaded())],
+                                [tool_use("t2", "data__lookup", {"q": 2})],
+                                [text("Found it")])
+        await collect(_setup(session).send_message_stream("find"))
+        return session, client
+
+    session, client = asyncio.run(run())
+
+    # La primera llamada se canceló al empezar el reintento y el servidor recibió el aviso
+    assert session.cancelled == [0]
+    assert [(n.requestId, n.reason) for n in session.notifications] == [(0, "cancelled by the client")]
+    assert [args for _, args, _ in session.calls] == [{"q": 1}, {"q": 2}]
+    assert _tool_result(client.requests[2])["tool_use_id"] == "t2"
+    assert claude_bot.speculation_stats == {"started": 2, "used": 1, "discarded": 1}
+
+
+def test_timeout_becomes_an_error_tool_result(fake_anthropic):
+    async def run():
+        session = FakeSession(fail=McpError(types.ErrorData(code=408, message="Timed out")))
+        chat = _setup(session, tool_timeouts={"lookup": 0.05})
+        client = fake_anthropic([tool_use("t1", "data__lookup", {"q": 1})], [text("It timed out")])
+        output = await collect(chat.send_message_stream("find 1"))
+        return session, client, chat, output
+
+    session, client, chat, output = asyncio.run(run())
+
+    assert output.endswith("It timed out")
+    assert session.calls[0][2] == {"read_timeout_seconds": timedelta(seconds=0.05)}
+    assert _tool_result(client.requests[1])["content"] == "Error executing lookup: lookup timed out after 0.05s"
+    assert [(n.requestId, n.reason) for n in session.notifications] == [(0, "timed out")]
+    assert chat.hub.get_call_stats()["timeouts"] == 1
@@ -0,0 +1,132 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+import claude_bot
+from claude_bot import ChatMessage, ChatSession
+
+WHEN = datetime(2024, 1, 1)
+
+
+def _turn(i: int) -> list:
+    # 13 tokens estimados por mensaje, 26 por turno
+    return [ChatMessage(role="user", content=f"{i:02d}" + "q" * 34, timestamp=WHEN),
+            ChatMessage(role="assistant", content=f"{i:02d}" + "a" * 34, timestamp=WHEN)]
+
+
+def _session(turns: int, path=None) -> ChatSession:
+    session = ChatSession("test", path)
+    session.context_token_budget = 80
+    for i in range(turns):
+        session.history.extend(_turn(i))
+    return session
+
+
+@pytest.fixture
+def summarizer(monkeypatch):
+    """Sustituye la llamada al modelo: cada resumen nombra los mensajes plegados hasta ahora."""
+    calls = []
+
+    async def summarize(previous: str, transcript: str) -> str:
+        calls.append((previous, transcript))
+        seen = [line[6:8] for line in transcript.splitlines() if line.startswith("USER: ")]
+        return " ".join(filter(None, [previous, *seen]))
+
+    monkeypatch.setattr(claude_bot, "_summarize", summarize)
+    return calls
+
+
+def test_turns_out_of_context_are_folded_into_the_summary(summarizer, monkeypatch):
+    # Dos mensajes por tanda
+    monkeypatch.setattr(claude_bot, "SUMMARY_CHUNK_CHARS", 80)
+    session = _session(10)
+
+    asyncio.run(session._update_summary())
+
+    # Caben tres turnos en el presupuesto: los siete anteriores (14 mensajes) van al resumen
+    assert session.summary_covered == 14
+    assert session.summary == "00 01 02 03 04 05 06"
+    assert len(summarizer) == 7
+    # Cada tanda parte del resumen que dejó la anterior
+    assert [previous for previous, _ in summarizer[:3]] == ["", "00", "00 01"]
+    assert "Summary of the earlier part" in session.summary_prompt()
+
+
+def test_only_new_messages_are_summarized_later(summarizer):
+    session = _session(10)
+    asyncio.run(session._update_summary())
+    covered = session.summary_covered
+
+    for extra in range(10, 13):
+        summarizer.clear()
+        session.history.extend(_turn(extra))
+        out_of_context = len(session.history) - len(session._select_turns()[0])
+        asyncio.run(session._update_summary())
+
+        # Sólo se envían los mensajes posteriores a lo ya resumido, hasta el inicio del contexto
+        folded = [line[6:8] for _, t in summarizer for line in t.splitlines() if line.startswith("USER: ")]
+        assert folded == [f"{i:02d}" for i in range(covered // 2, session.summary_covered // 2)]
+        assert session.summary_covered == out_of_context
+        covered = session.summary_covered
+
+
+def test_summary_counts_against_the_budget():
+    session = _session(10)
+    session.context_token_budget = 120
+    assert len(session._select_turns()[0]) == 8
+
+    session.summary = "s" * 100
+    selected, used = session._select_turns()
+
+    assert len(selected) == 4
+    assert used == len(session.summary_prompt()) // claude_bot.CHARS_PER_TOKEN + 52
+
+
+def test_clear_during_a_summary_call_discards_it(monkeypatch):
+    session = _session(10)
+
+    async def summarize(previous: str, transcript: str) -> str:
+        session.clear()
+        return "stale"
+
+    monkeypatch.setattr(claude_bot, "_summarize", summarize)
+    asyncio.run(session._update_summary())
+
+    assert session.summary == ""
+    assert session.summary_covered == 0
+
+
+def test_failed_call_keeps_what_was_already_folded(monkeypatch):
+    monkeypatch.setattr(claude_bot, "SUMMARY_CHUNK_CHARS", 80)
+    session = _session(10)
+    calls = []
+
+    async def summarize(previous: str, transcript: str) -> str:
+        calls.append(transcript)
+        if len(calls) == 2:
+            raise RuntimeError("overloaded")
+        return "first"
+
+    monkeypatch.setattr(claude_bot, "_summarize", summarize)
+    asyncio.run(session._update_summary())
+
+    assert session.summary == "first"
+    assert session.summary_covered == 2
+
+
+def test_summary_is_saved_and_reloaded_with_the_session(summarizer, tmp_path):
+    path = tmp_path / "s.jsonl"
+
+    async def run():
+        session = _session(10, path)
+        await session._update_summary()
+        await claude_bot.writer.flush()
+        reloaded = ChatSession("test", path)
+        await reloaded.load()
+        return session, reloaded
+
+    session, reloaded = asyncio.run(run())
+
+    assert (reloaded.summary, reloaded.summary_covered) == (session.summary, 14)
+    assert len(reloaded.history) == 20
@@ -0,0 +1,173 @@
+import re
+import asyncio
+
+import pytest
+from mcp import types
+
+import mcp_manager
+from mcp_manager import MCPHub
+
+
+def _result(*blocks, **kwargs):
+    return types.CallToolResult(content=list(blocks), **kwargs)
+
+
+def _text(text: str):
+    return types.TextContent(type="text", text=text)
+
+
+def _handle(blocks) -> str:
+    return re.search(r'handle="([^"]+)"', blocks[-1]["text"]).group(1)
+
+
+def _fetch(hub: MCPHub, **arguments) -> str:
+    blocks = asyncio.run(hub.call_tool(mcp_manager.LOCAL_SERVER, "fetch_result", arguments))
+    return blocks[0]["text"]
+
+
+def test_small_results_pass_through():
+    hub = MCPHub()
+
+    blocks = hub._convert_tool_result(_result(_text("one"), _text("two")))
+
+    assert blocks == [{"type": "text", "text": "one"}, {"type": "text", "text": "two"}]
+
+
+def test_empty_and_structured_results():
+    hub = MCPHub()
+
+    assert hub._convert_tool_result(_result()) == [{"type": "text", "text": "(empty result)"}]
+    structured = hub._convert_tool_result(_result(structuredContent={"rows": 2}))
+    assert structured == [{"type": "text", "text": '{"rows": 2}'}]
+
+
+def test_long_text_is_capped_and_the_rest_kept_under_a_handle():
+    hub = MCPHub()
+    hub.configure_tool_results(max_bytes=100)
+    text = "".join(f"{i:04d}" for i in range(100))
+
+    blocks = hub._convert_tool_result(_result(_text(text)))
+
+    assert blocks[0] == {"type": "text", "text": text[:100]}
+    assert "300 more bytes" in blocks[1]["text"]
+    assert hub._stored_results[_handle(blocks)][1] == text[100:]
+
+
+def test_fetch_result_pages_through_the_rest():
+    hub = MCPHub()
+    hub.configure_tool_results(max_bytes=100)
+    text = "".join(f"{i:04d}" for i in range(100))
+    handle = _handle(hub._convert_tool_result(_result(_text(text))))
+
+    first = _fetch(hub, handle=handle)
+    assert first.startswith(text[100:200])
+    assert "offset=100" in first
+
+    rest = _fetch(hub, handle=handle, offset=100, length=1000)
+    assert rest.startswith(text[200:300])
+    # length se limita a max_result_bytes
+    assert _fetch(hub, handle=handle, offset=200) == text[300:]
+
+
+def test_text_after_the_cap_goes_to_the_same_handle():
+    hub = MCPHub()
+    hub.configure_tool_results(max_bytes=10)
+
+    blocks = hub._convert_tool_result(_result(_text("a" * 15), _text("b" * 5)))
+
+    assert blocks[0]["text"] == "a" * 10
+    assert hub._stored_results[_handle(blocks)][1] == "a" * 5 + "\n" + "b" * 5
+
+
+def test_truncation_does_not_split_characters():
+    hub = MCPHub()
+    hub.configure_tool_results(max_bytes=5)
+
+    blocks = hub._convert_tool_result(_result(_text("ñññññ")))
+
+    # Cada ñ ocupa 2 bytes: caben dos
+    assert blocks[0]["text"] == "ññ"
+    assert hub._stored_results[_handle(blocks)][1] == "ñññ"
+
+
+def test_images_over_the_remaining_budget_are_omitted():
+    hub = MCPHub()
+    hub.configure_tool_results(max_bytes=10)
+    image = types.ImageContent(type="image", data="A" * 40, mimeType="image/png")
+
+    blocks = hub._convert_tool_result(_result(_text("caption"), image))
+
+    assert blocks == [{"type": "text", "text": "caption"},
+                      {"type": "text", "text": "[image omitted: exceeds tool result size cap]"}]
+
+
+def test_unknown_handle_is_rejected():
+    hub = MCPHub()
+
+    with pytest.raises(ValueError, match="Unknown or expired"):
+        _fetch(hub, handle="res-404")
+
+
+def test_only_the_latest_results_are_kept():
+    hub = MCPHub()
+    handles = [hub._store_result(str(i)) for i in range(mcp_manager.MAX_STORED_RESULTS + 1)]
+
+    assert handles[0] not in hub._stored_results
+    assert all(h in hub._stored_results for h in handles[1:])
+
+
+def _page(hub: MCPHub, handle: str, offset: int, length: int):
+    """Texto de una página sin el aviso final, y el offset de la siguiente (None en la última)."""
+    text = _fetch(hub, handle=handle, offset=offset, length=length)
+    match = re.search(r'\n\[\d+ more bytes\. .* offset=(\d+)\]$', text)
+    if match is None:
+        return text, None
+    return text[:match.start()], int(match.group(1))
+
+
+@pytest.mark.parametrize("length", [1, 2, 3, 5, 7])
+def test_pages_split_on_character_boundaries(length):
+    hub = MCPHub()
+    hub.configure_tool_results(max_bytes=8)
+    # Caracteres de 1, 2, 3 y 4 bytes: casi cualquier corte cae en medio de uno
+    rest = "añ€😀b" * 5
+    handle = hub._store_result(rest)
+
+    pages, offset = [], 0
+    while offset is not None:
+        text, next_offset = _page(hub, handle, offset, length)
+        assert text
+        pages.append(text)
+        assert next_offset is None or next_offset == offset + len(text.encode("utf-8"))
+        offset = next_offset
+
+    assert "".join(pages) == rest
+
+
+def test_offset_inside_a_character_starts_at_that_character():
+    hub = MCPHub()
+    handle = hub._store_result("€uro")
+
+    assert _fetch(hub, handle=handle, offset=1) == "€uro"
+
+
+def test_handles_are_not_sequential():
+    hub = MCPHub()
+    first, second = hub._store_result("a"), hub._store_result("b")
+
+    assert re.fullmatch(r"res-[0-9a-f]{16}", first)
+    assert first != second
+
+
+def test_only_the_owner_can_fetch_a_result():
+    hub = MCPHub()
+    hub.configure_tool_results(max_bytes=10)
+    blocks = hub._convert_tool_result(_result(_text("x" * 30)), owner="alice")
+    handle = _handle(blocks)
+
+    with pytest.raises(ValueError, match="Unknown or expired"):
+        asyncio.run(hub.call_tool(mcp_manager.LOCAL_SERVER, "fetch_result", {"handle": handle}, owner="bob"))
+    with pytest.raises(ValueError, match="Unknown or expired"):
+        _fetch(hub, handle=handle)
+    text = asyncio.run(hub.call_tool(mcp_manager.LOCAL_SERVER, "fetch_result", {"handle": handle}, owner="alice"))
+    assert text[0]["text"].startswith("x" * 10)
@@ -0,0 +1,146 @@
+import claude_bot
+from tool_selector import SEARCH_TOOL, SEARCH_TOOL_NAME, ToolIndex, ToolSelector, _tokenize
+
+
+def _tool(name: str, description: str, **properties) -> dict:
+    return {
+        "name": name,
+        "description": description,
+        "input_schema": {"type": "object", "properties": {k: {"type": "string", "description": v}
+                                                          for k, v in properties.items()}},
+    }
+
+
+CATALOG = [
+    _tool("fs__read_file", "Read the contents of a file", path="Path of the file"),
+    _tool("fs__write_file", "Write text to a file", path="Path of the file", text="Text to write"),
+    _tool("fs__list_directory", "List the entries of a directory", path="Directory path"),
+    _tool("git__git_log", "Show the commit history of a repository", repo="Repository path"),
+    _tool("git__git_diff", "Show changes between commits", repo="Repository path"),
+    _tool("weather__get_forecast", "Weather forecast for a city", city="City name"),
+    _tool("weather__get_alerts", "Active weather alerts for a region", region="Region code"),
+    _tool("datasets__load_dataset", "Load a dataset by id", dataset_id="Dataset id"),
+    _tool("datasets__describe_columns", "Summary statistics for each column of a dataset", dataset_id="Dataset id"),
+    _tool("datasets__plot_histogram", "Plot a histogram of a column", dataset_id="Dataset id", column="Column"),
+    _tool("calendar__create_event", "Create a calendar event", title="Event title", when="Start time"),
+    _tool("calendar__list_events", "List upcoming calendar events", days="How many days ahead"),
+    _tool("mail__send_email", "Send an email message", to="Recipient", body="Message body"),
+    _tool("mail__search_inbox", "Search received email", query="Search terms"),
+]
+
+
+def _names(tools) -> list:
+    return [t["name"] for t in tools]
+
+
+def test_tokenize_splits_identifiers_and_drops_noise():
+    assert _tokenize("getForecast for the read_files") == ["get", "forecast", "read", "file"]
+
+
+def test_best_match_ranks_first():
+    index = ToolIndex(CATALOG)
+
+    assert index.search("what's the weather forecast in Paris", 3)[0] == "weather__get_forecast"
+    assert index.search("show me the commit history", 3)[0] == "git__git_log"
+
+
+def test_tool_name_outweighs_description():
+    index = ToolIndex([
+        _tool("notes__search", "Find notes"),
+        _tool("notes__archive", "Archive notes, they can be found later with search"),
+    ])
+
+    assert index.search("search", 2)[0] == "notes__search"
+
+
+def test_weak_matches_and_limit():
+    index = ToolIndex(CATALOG)
+
+    assert index.search("histogram", 5) == ["datasets__plot_histogram"]
+    assert len(index.search("file directory path", 2)) == 2
+    assert index.search("quantum chromodynamics", 5) == []
+
+
+def test_server_context_is_indexed():
+    index = ToolIndex(CATALOG, {"weather": "meteorology service"})
+
+    assert set(index.search("meteorology", 5)) == {"weather__get_forecast", "weather__get_alerts"}
+
+
+def test_small_catalogs_are_sent_whole():
+    selector = ToolSelector()
+    selector.configure(min_tools=len(CATALOG))
+
+    assert selector.select(CATALOG, "weather") is CATALOG
+
+
+def test_disabled_selector_sends_everything():
+    selector = ToolSelector()
+    selector.configure(enabled=False, min_tools=0)
+
+    assert selector.select(CATALOG, "weather") is CATALOG
+
+
+def test_pruned_set_keeps_catalog_order_and_adds_search_tool():
+    selector = ToolSelector()
+    selector.configure(min_tools=4, always_include=["mail__send_email"])
+
+    selected = selector.select(CATALOG, "weather alerts", recent=["fs__read_file"], extra=["git__git_diff"])
+
+    names = _names(selected)
+    assert names[-1] == SEARCH_TOOL_NAME
+    assert {"weather__get_alerts", "fs__read_file", "git__git_diff", "mail__send_email"} <= set(names)
+    assert "calendar__create_event" not in names
+    assert names[:-1] == [n for n in _names(CATALOG) if n in names]
+    assert selector.get_stats()["pruned"] == 1
+
+
+def test_index_is_built_once_per_catalog_version():
+    selector = ToolSelector()
+    first = selector.index(CATALOG)
+
+    assert selector.index(CATALOG) is first
+    assert selector.index(list(CATALOG)) is not first
+
+
+class _Hub:
+    """Lo que ChatSession usa del hub para elegir tools."""
+
+    def __init__(self, tools):
+        self.tools = tools
+        self.tool_selector = ToolSelector()
+        self.tool_selector.configure(min_tools=4)
+
+    def select_tools(self, query, recent=(), extra=()):
+        return self.tool_selector.select(self.tools, query, recent, extra)
+
+    def get_all_tools_for_anthropic(self):
+        return self.tools
+
+
+def test_prompt_caching_keeps_a_grow_only_tool_set():
+    session = claude_bot.ChatSession("test", None, tool_hub=_Hub(CATALOG))
+    session.prompt_caching = True
+
+    first = _names(session._select_tools("weather forecast"))
+    second = _names(session._select_tools("show the commit history"))
+    third = _names(session._select_tools("weather forecast"))
+
+    assert "weather__get_forecast" in first and "git__git_log" in second
+    # Lo enviado antes sigue en el set y en la misma posición relativa
+    assert set(first) <= set(second)
+    assert third == second
+    assert second[-1] == SEARCH_TOOL_NAME
+
+    session.clear()
+    assert "git__git_log" not in _names(session._select_tools("weather forecast"))
+
+
+def test_without_prompt_caching_each_request_is_pruned_independently():
+    session = claude_bot.ChatSession("test", None, tool_hub=_Hub(CATALOG))
+    session.prompt_caching = False
+
+    session._select_tools("show the commit history")
+
+    assert "git__git_log" not in _names(session._select_tools("weather forecast"))
+    assert SEARCH_TOOL in session._select_tools("weather forecast")
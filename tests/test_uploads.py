@@ -0,0 +1,98 @@
+import json
+import asyncio
+
+import pytest
+from mcp import types
+
+import mcp_manager
+from mcp_manager import MCPHub, MCPServerConfig
+
+UPLOAD_TOOL = f"{mcp_manager.LOCAL_SERVER}__upload_file"
+
+
+class FakeSession:
+    def __init__(self):
+        self.calls = []
+
+    async def call_tool(self, tool_name, arguments, **kwargs):
+        self.calls.append((tool_name, arguments))
+        return types.CallToolResult(content=[types.TextContent(type="text", text="dataset-1")])
+
+
+@pytest.fixture
+def setup(tmp_path):
+    root = tmp_path / "uploads"
+    root.mkdir()
+    (root / "data.xlsx").write_bytes(b"inside")
+    outside = tmp_path / "secret.env"
+    outside.write_bytes(b"API_KEY=1")
+
+    hub = MCPHub()
+    hub.upload_root = root
+    session = FakeSession()
+    hub._server_configs["datasets"] = MCPServerConfig(name="datasets", command="unused", upload_tool="upload_excel")
+    hub.sessions["datasets"] = session
+    return hub, session, root, outside
+
+
+def _upload(hub: MCPHub, path: str):
+    return asyncio.run(hub.call_tool(mcp_manager.LOCAL_SERVER, "upload_file", {"path": path}))
+
+
+def test_file_under_the_root_is_uploaded(setup):
+    hub, session, root, _ = setup
+
+    _upload(hub, "data.xlsx")
+    _upload(hub, str(root / "data.xlsx"))
+
+    assert [args["filename"] for _, args in session.calls] == ["data.xlsx", "data.xlsx"]
+
+
+def test_parent_traversal_is_rejected(setup):
+    hub, session, _, _ = setup
+
+    with pytest.raises(ValueError, match="limited to files under"):
+        _upload(hub, "../secret.env")
+    assert session.calls == []
+
+
+def test_absolute_path_outside_the_root_is_rejected(setup):
+    hub, session, _, outside = setup
+
+    with pytest.raises(ValueError, match="limited to files under"):
+        _upload(hub, str(outside))
+    assert session.calls == []
+
+
+def test_symlink_inside_the_root_pointing_outside_is_rejected(setup):
+    hub, session, root, outside = setup
+    (root / "innocent.xlsx").symlink_to(outside)
+
+    with pytest.raises(ValueError, match="limited to files under"):
+        _upload(hub, "innocent.xlsx")
+    assert session.calls == []
+
+
+def test_without_upload_root_the_tool_is_disabled(setup):
+    hub, session, root, _ = setup
+    hub.upload_root = None
+    hub._combined_tools_cache = None
+
+    assert UPLOAD_TOOL not in [t["name"] for t in hub.get_all_tools_for_anthropic()]
+    with pytest.raises(ValueError, match="disabled"):
+        _upload(hub, str(root / "data.xlsx"))
+    assert session.calls == []
+
+
+def test_load_config_controls_whether_the_tool_is_offered(tmp_path):
+    hub = MCPHub()
+    config = tmp_path / "mcp_config.json"
+
+    config.write_text(json.dumps({"servers": [], "upload_root": "datasets"}))
+    mcp_manager.load_config(str(config), hub)
+    assert UPLOAD_TOOL in [t["name"] for t in hub.get_all_tools_for_anthropic()]
+
+    config.write_text(json.dumps({"servers": []}))
+    mcp_manager.load_config(str(config), hub)
+    assert hub.upload_root is None
+    assert UPLOAD_TOOL not in [t["name"] for t in hub.get_all_tools_for_anthropic()]
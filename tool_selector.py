@@ -0,0 +1,165 @@
+import re
+import math
+import logging
+from collections import Counter
+from typing import List, Dict, Any, Optional, Iterable, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Meta-tool que se envía cuando el set está recortado: el modelo la llama si no tiene la tool
+# que necesita y las que encuentre se añaden a las peticiones siguientes del turno
+SEARCH_TOOL_NAME = "client__search_tools"
+SEARCH_TOOL: Dict[str, Any] = {
+    "name": SEARCH_TOOL_NAME,
+    "description": ("[client] Sólo se muestra una parte de las tools disponibles. Si ninguna sirve para "
+                    "lo que pide el usuario, busca por palabras clave entre todas las tools; las que "
+                    "encuentre estarán disponibles en el siguiente paso"),
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "query": {"type": "string", "description": "Qué tiene que hacer la tool (palabras clave)"},
+        },
+        "required": ["query"]
+    }
+}
+
+# Parámetros de BM25
+_K1 = 1.2
+_B = 0.75
+# El nombre de la tool pesa más que su descripción
+_NAME_WEIGHT = 3
+# Se descartan las coincidencias con menos de esta fracción de la puntuación de la mejor
+_MIN_SCORE_RATIO = 0.3
+
+_STOPWORDS = frozenset("""
+a an and are as at be by can do does for from how i in is it me my of on or please show
+tell that the this to use what when which with you your
+al con como cual de del el en es esta este la las lo los me mi por que se su un una y o para
+""".split())
+
+
+def _tokenize(text: str) -> List[str]:
+    """Palabras en minúsculas (partiendo snake_case y camelCase), sin stopwords y sin plural simple."""
+    text = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", text or "").lower()
+    tokens = []
+    for word in re.findall(r"[a-z0-9áéíóúñü]+", text):
+        if len(word) < 2 or word in _STOPWORDS:
+            continue
+        if len(word) > 3 and word.endswith("s"):
+            word = word[:-1]
+        tokens.append(word)
+    return tokens
+
+
+def _tool_terms(tool: Dict[str, Any], context: str = "") -> List[str]:
+    """Términos indexados de una tool: nombre, descripción, parámetros y el contexto del servidor."""
+    terms = _tokenize(tool["name"].replace("__", " ")) * _NAME_WEIGHT
+    terms += _tokenize(tool.get("description") or "")
+    for prop, spec in (tool.get("input_schema") or {}).get("properties", {}).items():
+        terms += _tokenize(prop)
+        if isinstance(spec, dict):
+            terms += _tokenize(spec.get("description") or "")
+    return terms + _tokenize(context)
+
+
+class ToolIndex:
+    """Índice BM25 sobre las tools de una versión del catálogo del hub."""
+
+    def __init__(self, tools: List[Dict[str, Any]], contexts: Optional[Dict[str, str]] = None):
+        contexts = contexts or {}
+        self.names = [t["name"] for t in tools]
+        self._postings: Dict[str, List[Tuple[int, int]]] = {}
+        self._lengths: List[int] = []
+        for doc, tool in enumerate(tools):
+            terms = _tool_terms(tool, contexts.get(tool["name"].split("__", 1)[0], ""))
+            self._lengths.append(len(terms))
+            for term, tf in Counter(terms).items():
+                self._postings.setdefault(term, []).append((doc, tf))
+        self._avg_length = sum(self._lengths) / len(self._lengths) if self._lengths else 0.0
+
+    def search(self, query: str, limit: int) -> List[str]:
+        """Hasta `limit` nombres de tools relevantes para `query`, sin las de puntuación muy baja."""
+        scores: Dict[int, float] = {}
+        total = len(self.names)
+        for term in set(_tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc, tf in postings:
+                norm = _K1 * (1 - _B + _B * self._lengths[doc] / (self._avg_length or 1))
+                scores[doc] = scores.get(doc, 0.0) + idf * tf * (_K1 + 1) / (tf + norm)
+        ranked = sorted(scores.items(), key=lambda kv: -kv[1])[:limit]
+        cutoff = ranked[0][1] * _MIN_SCORE_RATIO if ranked else 0.0
+        return [self.names[doc] for doc, score in ranked if score >= cutoff]
+
+
+class ToolSelector:
+    """
+    Elige qué schemas de tools se envían en cada petición: las más relevantes para el mensaje
+    del usuario según el índice, las usadas en los últimos turnos, las fijas (always_include) y
+    las que el modelo haya pedido en este turno con client__search_tools. Con pocas tools
+    (<= min_tools) o desactivado se envía el catálogo completo.
+    """
+
+    def __init__(self):
+        self.enabled: bool = True
+        self.max_tools: int = 8
+        self.min_tools: int = 12
+        self.recent_turns: int = 3
+        self.always_include: List[str] = []
+        self._index_key = None
+        self._index: Optional[ToolIndex] = None
+        self.stats: Dict[str, int] = {"requests": 0, "pruned": 0, "tools_sent": 0, "tools_total": 0,
+                                      "searches": 0}
+
+    def configure(self, enabled: Optional[bool] = None, max_tools: Optional[int] = None,
+                  min_tools: Optional[int] = None, recent_turns: Optional[int] = None,
+                  always_include: Optional[List[str]] = None) -> None:
+        if enabled is not None:
+            self.enabled = enabled
+        if max_tools is not None:
+            self.max_tools = max(1, max_tools)
+        if min_tools is not None:
+            self.min_tools = min_tools
+        if recent_turns is not None:
+            self.recent_turns = recent_turns
+        if always_include is not None:
+            self.always_include = list(always_include)
+
+    def index(self, tools: List[Dict[str, Any]], contexts: Optional[Dict[str, str]] = None) -> ToolIndex:
+        # El hub devuelve la misma lista mientras no cambie el catálogo: se indexa una vez por versión
+        if self._index_key is not tools:
+            self._index = ToolIndex(tools, contexts)
+            self._index_key = tools
+            logger.debug("Indexed %d tools for selection", len(tools))
+        return self._index
+
+    def search(self, tools: List[Dict[str, Any]], query: str, contexts: Optional[Dict[str, str]] = None,
+               limit: Optional[int] = None) -> List[str]:
+        return self.index(tools, contexts).search(query, limit or self.max_tools)
+
+    def select(self, tools: List[Dict[str, Any]], query: str, recent: Iterable[str] = (),
+               extra: Iterable[str] = (), contexts: Optional[Dict[str, str]] = None) -> List[Dict[str, Any]]:
+        """Subconjunto de `tools` para una petición, en el orden del catálogo, más SEARCH_TOOL."""
+        self.stats["requests"] += 1
+        self.stats["tools_total"] += len(tools)
+        if not self.enabled or len(tools) <= self.min_tools:
+            self.stats["tools_sent"] += len(tools)
+            return tools
+
+        wanted = set(self.always_include) | set(recent) | set(extra)
+        wanted.update(self.search(tools, query, contexts))
+        selected = [t for t in tools if t["name"] in wanted]
+        selected.append(SEARCH_TOOL)
+        self.stats["pruned"] += 1
+        self.stats["tools_sent"] += len(selected)
+        return selected
+
+    def get_stats(self) -> Dict[str, Any]:
+        requests = self.stats["requests"]
+        return {
+            **self.stats,
+            "avg_tools_sent": round(self.stats["tools_sent"] / requests, 1) if requests else 0.0,
+            "avg_tools_total": round(self.stats["tools_total"] / requests, 1) if requests else 0.0,
+        }
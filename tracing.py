@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import List, Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+# Spans recientes en formato Chrome trace (chrome://tracing, Perfetto); se descartan los más viejos
+MAX_EVENTS = 50_000
+# Muestras por histograma para calcular percentiles
+HISTOGRAM_SAMPLES = 2048
+
+enabled: bool = True
+# Si está definido, cleanup() del bot exporta aquí la traza al salir
+export_path: Optional[str] = os.getenv("TRACE_FILE") or None
+_events: "deque[Dict[str, Any]]" = deque(maxlen=MAX_EVENTS)
+_histograms: Dict[str, "_Histogram"] = {}
+_task_ids: Dict[int, int] = {}
+# Referencia de tiempo de los "ts" exportados
+ORIGIN = time.perf_counter()
+_pid = os.getpid()
+
+
+class _Histogram:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples: "deque[float]" = deque(maxlen=HISTOGRAM_SAMPLES)
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.samples.append(value)
+
+    def percentile(self, pct: float) -> float:
+        ordered = sorted(self.samples)
+        if not ordered:
+            return 0.0
+        return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def _track_id() -> int:
+    """Una fila por task de asyncio en el visor (o por hilo fuera del loop)."""
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    key = id(task) if task is not None else threading.get_ident()
+    track = _task_ids.get(key)
+    if track is None:
+        track = _task_ids[key] = len(_task_ids) + 1
+        if len(_task_ids) > 10_000:
+            _task_ids.clear()
+    return track
+
+
+def record(name: str, start: float, end: float, cat: str = "app", **args) -> None:
+    """Registra un span ya medido (tiempos de time.perf_counter())."""
+    if not enabled:
+        return
+    duration = end - start
+    hist = _histograms.get(name)
+    if hist is None:
+        hist = _histograms[name] = _Histogram()
+    hist.add(duration)
+    _events.append({
+        "name": name,
+        "cat": cat,
+        "ph": "X",
+        "ts": round((start - ORIGIN) * 1e6, 1),
+        "dur": round(duration * 1e6, 1),
+        "pid": _pid,
+        "tid": _track_id(),
+        "args": args,
+    })
+
+
+@contextmanager
+def span(name: str, cat: str = "app", **args):
+    """Mide el bloque (incluidos los await que contenga) y lo registra como span."""
+    if not enabled:
+        yield args
+        return
+    start = time.perf_counter()
+    try:
+        yield args
+    except BaseException as e:
+        args["error"] = type(e).__name__
+        raise
+    finally:
+        record(name, start, time.perf_counter(), cat, **args)
+
+
+def summary() -> Dict[str, Dict[str, float]]:
+    """count, media y percentiles (en ms) de cada span, ordenados por tiempo total."""
+    result = {}
+    for name, hist in sorted(_histograms.items(), key=lambda kv: -kv[1].total):
+        result[name] = {
+            "count": hist.count,
+            "total_ms": round(hist.total * 1000, 1),
+            "mean_ms": round(hist.total / hist.count * 1000, 2) if hist.count else 0.0,
+            "p50_ms": round(hist.percentile(50) * 1000, 2),
+            "p95_ms": round(hist.percentile(95) * 1000, 2),
+            "p99_ms": round(hist.percentile(99) * 1000, 2),
+            "max_ms": round(hist.max * 1000, 2),
+        }
+    return result
+
+
+def events(prefixes: tuple = ()) -> List[Dict[str, Any]]:
+    """Spans registrados (opcionalmente sólo los que empiezan por `prefixes`) en orden de inicio."""
+    selected = [e for e in _events if not prefixes or e["name"].startswith(prefixes)]
+    return sorted(selected, key=lambda e: e["ts"])
+
+
+def export_chrome_trace(path: str) -> int:
+    """Escribe los spans en formato Chrome trace JSON. Devuelve cuántos eventos escribió."""
+    trace_events: List[Dict[str, Any]] = list(_events)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f, default=str)
+    logger.info("Wrote %d trace events to %s", len(trace_events), path)
+    return len(trace_events)
+
+
+def reset() -> None:
+    _events.clear()
+    _histograms.clear()
+    _task_ids.clear()
+
+
+def configure(enable: bool = True, trace_file: Optional[str] = None) -> None:
+    global enabled, export_path
+    enabled = enable
+    export_path = trace_file